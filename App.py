@@ -1,23 +1,41 @@
 import base64
+import copy
 import csv
 import io
 import logging
 import traceback
 import fitz  # PyMuPDF
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g as request_g, has_request_context
+import click
 import psycopg2
 import pdfplumber
 import PyPDF2
 from psycopg2 import errors
 from datetime import datetime ,date, timedelta
 import re
-from collections import defaultdict , Counter
+from collections import defaultdict , Counter, OrderedDict, deque
 import os
+import sys
+import threading
+import time
+import select
+import signal
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from PyPDF2 import PdfReader
 import json, gzip
-from typing import Any, Dict, List, Optional, Tuple
+import zlib
+import hashlib
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+from types import MappingProxyType
+from contextlib import contextmanager
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import zipfile
+import uuid
 import pandas as pd
+import numpy as np
 import requests
 from flask_mail import Mail, Message
 import openai
@@ -25,6 +43,16 @@ from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
 import pytz
 
+# Optional: brotli response encoding and Arrow/Parquet output formats
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
 
 # --- Flask-Mail Configuration (Outlook SMTP) ---
 
@@ -66,17 +94,15 @@ def process_nidec_elpaso_monterrey_pdf(pdf_bytes, file_name):
     """
 
     import re
-    import io
     import logging
 
-    # 1) Mapping inside the function (same style as your other clients)
-    pn_mapping = {
-        "O000003528": "50-0819M",
-    }
+    # 1) Part number mapping (MAPPING_REGISTRY)
+    pn_mapping = MAPPING_REGISTRY.forward("nidec_elpaso.part_to_avo")
 
     # 2) Extract PDF text using your existing helper
     #    (You already have parse_pdf(BytesIO(...)) in your codebase)
-    text = parse_pdf(io.BytesIO(pdf_bytes)) or ""
+    with pdf_document(pdf_bytes, file_name) as pdf:
+        text = pdf.pypdf_text() or ""
     if not text.strip():
         return []
 
@@ -266,19 +292,7 @@ def extract_pn_from_item_description(item_desc: str) -> str:
         return ""
     return item_desc.split(" - ", 1)[0].strip()
 def process_monterrey_ti_caro_rows(rows, header):
-    pn_mapping = {
-        "1870678": "05-0396AM",
-        "1870681": "05-0411BM",
-        "1870682": "05-0412BM",
-        "1870683": "05-0413BM",
-        "1870685": "05-0415BM",
-        "1870686": "05-0416BM",
-        "1870680": "05-0420AM",
-        "1870687": "05-0424AM",
-        "000103335/AA": "05-0452M",
-        "000116611/AA": "05-0604",
-        "116611": "05-0604",
-    }
+    pn_mapping = MAPPING_REGISTRY.forward("ti_caro.part_to_avo")
 
     idx = {str(col).strip(): i for i, col in enumerate(header)}
 
@@ -370,10 +384,1115 @@ def process_monterrey_ti_caro_rows(rows, header):
 
     logging.warning(f"[Monterrey TI CARO] Processed {len(processed)} records.")
     return processed 
-def get_pg_connection():
+
+
+# ========================= DB CONNECTION POOL =========================
+# One ThreadedConnectionPool per worker process (created lazily, so gunicorn
+# forks never share sockets). get_pg_connection() hands out a thin wrapper
+# whose close() returns the connection to the pool instead of tearing down
+# the TLS session, so existing callers keep their `conn.close()` calls.
+
+# NOTE: psycopg2 keeps at most PG_POOL_MIN idle connections; extra ones are closed on return.
+PG_POOL_MIN = int(os.environ.get("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.environ.get("PG_POOL_MAX", "10"))
+PG_POOL_TIMEOUT = float(os.environ.get("PG_POOL_TIMEOUT", "30"))          # seconds to wait for a free connection
+PG_POOL_HEALTHCHECK_IDLE = float(os.environ.get("PG_POOL_HEALTHCHECK_IDLE", "60"))  # ping connections idle longer than this
+
+_pg_pool = None
+_pg_pool_pid = None
+_pg_pool_lock = threading.Lock()
+_pg_pool_slots = None
+_pg_idle_since: Dict[int, float] = {}
+
+_pg_pool_stats = {
+    "checkouts": 0,
+    "checkout_errors": 0,
+    "wait_ms_total": 0.0,
+    "wait_ms_max": 0.0,
+    "held_ms_total": 0.0,
+    "held_ms_max": 0.0,
+    "healthcheck_failures": 0,
+    "discarded": 0,
+    "in_use": 0,
+}
+_pg_pool_callers: Dict[str, Dict[str, Any]] = {}
+
+# Connections whose proxy was garbage-collected without close(). __del__ can
+# run on any thread at any allocation, including while that thread already
+# holds _pg_pool_lock or the pool's internal lock, so it only appends here
+# (deque.append is atomic and lock-free) and the actual release happens on
+# the next get_pg_connection() / close().
+_pg_pending_release: deque = deque()
+
+
+def get_direct_pg_connection():
+    """Unpooled connection, for long-lived sessions (e.g. the scheduler advisory lock)."""
     return psycopg2.connect(DATABASE_URL)
 
 
+def _get_pg_pool():
+    global _pg_pool, _pg_pool_pid, _pg_pool_slots
+    pid = os.getpid()
+    if _pg_pool is not None and _pg_pool_pid == pid:
+        return _pg_pool
+    with _pg_pool_lock:
+        if _pg_pool is None or _pg_pool_pid != pid:
+            _pg_pool = ThreadedConnectionPool(PG_POOL_MIN, PG_POOL_MAX, DATABASE_URL)
+            _pg_pool_pid = pid
+            _pg_pool_slots = threading.BoundedSemaphore(PG_POOL_MAX)
+            _pg_idle_since.clear()
+            logging.info(f"[DB POOL] created pid={pid} min={PG_POOL_MIN} max={PG_POOL_MAX}")
+    return _pg_pool
+
+
+def _pg_connection_is_healthy(raw) -> bool:
+    if raw.closed:
+        return False
+    idle_since = _pg_idle_since.get(id(raw))
+    if idle_since is not None and time.monotonic() - idle_since < PG_POOL_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with raw.cursor() as cur:
+            cur.execute("SELECT 1")
+        raw.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+class PooledConnection:
+    """
+    Proxy around a pooled psycopg2 connection. Everything is delegated to the
+    real connection except close(), which hands it back to the pool.
+    """
+
+    def __init__(self, pool, raw, caller):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_raw", raw)
+        object.__setattr__(self, "_caller", caller)
+        object.__setattr__(self, "_checked_out_at", time.monotonic())
+        object.__setattr__(self, "_released", False)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+    def __enter__(self):
+        self._raw.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._raw.__exit__(exc_type, exc, tb)
+
+    @property
+    def closed(self):
+        return 1 if self._released else self._raw.closed
+
+    def close(self):
+        if self._released:
+            return
+        object.__setattr__(self, "_released", True)
+        _release_pg_connection(self._pool, self._raw, self._caller, self._checked_out_at)
+        _drain_pending_pg_releases()
+
+    def __del__(self):
+        # Safety net for callers that forget close() on an error path. No
+        # locks and no logging here: just queue it for _drain_pending_pg_releases().
+        try:
+            if not self._released:
+                object.__setattr__(self, "_released", True)
+                _pg_pending_release.append((self._pool, self._raw, self._caller, self._checked_out_at))
+        except Exception:
+            pass
+
+
+def _release_pg_connection(pool, raw, caller, checked_out_at):
+    held_ms = (time.monotonic() - checked_out_at) * 1000.0
+    discard = bool(raw.closed)
+    if not discard:
+        try:
+            if raw.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                raw.rollback()
+            if raw.autocommit:
+                raw.autocommit = False
+        except psycopg2.Error:
+            discard = True
+    try:
+        if discard:
+            _pg_idle_since.pop(id(raw), None)
+        else:
+            _pg_idle_since[id(raw)] = time.monotonic()
+        pool.putconn(raw, close=discard)
+    except Exception as e:
+        logging.warning(f"[DB POOL] putconn failed: {e}")
+    finally:
+        if pool is _pg_pool and _pg_pool_slots is not None:
+            _pg_pool_slots.release()
+    with _pg_pool_lock:
+        st = _pg_pool_stats
+        st["in_use"] -= 1
+        st["held_ms_total"] += held_ms
+        st["held_ms_max"] = max(st["held_ms_max"], held_ms)
+        if discard:
+            st["discarded"] += 1
+        c = _pg_pool_callers.get(caller)
+        if c is not None:
+            c["held_ms_total"] += held_ms
+            c["held_ms_max"] = max(c["held_ms_max"], held_ms)
+
+
+def _drain_pending_pg_releases():
+    while True:
+        try:
+            pool, raw, caller, checked_out_at = _pg_pending_release.popleft()
+        except IndexError:
+            return
+        logging.warning(f"[DB POOL] connection from {caller} was garbage-collected without close()")
+        _release_pg_connection(pool, raw, caller, checked_out_at)
+
+
+def get_pg_connection():
+    # Before waiting on a slot, so leaked connections can't starve the pool.
+    _drain_pending_pg_releases()
+    pool = _get_pg_pool()
+    caller = sys._getframe(1).f_code.co_name
+    started = time.monotonic()
+
+    if not _pg_pool_slots.acquire(timeout=PG_POOL_TIMEOUT):
+        with _pg_pool_lock:
+            _pg_pool_stats["checkout_errors"] += 1
+        raise psycopg2.pool.PoolError(
+            f"connection pool exhausted: no connection freed within {PG_POOL_TIMEOUT:.0f}s (max={PG_POOL_MAX})"
+        )
+
+    try:
+        raw = pool.getconn()
+        if not _pg_connection_is_healthy(raw):
+            with _pg_pool_lock:
+                _pg_pool_stats["healthcheck_failures"] += 1
+                _pg_pool_stats["discarded"] += 1
+            _pg_idle_since.pop(id(raw), None)
+            pool.putconn(raw, close=True)
+            raw = pool.getconn()
+    except Exception:
+        _pg_pool_slots.release()
+        with _pg_pool_lock:
+            _pg_pool_stats["checkout_errors"] += 1
+        raise
+
+    wait_ms = (time.monotonic() - started) * 1000.0
+    with _pg_pool_lock:
+        st = _pg_pool_stats
+        st["checkouts"] += 1
+        st["in_use"] += 1
+        st["wait_ms_total"] += wait_ms
+        st["wait_ms_max"] = max(st["wait_ms_max"], wait_ms)
+        c = _pg_pool_callers.setdefault(caller, {
+            "checkouts": 0, "wait_ms_total": 0.0, "held_ms_total": 0.0, "held_ms_max": 0.0,
+        })
+        c["checkouts"] += 1
+        c["wait_ms_total"] += wait_ms
+
+    return PooledConnection(pool, raw, caller)
+
+
+def get_pg_pool_stats() -> Dict[str, Any]:
+    with _pg_pool_lock:
+        st = dict(_pg_pool_stats)
+        callers = {k: dict(v) for k, v in _pg_pool_callers.items()}
+    n = st["checkouts"] or 1
+    pool = _pg_pool
+    return {
+        "pid": _pg_pool_pid,
+        "min_size": PG_POOL_MIN,
+        "max_size": PG_POOL_MAX,
+        "open_connections": (len(pool._used) + len(pool._pool)) if pool is not None else 0,
+        "idle_connections": len(pool._pool) if pool is not None else 0,
+        "in_use": st["in_use"],
+        "checkouts": st["checkouts"],
+        "checkout_errors": st["checkout_errors"],
+        "healthcheck_failures": st["healthcheck_failures"],
+        "discarded": st["discarded"],
+        "avg_wait_ms": round(st["wait_ms_total"] / n, 3),
+        "max_wait_ms": round(st["wait_ms_max"], 3),
+        "avg_held_ms": round(st["held_ms_total"] / n, 3),
+        "max_held_ms": round(st["held_ms_max"], 3),
+        "by_caller": {
+            name: {
+                "checkouts": c["checkouts"],
+                "avg_wait_ms": round(c["wait_ms_total"] / (c["checkouts"] or 1), 3),
+                "avg_held_ms": round(c["held_ms_total"] / (c["checkouts"] or 1), 3),
+                "max_held_ms": round(c["held_ms_max"], 3),
+            }
+            for name, c in sorted(callers.items())
+        },
+    }
+
+
+def _close_pg_pool():
+    if _pg_pool is not None and _pg_pool_pid == os.getpid():
+        try:
+            _pg_pool.closeall()
+        except Exception:
+            pass
+
+
+atexit.register(_close_pg_pool)
+
+
+@app.route("/db-pool-stats", methods=["GET"])
+def db_pool_stats():
+    return jsonify({"status": "ok", "pool": get_pg_pool_stats()}), 200
+
+
+# ========================= SCHEMA MIGRATIONS =========================
+# Indexes and helper objects the app's queries rely on. Each migration runs in
+# its own transaction and is recorded in public."SchemaMigrations", so running
+# them again is a no-op. A session advisory lock serializes concurrent runners.
+#
+#   flask --app App db-migrate            apply pending migrations
+#   flask --app App db-migrate --status   list applied / pending / failed versions
+#   flask --app App db-migrate --dedupe-ediglobal
+#                                         count the duplicate EDIGlobal lines blocking migration 5
+#   flask --app App db-migrate --dedupe-ediglobal --yes
+#                                         delete them (keeping the latest), then migrate
+#
+# A failing migration is rolled back, recorded in public."SchemaMigrationFailures"
+# (shown by /scheduler-health) and retried on the next run; the ones after it
+# still apply, so migrations must not depend on an earlier one succeeding.
+# startup.sh runs db-migrate before gunicorn; RUN_MIGRATIONS_ON_STARTUP=1 also
+# runs them in-process on the first request (for hosts that skip startup.sh).
+
+SCHEMA_MIGRATIONS_LOCK_ID = 998  # next to SCHEDULER_LOCK_ID
+RUN_MIGRATIONS_ON_STARTUP = os.environ.get("RUN_MIGRATIONS_ON_STARTUP", "0").lower() in ("1", "true", "yes")
+
+# DeliveryDetails lookup expressions. fetch_deliverydetails_raw filters with
+# exactly these expressions so the planner can match them to the expression
+# indexes below; change both or neither.
+_SQL_DD_STATUS = 'UPPER(TRIM("Status"))'
+_SQL_DD_PRODUCT = 'UPPER(COALESCE("AVOMaterialNo", \'\'))'
+_SQL_DD_SITE = 'UPPER(TRIM("Site"))'
+_SQL_DD_IN_TRANSIT = f"{_SQL_DD_STATUS} IN ('IN TRANSIT','INTRANSIT')"
+
+# Partial indexes: in-transit rows are a small slice of DeliveryDetails, and
+# the fetcher never reads anything else.
+DELIVERYDETAILS_LOOKUP_INDEXES: Dict[str, str] = {
+    "DeliveryDetails_intransit_product_site_idx": f'''
+        CREATE INDEX IF NOT EXISTS "DeliveryDetails_intransit_product_site_idx"
+        ON public."DeliveryDetails" (({_SQL_DD_PRODUCT}), ({_SQL_DD_SITE}))
+        WHERE {_SQL_DD_IN_TRANSIT}
+    ''',
+    "DeliveryDetails_intransit_site_idx": f'''
+        CREATE INDEX IF NOT EXISTS "DeliveryDetails_intransit_site_idx"
+        ON public."DeliveryDetails" (({_SQL_DD_SITE}))
+        WHERE {_SQL_DD_IN_TRANSIT}
+    ''',
+}
+
+# Natural key of an EDI line. Duplicate detection in _bulk_insert_ediglobal
+# follows whatever unique keys EDIGlobal has, so without one a re-upload of
+# the same file would be accepted twice. It contains the parsers' own dedup key
+# (Site, ClientCode, AVOMaterialNo, DateFrom, Quantity, ForecastDate) plus
+# ClientMaterialNo, so lines a parser keeps apart (two client part numbers
+# mapped to one AVO part, two deliveries in one DateUntil) are never rejected.
+EDIGLOBAL_NATURAL_KEY = [
+    "Site", "ClientCode", "ClientMaterialNo", "AVOMaterialNo", "ForecastDate",
+    "DateFrom", "DateUntil", "Quantity", "EDIStatus",
+]
+# UNIQUE treats NULLs as distinct, so lines with a NULL key column never conflict
+_SQL_EDIGLOBAL_KEY_NOT_NULL = " AND ".join(f'"{c}" IS NOT NULL' for c in EDIGLOBAL_NATURAL_KEY)
+
+
+def _add_ediglobal_natural_key(cur):
+    cur.execute("""
+        SELECT array_agg(a.attname::text ORDER BY k.ord)
+        FROM pg_constraint c
+        CROSS JOIN LATERAL unnest(c.conkey) WITH ORDINALITY AS k(attnum, ord)
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+        WHERE c.conrelid = 'public."EDIGlobal"'::regclass AND c.conname = 'EDIGlobal_natural_key'
+        GROUP BY c.oid
+    """)
+    row = cur.fetchone()
+    if row:
+        if list(row[0]) == EDIGLOBAL_NATURAL_KEY:
+            return
+        # Narrower key left by an earlier migration 5. Any table that satisfies
+        # it also satisfies the current one, so the swap cannot fail on data.
+        cur.execute('ALTER TABLE public."EDIGlobal" DROP CONSTRAINT "EDIGlobal_natural_key"')
+    # An existing unique key on a subset of these columns already implies this one.
+    for cols in _ediglobal_unique_keys(cur):
+        if set(cols) <= set(EDIGLOBAL_NATURAL_KEY):
+            logging.warning(f"[MIGRATIONS] EDIGlobal already unique on {cols}; natural key constraint not needed")
+            return
+
+    key_sql = ", ".join(f'"{c}"' for c in EDIGLOBAL_NATURAL_KEY)
+    cur.execute(f"""
+        SELECT {key_sql}, COUNT(*)
+        FROM public."EDIGlobal"
+        WHERE {_SQL_EDIGLOBAL_KEY_NOT_NULL}
+        GROUP BY {key_sql}
+        HAVING COUNT(*) > 1
+        ORDER BY COUNT(*) DESC
+        LIMIT 5
+    """)
+    dupes = cur.fetchall()
+    if dupes:
+        cur.execute(f"""
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM public."EDIGlobal" WHERE {_SQL_EDIGLOBAL_KEY_NOT_NULL}
+                GROUP BY {key_sql} HAVING COUNT(*) > 1
+            ) d
+        """)
+        raise RuntimeError(
+            f"EDIGlobal has {cur.fetchone()[0]} duplicated {EDIGLOBAL_NATURAL_KEY} groups "
+            f"(e.g. {[tuple(d) for d in dupes]}); review them with 'flask --app App db-migrate "
+            f"--dedupe-ediglobal', then add --yes to keep one line per group"
+        )
+    cur.execute(f'ALTER TABLE public."EDIGlobal" ADD CONSTRAINT "EDIGlobal_natural_key" UNIQUE ({key_sql})')
+
+
+def dedupe_ediglobal(cur, dry_run: bool = True) -> int:
+    """
+    EDIGlobal lines that repeat EDIGLOBAL_NATURAL_KEY, apart from the
+    physically last one of each group (highest ctid, normally the latest
+    upload). Only counted unless dry_run is False, in which case they are
+    deleted. Returns the number of rows.
+    """
+    key_sql = ", ".join(f'"{c}"' for c in EDIGLOBAL_NATURAL_KEY)
+    ranked = f"""
+        SELECT ctid, ROW_NUMBER() OVER (PARTITION BY {key_sql} ORDER BY ctid DESC) AS rn
+        FROM public."EDIGlobal"
+        WHERE {_SQL_EDIGLOBAL_KEY_NOT_NULL}
+    """
+    if dry_run:
+        cur.execute(f"SELECT COUNT(*) FROM ({ranked}) d WHERE d.rn > 1")
+        return cur.fetchone()[0]
+    cur.execute(f"""
+        DELETE FROM public."EDIGlobal" e
+        USING ({ranked}) d
+        WHERE e.ctid = d.ctid AND d.rn > 1
+    """)
+    return cur.rowcount
+
+
+# (version, description, steps) - append only, never renumber. A step is a
+# SQL string or a callable taking the cursor.
+SCHEMA_MIGRATIONS: List[Tuple[int, str, List[Any]]] = [
+    (1, "DeliveryDetails in-transit lookup indexes", list(DELIVERYDETAILS_LOOKUP_INDEXES.values())),
+    (2, "EDIGlobal (ForecastDate, ClientCode) covering index", [
+        # fetch_ediglobal / fetch_ediglobal_aggregated and the compliance check
+        # can all be answered from this index alone.
+        '''
+        CREATE INDEX IF NOT EXISTS "EDIGlobal_forecast_client_idx"
+        ON public."EDIGlobal" ("ForecastDate", "ClientCode")
+        INCLUDE ("Site", "AVOMaterialNo", "DateFrom", "Quantity")
+        ''',
+    ]),
+    (3, "DeliveryDetails (Site, AVOMaterialNo) index", [
+        # insert_deliverydetails merges and /get-delivery-details filter on the raw columns.
+        '''
+        CREATE INDEX IF NOT EXISTS "DeliveryDetails_site_product_idx"
+        ON public."DeliveryDetails" ("Site", "AVOMaterialNo")
+        ''',
+    ]),
+    (4, "ProductStock / ProductDetails lookup indexes", [
+        '''
+        CREATE INDEX IF NOT EXISTS "ProductStock_product_idx"
+        ON public."ProductStock" ("ProductCode") INCLUDE ("Quantity")
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS "ProductDetails_product_idx"
+        ON public."ProductDetails" ("AVOMaterialNo") INCLUDE ("Line", "WeeklyCapacity")
+        ''',
+    ]),
+    (5, "EDIGlobal natural key unique constraint", [_add_ediglobal_natural_key]),
+    (6, "InTransitBalance table", [
+        # Effective in-transit quantity per (Site, AVOMaterialNo), maintained by
+        # insert_deliverydetails and the weekly purge; read by load_in_transit_map.
+        '''
+        CREATE TABLE IF NOT EXISTS public."InTransitBalance" (
+            "Site" text NOT NULL,
+            "AVOMaterialNo" text NOT NULL,
+            "Quantity" numeric NOT NULL DEFAULT 0,
+            "UpdatedAt" timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY ("Site", "AVOMaterialNo")
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS "InTransitBalance_lookup_idx"
+        ON public."InTransitBalance" ((UPPER("AVOMaterialNo")), (UPPER("Site")))
+        ''',
+        lambda cur: refresh_in_transit_balance(cur),
+    ]),
+    (7, "EDIWeekPresence table", [
+        # Which forecast weeks each client has sent; maintained by
+        # _bulk_insert_ediglobal, read by the compliance check.
+        '''
+        CREATE TABLE IF NOT EXISTS public."EDIWeekPresence" (
+            "ClientCode" text NOT NULL,
+            "ForecastDate" text NOT NULL,
+            "LastLoadedAt" timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY ("ClientCode", "ForecastDate")
+        )
+        ''',
+        '''
+        INSERT INTO public."EDIWeekPresence" ("ClientCode", "ForecastDate")
+        SELECT DISTINCT "ClientCode", "ForecastDate" FROM public."EDIGlobal"
+        WHERE "ClientCode" IS NOT NULL AND "ForecastDate" IS NOT NULL
+        ON CONFLICT DO NOTHING
+        ''',
+    ]),
+    (8, "ProductDetails change notifications", [
+        # Statement trigger that wakes every worker's ProductDetails cache
+        # (channel = PRODUCT_DETAILS_CHANNEL)
+        '''
+        CREATE OR REPLACE FUNCTION public.notify_productdetails_changed() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_notify('productdetails_changed', TG_OP);
+            RETURN NULL;
+        END
+        $$
+        ''',
+        'DROP TRIGGER IF EXISTS "ProductDetails_notify" ON public."ProductDetails"',
+        '''
+        CREATE TRIGGER "ProductDetails_notify"
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public."ProductDetails"
+        FOR EACH STATEMENT EXECUTE FUNCTION public.notify_productdetails_changed()
+        ''',
+    ]),
+    (9, "ProductStockTotals table", [
+        # Per-product SUM("Quantity") of ProductStock, kept current by
+        # statement triggers (transition tables, so bulk loads update each
+        # product once); read by /product-capacity-stock.
+        '''
+        CREATE TABLE IF NOT EXISTS public."ProductStockTotals" (
+            "ProductCode" text PRIMARY KEY,
+            "TotalQuantity" numeric NOT NULL DEFAULT 0,
+            "RowCount" bigint NOT NULL DEFAULT 0,
+            "UpdatedAt" timestamptz NOT NULL DEFAULT now()
+        )
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION public.sync_productstock_totals() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                TRUNCATE public."ProductStockTotals";
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO public."ProductStockTotals" AS t ("ProductCode", "TotalQuantity", "RowCount")
+                SELECT "ProductCode", -COALESCE(SUM("Quantity"), 0), -COUNT(*)
+                FROM old_rows WHERE "ProductCode" IS NOT NULL GROUP BY "ProductCode"
+                ON CONFLICT ("ProductCode") DO UPDATE SET
+                    "TotalQuantity" = t."TotalQuantity" + EXCLUDED."TotalQuantity",
+                    "RowCount" = t."RowCount" + EXCLUDED."RowCount",
+                    "UpdatedAt" = now();
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO public."ProductStockTotals" AS t ("ProductCode", "TotalQuantity", "RowCount")
+                SELECT "ProductCode", COALESCE(SUM("Quantity"), 0), COUNT(*)
+                FROM new_rows WHERE "ProductCode" IS NOT NULL GROUP BY "ProductCode"
+                ON CONFLICT ("ProductCode") DO UPDATE SET
+                    "TotalQuantity" = t."TotalQuantity" + EXCLUDED."TotalQuantity",
+                    "RowCount" = t."RowCount" + EXCLUDED."RowCount",
+                    "UpdatedAt" = now();
+            END IF;
+            DELETE FROM public."ProductStockTotals" WHERE "RowCount" <= 0;
+            RETURN NULL;
+        END
+        $$
+        ''',
+        'DROP TRIGGER IF EXISTS "ProductStock_totals_ins" ON public."ProductStock"',
+        'DROP TRIGGER IF EXISTS "ProductStock_totals_upd" ON public."ProductStock"',
+        'DROP TRIGGER IF EXISTS "ProductStock_totals_del" ON public."ProductStock"',
+        'DROP TRIGGER IF EXISTS "ProductStock_totals_trunc" ON public."ProductStock"',
+        '''
+        CREATE TRIGGER "ProductStock_totals_ins" AFTER INSERT ON public."ProductStock"
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION public.sync_productstock_totals()
+        ''',
+        '''
+        CREATE TRIGGER "ProductStock_totals_upd" AFTER UPDATE ON public."ProductStock"
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION public.sync_productstock_totals()
+        ''',
+        '''
+        CREATE TRIGGER "ProductStock_totals_del" AFTER DELETE ON public."ProductStock"
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION public.sync_productstock_totals()
+        ''',
+        '''
+        CREATE TRIGGER "ProductStock_totals_trunc" AFTER TRUNCATE ON public."ProductStock"
+        FOR EACH STATEMENT EXECUTE FUNCTION public.sync_productstock_totals()
+        ''',
+        # Backfill after the triggers exist: CREATE TRIGGER blocks ProductStock
+        # writes until this migration commits, so nothing is counted twice
+        'DELETE FROM public."ProductStockTotals"',
+        '''
+        INSERT INTO public."ProductStockTotals" ("ProductCode", "TotalQuantity", "RowCount")
+        SELECT "ProductCode", COALESCE(SUM("Quantity"), 0), COUNT(*)
+        FROM public."ProductStock" WHERE "ProductCode" IS NOT NULL
+        GROUP BY "ProductCode"
+        ''',
+    ]),
+    (10, "MappingRegistry table", [
+        # Parser part number / plant / client maps (see MAPPING REGISTRY),
+        # seeded from MAPPING_SEED; writes notify every worker to reload
+        '''
+        CREATE TABLE IF NOT EXISTS public."MappingRegistry" (
+            "Namespace" text NOT NULL,
+            "SourceKey" text NOT NULL,
+            "TargetValue" text NOT NULL,
+            "Active" boolean NOT NULL DEFAULT true,
+            "UpdatedAt" timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY ("Namespace", "SourceKey")
+        )
+        ''',
+        lambda cur: seed_mapping_registry(cur),
+        '''
+        CREATE OR REPLACE FUNCTION public.notify_mappingregistry_changed() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_notify('mappingregistry_changed', TG_OP);
+            RETURN NULL;
+        END
+        $$
+        ''',
+        'DROP TRIGGER IF EXISTS "MappingRegistry_notify" ON public."MappingRegistry"',
+        '''
+        CREATE TRIGGER "MappingRegistry_notify"
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public."MappingRegistry"
+        FOR EACH STATEMENT EXECUTE FUNCTION public.notify_mappingregistry_changed()
+        ''',
+    ]),
+    # Widens the key an earlier migration 5 created; a no-op where 5 already
+    # built the current EDIGLOBAL_NATURAL_KEY.
+    (11, "EDIGlobal natural key includes ClientMaterialNo, DateFrom and Quantity", [_add_ediglobal_natural_key]),
+]
+
+
+def _ensure_schema_migrations_table(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS public."SchemaMigrations" (
+            "Version" integer PRIMARY KEY,
+            "Description" text NOT NULL,
+            "AppliedAt" timestamptz NOT NULL DEFAULT now()
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS public."SchemaMigrationFailures" (
+            "Version" integer PRIMARY KEY,
+            "Description" text NOT NULL,
+            "Error" text NOT NULL,
+            "FailedAt" timestamptz NOT NULL DEFAULT now()
+        )
+    ''')
+
+
+def get_schema_migration_status() -> Dict[str, Any]:
+    conn = get_pg_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                _ensure_schema_migrations_table(cur)
+                cur.execute('SELECT "Version", "Description", "AppliedAt" FROM public."SchemaMigrations" ORDER BY "Version"')
+                applied = [{"version": v, "description": d, "applied_at": a.isoformat()} for v, d, a in cur.fetchall()]
+                cur.execute('SELECT "Version", "Description", "Error", "FailedAt" FROM public."SchemaMigrationFailures" ORDER BY "Version"')
+                failed = [
+                    {"version": v, "description": d, "error": err, "failed_at": a.isoformat()}
+                    for v, d, err, a in cur.fetchall()
+                ]
+    finally:
+        conn.close()
+    done = {m["version"] for m in applied}
+    pending = [{"version": v, "description": d} for v, d, _ in SCHEMA_MIGRATIONS if v not in done]
+    return {"applied": applied, "pending": pending, "failed": failed}
+
+
+def run_schema_migrations(dedupe_ediglobal_first: bool = False) -> List[int]:
+    """
+    Apply pending SCHEMA_MIGRATIONS in version order and return the versions
+    applied. Waits for the advisory lock, so a second runner simply finds
+    nothing left to do. A failing migration is recorded and skipped; once the
+    others have run, RuntimeError lists the failures.
+    """
+    applied_now: List[int] = []
+    failures: List[str] = []
+    conn = get_direct_pg_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_MIGRATIONS_LOCK_ID,))
+        conn.commit()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    _ensure_schema_migrations_table(cur)
+                    cur.execute('SELECT "Version" FROM public."SchemaMigrations"')
+                    done = {r[0] for r in cur.fetchall()}
+                    if dedupe_ediglobal_first:
+                        removed = dedupe_ediglobal(cur, dry_run=False)
+                        logging.warning(f"[MIGRATIONS] removed {removed} duplicate EDIGlobal lines")
+
+            for version, description, steps in sorted(SCHEMA_MIGRATIONS, key=lambda m: m[0]):
+                if version in done:
+                    continue
+                started = time.monotonic()
+                try:
+                    with conn:
+                        with conn.cursor() as cur:
+                            for step in steps:
+                                if callable(step):
+                                    step(cur)
+                                else:
+                                    cur.execute(step)
+                            cur.execute(
+                                'INSERT INTO public."SchemaMigrations" ("Version", "Description") VALUES (%s, %s)',
+                                (version, description),
+                            )
+                            cur.execute('DELETE FROM public."SchemaMigrationFailures" WHERE "Version" = %s', (version,))
+                except Exception as e:
+                    logging.error(f"[MIGRATIONS] {version} ({description}) failed, continuing with the next ones: {e}")
+                    failures.append(f"{version}: {e}")
+                    with conn:
+                        with conn.cursor() as cur:
+                            cur.execute('''
+                                INSERT INTO public."SchemaMigrationFailures" ("Version", "Description", "Error")
+                                VALUES (%s, %s, %s)
+                                ON CONFLICT ("Version") DO UPDATE SET
+                                    "Description" = EXCLUDED."Description",
+                                    "Error" = EXCLUDED."Error",
+                                    "FailedAt" = now()
+                            ''', (version, description, str(e)))
+                    continue
+                applied_now.append(version)
+                logging.warning(f"[MIGRATIONS] applied {version}: {description} ({time.monotonic() - started:.2f}s)")
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_MIGRATIONS_LOCK_ID,))
+            conn.commit()
+    finally:
+        conn.close()
+    if failures:
+        raise RuntimeError(f"applied {applied_now}; failed: {'; '.join(failures)}")
+    return applied_now
+
+
+def run_startup_migrations():
+    if not RUN_MIGRATIONS_ON_STARTUP:
+        return
+    try:
+        run_schema_migrations()
+    except Exception as e:
+        # Serve with the current schema rather than not at all.
+        logging.error(f"[MIGRATIONS] startup migrations failed: {e}")
+
+
+@app.cli.command("db-migrate")
+@click.option("--status", "show_status", is_flag=True, help="List applied and pending migrations without applying.")
+@click.option("--dedupe-ediglobal", "dedupe", is_flag=True,
+              help="Count duplicate EDIGlobal lines (same natural key); changes nothing without --yes.")
+@click.option("--yes", "confirm", is_flag=True,
+              help="With --dedupe-ediglobal: delete the duplicates, keeping the latest, before migrating.")
+def db_migrate_command(show_status, dedupe, confirm):
+    """Apply pending schema migrations."""
+    error = None
+    if dedupe and not confirm:
+        conn = get_pg_connection()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    extra = dedupe_ediglobal(cur)
+        finally:
+            conn.close()
+        if extra:
+            click.echo(f"{extra} duplicate EDIGlobal line(s) on {EDIGLOBAL_NATURAL_KEY}; nothing was changed.")
+            click.echo("Re-run with --dedupe-ediglobal --yes to delete them (the latest line of each group is kept).")
+        else:
+            click.echo("No duplicate EDIGlobal lines.")
+        return
+    if not show_status:
+        try:
+            applied = run_schema_migrations(dedupe_ediglobal_first=dedupe and confirm)
+            click.echo(f"Applied {len(applied)} migration(s): {applied}" if applied else "Schema is up to date.")
+        except Exception as e:
+            error = e
+    status = get_schema_migration_status()
+    failed = {m["version"]: m for m in status["failed"]}
+    for m in status["applied"]:
+        click.echo(f"  [x] {m['version']:>4}  {m['description']}  ({m['applied_at']})")
+    for m in status["pending"]:
+        if m["version"] in failed:
+            click.echo(f"  [!] {m['version']:>4}  {m['description']}  FAILED: {failed[m['version']]['error']}")
+        else:
+            click.echo(f"  [ ] {m['version']:>4}  {m['description']}")
+    if error is not None:
+        raise click.ClickException(f"migration failed: {error}")
+
+
+# ========================= CHANGE NOTIFICATIONS =========================
+# In-process copies of rarely changing tables (ProductDetails, MappingRegistry)
+# hear about writes from statement triggers that pg_notify a channel. One
+# LISTEN thread per worker process runs the callback registered for each
+# channel in CHANGE_CHANNELS, and runs all of them after every (re)connect for
+# changes made while nobody was listening. PG_LISTEN=0 leaves the TTLs alone
+# in charge.
+
+PG_LISTEN = os.environ.get("PG_LISTEN", "1") == "1"
+
+CHANGE_CHANNELS: Dict[str, Any] = {}
+
+_change_listener: Optional[threading.Thread] = None
+_change_listener_lock = threading.Lock()
+
+
+def _listen_for_changes():
+    while True:
+        conn = None
+        try:
+            conn = get_direct_pg_connection()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                for channel in CHANGE_CHANNELS:
+                    cur.execute(f"LISTEN {channel}")
+            for callback in CHANGE_CHANNELS.values():
+                callback()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                channels = {n.channel for n in conn.notifies}
+                conn.notifies.clear()
+                for channel in channels:
+                    callback = CHANGE_CHANNELS.get(channel)
+                    if callback is not None:
+                        callback()
+        except Exception as e:
+            logging.warning(f"[CHANGE LISTENER] error, reconnecting in 30s: {e}")
+            time.sleep(30)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+
+def start_change_listener():
+    """One LISTEN thread per worker process (the caches are per process)."""
+    global _change_listener
+    if not PG_LISTEN:
+        return
+    with _change_listener_lock:
+        if _change_listener is not None and _change_listener.is_alive():
+            return
+        _change_listener = threading.Thread(target=_listen_for_changes, name="pg-change-listener", daemon=True)
+        _change_listener.start()
+
+
+def change_listener_alive() -> bool:
+    return _change_listener is not None and _change_listener.is_alive()
+
+
+# ========================= MAPPING REGISTRY =========================
+# Part number, plant and client code maps used by the parsers, by namespace.
+# MAPPING_SEED is what used to be hardcoded in each parser; schema migration
+# 10 copies it into the MappingRegistry table, which is the source of truth
+# from then on (add or deactivate rows there, no release needed). Maps are
+# loaded into read-only dicts (forward and reverse) and reloaded after
+# MAPPING_REGISTRY_TTL or when MappingRegistry notifies MAPPING_REGISTRY_CHANNEL.
+# Until the table exists the seed is served.
+
+MAPPING_REGISTRY_TTL = float(os.environ.get("MAPPING_REGISTRY_TTL", "300"))
+MAPPING_REGISTRY_CHANNEL = "mappingregistry_changed"
+
+MAPPING_SEED: Dict[str, Dict[str, str]] = {
+    # Monterrey - Nidec Automotive El Paso PDF: Nidec part number -> AVOMaterialNo
+    "nidec_elpaso.part_to_avo": {
+        "O000003528": "50-0819M",
+    },
+    # Monterrey - TI CARO: PN from "Item Description" -> AVOMaterialNo
+    "ti_caro.part_to_avo": {
+        "1870678": "05-0396AM",
+        "1870681": "05-0411BM",
+        "1870682": "05-0412BM",
+        "1870683": "05-0413BM",
+        "1870685": "05-0415BM",
+        "1870686": "05-0416BM",
+        "1870680": "05-0420AM",
+        "1870687": "05-0424AM",
+        "000103335/AA": "05-0452M",
+        "000116611/AA": "05-0604",
+        "116611": "05-0604",
+    },
+    # Valeo CSV
+    "valeo.plant_to_client": {
+        "SK01": "C00250",
+        "W113": "C00303",
+        "FUEN": "C00125",
+        "BN01": "C00132",
+    },
+    "valeo.material_to_avo": {
+        "473801": "V473801",
+        "469917D": "V469.917D",
+        "471346D": "V471.346D",
+        "471553D": "V471.553D",
+        "W000023134D": "VW000023134",
+    },
+    # Inteva CSV
+    "inteva.site_to_client": {
+        "ESS2": "C00410",
+        "GAD1": "C00241",
+    },
+    # Nidec CSV: old part number (current AVOMaterialNo) -> new part number
+    "nidec.avo_remap": {
+        "VA18116507G": "V504.519SP",
+        "VA14116701A": "V504.243SP",
+        "VA14116698P": "V504.510SP",
+        "VA13116595N": "V502.730SP",
+        "V504.519": "V504.519PL",
+        "V504.243": "V504.243PL",
+        "V504.510": "V504.510PL",
+    },
+    "nidec.plant_to_client": {
+        "ZI01": "C00126",
+        "SPER": "C00050",
+        "BI01": "C00113",
+    },
+    # Germany site: Valeo DE CSV (material without leading zeros)
+    "valeo_de.plant_to_client": {
+        "CZ22": "100442",
+        "FUEN": "100541",
+        "KJ01": "100506",
+        "CA02": "100573",
+        "ET01": "100523",
+    },
+    "valeo_de.material_to_avo": {
+        "190313": "1023093",
+        "191663": "1023645",
+        "187144": "1026188",
+        "194470": "1026258",
+        "202066": "1026540",
+        "214188": "1026629",
+        "471550": "1026325",
+        "478537": "1026365",
+        "470737": "1026384",
+    },
+    # Germany site: Nidec DE CSV
+    "nidec_de.plant_to_client": {
+        "ZI01": "100420",
+    },
+    "nidec_de.material_to_avo": {
+        "471-695-99-99": "1022201",
+        "503-660-99-99": "1027700",
+    },
+    # Germany site: Bosch PDF ("Standortcode (Kunde)"); the material map is
+    # looked up both ways (forward: AVO -> client material)
+    "bosch.site_to_client": {
+        "2570": "100409",
+        "5060": "100410",
+        "908A": "100327",
+        "526W": "100296",
+    },
+    "bosch.avo_to_client_material": {
+        "1027599": "1582875601",
+        "1022031": "1582884102",
+        "1026644": "1394320515",
+        "1021731": "1394320230",
+        "1394320230": "1021731",
+        "1394320228": "1026021",
+    },
+    # Company shown by /detect-client-info and used in suggested file names
+    "client.company": {
+        "C00409": "Valeo Nevers",
+        "C00072": "Valeo Brasil",
+        "C00285": "Pierburg",
+        "C00260": "Nidec Inde",
+        "C00113": "Nidec DCK",
+        "C00126": "Nidec Pologne",
+        "C00050": "Nidec ESP",
+        "C00241": "Inteva GAD",
+        "C00410": "Inteva Esson",
+        "C00250": "Valeo Poland",
+        "C00303": "Valeo Mexique",
+        "C00125": "Valeo Madrid",
+        "C00132": "Valeo Betigheim",
+    },
+    # Client name in EDI compliance results and escalation mails
+    "client.name": {
+        "C00126": "Nidec Pologne",
+        "C00050": "Nidec ESP",
+        "C00113": "Nidec DCK",
+        "C00285": "Pierburg",
+        "C00125": "Valeo Madrid",
+        "C00303": "Valeo Mexique",
+        "C00410": "Inteva Esson",
+        "C00250": "Valeo Pologne",
+        "C00072": "Valeo Brasil",
+        "C00409": "Valeo Nevers",
+    },
+}
+
+_EMPTY_MAPPING: Mapping[str, str] = MappingProxyType({})
+
+
+def seed_mapping_registry(cur, seed: Optional[Dict[str, Dict[str, str]]] = None) -> int:
+    """Insert seed entries that are not in MappingRegistry yet (never overwrites)."""
+    rows = [(ns, k, v) for ns, entries in (seed or MAPPING_SEED).items() for k, v in entries.items()]
+    execute_values(cur, '''
+        INSERT INTO public."MappingRegistry" ("Namespace", "SourceKey", "TargetValue")
+        VALUES %s
+        ON CONFLICT ("Namespace", "SourceKey") DO NOTHING
+    ''', rows)
+    return len(rows)
+
+
+class MappingRegistry:
+    """Namespaced key -> value maps as read-only dicts, forward and reverse."""
+
+    def __init__(self, seed: Dict[str, Dict[str, str]], ttl_seconds: float):
+        self._seed = seed
+        self.ttl = ttl_seconds
+        self._maps: Optional[Tuple[Dict[str, Mapping[str, str]], Dict[str, Mapping[str, str]]]] = None
+        self._expires = 0.0
+        self._generation = 0   # bumped by invalidate(); see _mark_fresh
+        self._lock = threading.Lock()
+        self.source: Optional[str] = None
+        self.loads = 0
+        self.loaded_at: Optional[str] = None
+
+    def _fetch(self) -> Optional[Dict[str, Dict[str, str]]]:
+        # Unpooled: parse pool children resolve mappings too, and should not
+        # open a connection pool each for one query per TTL
+        conn = get_direct_pg_connection()
+        try:
+            with conn.cursor() as cur:
+                try:
+                    cur.execute('''
+                        SELECT "Namespace", "SourceKey", "TargetValue"
+                        FROM public."MappingRegistry"
+                        WHERE "Active"
+                        ORDER BY "Namespace", "SourceKey"
+                    ''')
+                except psycopg2.errors.UndefinedTable:
+                    return None
+                entries: Dict[str, Dict[str, str]] = defaultdict(dict)
+                for ns, key, value in cur.fetchall():
+                    entries[ns][key] = value
+                return entries
+        finally:
+            conn.close()
+
+    def _ensure_loaded(self):
+        if self._maps is not None and time.monotonic() < self._expires:
+            return
+        with self._lock:
+            if self._maps is not None and time.monotonic() < self._expires:
+                return
+            ttl = self.ttl
+            generation = self._generation
+            try:
+                entries, source = self._fetch(), "table"
+                if entries is None:
+                    entries, source = self._seed, "seed"
+            except Exception as e:
+                logging.warning(f"[MAPPINGS] load failed: {e}")
+                ttl = min(self.ttl, 30.0)
+                if self._maps is not None:
+                    self._mark_fresh(generation, ttl)
+                    return
+                entries, source = self._seed, "seed"
+            forward = {ns: MappingProxyType(dict(m)) for ns, m in entries.items()}
+            # Reverse maps: on duplicate values the last key in SourceKey order wins
+            reverse = {ns: MappingProxyType({v: k for k, v in m.items()}) for ns, m in entries.items()}
+            self._maps = (forward, reverse)
+            self._mark_fresh(generation, ttl)
+            self.source = source
+            self.loads += 1
+            self.loaded_at = datetime.now().isoformat(timespec="seconds")
+
+    def forward(self, namespace: str) -> Mapping[str, str]:
+        self._ensure_loaded()
+        return self._maps[0].get(namespace, _EMPTY_MAPPING)
+
+    def reverse(self, namespace: str) -> Mapping[str, str]:
+        self._ensure_loaded()
+        return self._maps[1].get(namespace, _EMPTY_MAPPING)
+
+    def _mark_fresh(self, generation: int, ttl: float):
+        # A load whose SELECT may predate an invalidate() that arrived while it
+        # ran must not extend the maps' life. invalidate() bumps the generation
+        # before clearing _expires, so set first, check after.
+        self._expires = time.monotonic() + ttl
+        if self._generation != generation:
+            self._expires = 0.0
+
+    def invalidate(self):
+        self._generation += 1
+        self._expires = 0.0
+
+    def reload(self):
+        self.invalidate()
+        self._ensure_loaded()
+
+    def stats(self) -> Dict[str, Any]:
+        maps = self._maps
+        return {
+            "source": self.source,
+            "namespaces": {ns: len(m) for ns, m in maps[0].items()} if maps else {},
+            "ttl_seconds": self.ttl,
+            "loads": self.loads,
+            "loaded_at": self.loaded_at,
+            "listening": change_listener_alive(),
+        }
+
+
+MAPPING_REGISTRY = MappingRegistry(MAPPING_SEED, MAPPING_REGISTRY_TTL)
+
+
+def _mapping_registry_changed():
+    MAPPING_REGISTRY.invalidate()
+    # Parsed records depend on the maps: PARSE_CACHE keys carry this version,
+    # and parse pool children reload their own copy when it moves.
+    bump_data_version("MappingRegistry")
+
+
+CHANGE_CHANNELS[MAPPING_REGISTRY_CHANNEL] = _mapping_registry_changed
+
+
+@app.route("/mapping-registry", methods=["GET"])
+def mapping_registry_route():
+    """Loaded namespaces and sizes; ?namespace=x returns that map (and its reverse with &reverse=true)."""
+    namespace = request.args.get("namespace")
+    if not namespace:
+        return jsonify({"status": "ok", **MAPPING_REGISTRY.stats()}), 200
+    reverse = str(request.args.get("reverse", "")).strip().lower() in ("1", "true", "yes")
+    mapping = MAPPING_REGISTRY.reverse(namespace) if reverse else MAPPING_REGISTRY.forward(namespace)
+    return jsonify({"status": "ok", "namespace": namespace, "reverse": reverse, "count": len(mapping), "data": dict(mapping)}), 200
+
+
+@app.route("/mapping-registry/reload", methods=["POST"])
+def mapping_registry_reload():
+    """Reload this worker (its parse cache and parse pool children included) now and notify the others."""
+    try:
+        conn = get_pg_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_notify(%s, 'reload')", (MAPPING_REGISTRY_CHANNEL,))
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        logging.warning(f"[MAPPINGS] reload notify failed: {e}")
+    _mapping_registry_changed()
+    MAPPING_REGISTRY.reload()
+    return jsonify({"status": "ok", **MAPPING_REGISTRY.stats()}), 200
+
+
+
 def decode_base64_csv(b64_string):
     try:
         csv_bytes = base64.b64decode(b64_string)
@@ -519,21 +1638,10 @@ def to_forecast_week(raw):
 #-----------------------------------------------------------------------------------------------
 
 def process_valeo_rows(rows, header):
-    plant_to_client = {
-        "SK01": "C00250",
-        "W113": "C00303",
-        "FUEN": "C00125",
-        "BN01": "C00132",
-    }
+    plant_to_client = MAPPING_REGISTRY.forward("valeo.plant_to_client")
 
     # Client material → AVOMaterialNo mapping (Valeo-specific)
-    material_to_avo = {
-        "473801": "V473801",
-        "469917D": "V469.917D",      # as you specified
-        "471346D": "V471.346D",
-        "471553D": "V471.553D",
-        "W000023134D": "VW000023134",
-    }
+    material_to_avo = MAPPING_REGISTRY.forward("valeo.material_to_avo")
 
     processed = []
     idx = {col: header.index(col) for col in header}
@@ -653,10 +1761,7 @@ def parse_date_flexible(date_str):
 
 
 def process_inteva_rows(rows, header):
-    site_to_client = {
-        "ESS2": "C00410",
-        "GAD1": "C00241",
-    }
+    site_to_client = MAPPING_REGISTRY.forward("inteva.site_to_client")
     processed = []
     header = [h.strip() for h in header if h.strip() != ""]
     idx = {col: header.index(col) for col in header}
@@ -771,17 +1876,7 @@ def _build_index(header):
 
 def process_nidec_rows(rows, header):
     # New mapping: Old Part N° (current AVOMaterialNo) -> New Part N°
-    NEW_AVO_MAPPING = {
-        # Nidec ESP
-        "VA18116507G": "V504.519SP",
-        "VA14116701A": "V504.243SP",
-        "VA14116698P": "V504.510SP",
-        "VA13116595N": "V502.730SP",
-        # Nidec POL
-        "V504.519": "V504.519PL",
-        "V504.243": "V504.243PL",
-        "V504.510": "V504.510PL",  # corrected (was "504.510 PL")
-    }
+    NEW_AVO_MAPPING = MAPPING_REGISTRY.forward("nidec.avo_remap")
 
     def apply_new_mapping(avo_code: str) -> str:
         mapped = NEW_AVO_MAPPING.get(avo_code.strip(), avo_code)
@@ -789,11 +1884,7 @@ def process_nidec_rows(rows, header):
             logging.warning(f"DEBUG: AVOMaterialNo mapped '{avo_code}' -> '{mapped}'")
         return mapped
 
-    plant_to_client = {
-        "ZI01": "C00126",
-        "SPER": "C00050",
-        "BI01": "C00113",
-    }
+    plant_to_client = MAPPING_REGISTRY.forward("nidec.plant_to_client")
 
     if not rows:
         logging.warning("DEBUG: rows empty or None -> returning []")
@@ -923,46 +2014,182 @@ def parse_euro_number(val):
 
 
 
+EDIGLOBAL_COLUMNS = [
+    "Site", "ClientCode", "ClientMaterialNo", "AVOMaterialNo", "DateFrom",
+    "DateUntil", "Quantity", "ForecastDate", "LastDeliveryDate",
+    "LastDeliveredQuantity", "CumulatedQuantity", "EDIStatus", "ProductName", "LastDeliveryNo",
+]
+_EDI_DUPLICATE_ERROR = "Duplicate primary key: record already exists."
+
+
+def _ediglobal_unique_keys(cur) -> List[List[str]]:
+    """
+    Column lists of the plain (non-partial, non-expression) unique indexes on
+    EDIGlobal whose columns are all supplied by the ingestion. Keys involving
+    generated columns (serial ids) can never collide and are skipped.
+    """
+    cur.execute("""
+        SELECT array_agg(a.attname::text ORDER BY k.ord)
+        FROM pg_index i
+        CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+        WHERE i.indrelid = 'public."EDIGlobal"'::regclass
+          AND i.indisunique AND i.indpred IS NULL AND i.indexprs IS NULL
+          AND k.ord <= i.indnkeyatts
+        GROUP BY i.indexrelid
+    """)
+    wanted = set(EDIGLOBAL_COLUMNS)
+    return [list(cols) for (cols,) in cur.fetchall() if cols and set(cols) <= wanted]
+
+
+def _insert_ediglobal_rows_individually(cur, records) -> Tuple[int, List[Tuple[int, str]]]:
+    """Row-by-row insert, each row in its own savepoint so a bad row never undoes good ones."""
+    cols_sql = ", ".join(f'"{c}"' for c in EDIGLOBAL_COLUMNS)
+    vals_sql = ", ".join(f"%({c})s" for c in EDIGLOBAL_COLUMNS)
+    sql = f'INSERT INTO public."EDIGlobal" ({cols_sql}) VALUES ({vals_sql})'
+    inserted = 0
+    row_errors: List[Tuple[int, str]] = []
+    for i, record in enumerate(records):
+        cur.execute("SAVEPOINT edi_row")
+        try:
+            cur.execute(sql, record)
+            cur.execute("RELEASE SAVEPOINT edi_row")
+            inserted += 1
+        except psycopg2.errors.UniqueViolation:
+            cur.execute("ROLLBACK TO SAVEPOINT edi_row")
+            row_errors.append((i, _EDI_DUPLICATE_ERROR))
+        except psycopg2.DataError as de:
+            cur.execute("ROLLBACK TO SAVEPOINT edi_row")
+            row_errors.append((i, f"Data error: {str(de)}"))
+        except psycopg2.Error as pe:
+            cur.execute("ROLLBACK TO SAVEPOINT edi_row")
+            row_errors.append((i, f"Database error: {str(pe)}"))
+    return inserted, row_errors
+
+
+def _bulk_insert_ediglobal(cur, records) -> Tuple[int, List[Tuple[int, str]]]:
+    """
+    Insert EDIGlobal records (see _bulk_insert_ediglobal_rows) and record the
+    (ClientCode, ForecastDate) weeks they deliver in EDIWeekPresence.
+    """
+    inserted, row_errors = _bulk_insert_ediglobal_rows(cur, records)
+    if inserted:
+        failed = {i for i, _ in row_errors}
+        record_edi_week_presence(cur, [r for i, r in enumerate(records) if i not in failed])
+    return inserted, row_errors
+
+
+def record_edi_week_presence(cur, records):
+    """Upsert the (ClientCode, ForecastDate) pairs of freshly inserted EDIGlobal rows."""
+    pairs = sorted({
+        (str(r.get("ClientCode")), str(r.get("ForecastDate")))
+        for r in records
+        if r.get("ClientCode") is not None and r.get("ForecastDate") is not None
+    })
+    if not pairs or not _table_exists(cur, "EDIWeekPresence"):
+        return
+    cur.execute('''
+        INSERT INTO public."EDIWeekPresence" ("ClientCode", "ForecastDate")
+        SELECT * FROM unnest(%s::text[], %s::text[])
+        ON CONFLICT ("ClientCode", "ForecastDate") DO UPDATE SET "LastLoadedAt" = now()
+    ''', ([c for c, _ in pairs], [w for _, w in pairs]))
+
+
+def _bulk_insert_ediglobal_rows(cur, records) -> Tuple[int, List[Tuple[int, str]]]:
+    """
+    Set-based EDIGlobal insert inside the caller's transaction.
+
+    Rows are staged with execute_values into a temp table typed like EDIGlobal,
+    duplicates (against the table and earlier rows of the same batch) are
+    resolved in one query, and the remaining rows go in with a single
+    INSERT ... SELECT. If anything in the bulk path raises (bad value, NOT NULL,
+    a concurrent insert of the same key, ...) we roll back to a savepoint and
+    replay row by row so every record still gets its exact error.
+
+    Returns (inserted_count, [(record_index, error_message), ...]).
+    """
+    if not records:
+        return 0, []
+
+    rows = [(i, *[record[c] for c in EDIGLOBAL_COLUMNS]) for i, record in enumerate(records)]
+    cols_sql = ", ".join(f'"{c}"' for c in EDIGLOBAL_COLUMNS)
+
+    cur.execute("SAVEPOINT edi_bulk")
+    try:
+        cur.execute(f"""
+            CREATE TEMP TABLE _edi_stage ON COMMIT DROP AS
+            SELECT 0 AS _row_no, {cols_sql} FROM public."EDIGlobal" WITH NO DATA
+        """)
+        execute_values(
+            cur,
+            f"INSERT INTO _edi_stage (_row_no, {cols_sql}) VALUES %s",
+            rows,
+            page_size=len(rows),
+        )
+
+        keys = _ediglobal_unique_keys(cur)
+        accepted: List[int] = []
+        row_errors: List[Tuple[int, str]] = []
+        if keys:
+            key_cols = sorted({c for key in keys for c in key})
+            exists_sql = ", ".join(
+                "EXISTS (SELECT 1 FROM public.\"EDIGlobal\" e WHERE "
+                + " AND ".join(f's."{c}" = e."{c}"' for c in key)
+                + ")"
+                for key in keys
+            )
+            cur.execute(f"""
+                SELECT s._row_no, {exists_sql}, {", ".join(f's."{c}"' for c in key_cols)}
+                FROM _edi_stage s
+                ORDER BY s._row_no
+            """)
+            n_keys = len(keys)
+            pos = {c: n_keys + 1 + j for j, c in enumerate(key_cols)}
+            seen = [set() for _ in keys]
+            for r in cur.fetchall():
+                key_vals = [tuple(r[pos[c]] for c in key) for key in keys]
+                duplicate = any(r[1:1 + n_keys]) or any(
+                    None not in kv and kv in seen[k] for k, kv in enumerate(key_vals)
+                )
+                if duplicate:
+                    row_errors.append((r[0], _EDI_DUPLICATE_ERROR))
+                    continue
+                accepted.append(r[0])
+                for k, kv in enumerate(key_vals):
+                    seen[k].add(kv)
+        else:
+            accepted = [r[0] for r in rows]
+
+        if accepted:
+            cur.execute(f"""
+                INSERT INTO public."EDIGlobal" ({cols_sql})
+                SELECT {cols_sql} FROM _edi_stage
+                WHERE _row_no = ANY(%s)
+                ORDER BY _row_no
+            """, (accepted,))
+        cur.execute("DROP TABLE _edi_stage")
+        cur.execute("RELEASE SAVEPOINT edi_bulk")
+        return len(accepted), row_errors
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT edi_bulk")
+        logging.warning(f"[EDIGlobal] bulk insert fell back to row-by-row: {e}")
+        return _insert_ediglobal_rows_individually(cur, records)
+
+
 def save_to_postgres_with_conflict_reporting(extracted_records):
+    set_job_stage("saving")
     conn = None
-    success_count = 0
-    error_details = []
     try:
         conn = get_pg_connection()
         with conn.cursor() as cur:
-            for record in extracted_records:
-                try:
-                    cur.execute("""
-                        INSERT INTO public."EDIGlobal" (
-                            "Site", "ClientCode", "ClientMaterialNo", "AVOMaterialNo", "DateFrom",
-                            "DateUntil", "Quantity", "ForecastDate", "LastDeliveryDate",
-                            "LastDeliveredQuantity", "CumulatedQuantity", "EDIStatus", "ProductName","LastDeliveryNo"
-                        ) VALUES (
-                            %(Site)s, %(ClientCode)s, %(ClientMaterialNo)s, %(AVOMaterialNo)s, %(DateFrom)s,
-                            %(DateUntil)s, %(Quantity)s, %(ForecastDate)s, %(LastDeliveryDate)s,
-                            %(LastDeliveredQuantity)s, %(CumulatedQuantity)s, %(EDIStatus)s, %(ProductName)s, %(LastDeliveryNo)s
-                        )
-                    """, record)
-                    success_count += 1
-                except psycopg2.errors.UniqueViolation:
-                    conn.rollback()
-                    error_details.append({
-                        "record": record,
-                        "error": "Duplicate primary key: record already exists."
-                    })
-                except psycopg2.DataError as de:
-                    conn.rollback()
-                    error_details.append({
-                        "record": record,
-                        "error": f"Data error: {str(de)}"
-                    })
-                except psycopg2.Error as pe:
-                    conn.rollback()
-                    error_details.append({
-                        "record": record,
-                        "error": f"Database error: {str(pe)}"
-                    })
-            conn.commit()
+            success_count, row_errors = _bulk_insert_ediglobal(cur, extracted_records)
+        conn.commit()
+        if success_count:
+            bump_data_version("EDIGlobal")
+        error_details = [
+            {"record": extracted_records[i], "error": msg}
+            for i, msg in sorted(row_errors, key=lambda e: e[0])
+        ]
         return success_count, error_details
     except Exception as e:
         logging.error(f"Database error: {e}")
@@ -1020,6 +2247,14 @@ def read_clean_csv(csv_text):
 def decode_and_clean_csv(b64_string):
     try:
         csv_bytes = base64.b64decode(b64_string)
+    except Exception as e:
+        logging.error(f"Base64 or decode error: {e}")
+        raise
+    return clean_csv_bytes(csv_bytes)
+
+
+def clean_csv_bytes(csv_bytes):
+    try:
         try:
             csv_text = csv_bytes.decode('utf-8')
         except UnicodeDecodeError:
@@ -1045,10 +2280,570 @@ def decode_and_clean_csv(b64_string):
 
 
 
+# ========================= PDF DOCUMENT CACHE =========================
+# One upload used to be opened and text-extracted several times (scan check,
+# FACTURE check, format detection, vendor parser), by three different engines.
+# PdfDocument opens each engine at most once and caches per-page text/tables,
+# so every detector and parser can share the same object for the request.
+
+class PdfDocument:
+    """
+    Lazily extracted view of one PDF. Text is cached per engine because the
+    vendor regexes are tuned to a specific engine's output:
+      - fitz (PyMuPDF): is_scanned_pdf, Valeo Campinas/Nevers
+      - pdfplumber    : FACTURE check, detect_pdf_format, Pierburg/Nidec, delivery invoices
+      - PyPDF2        : parse_pdf, Bosch, Nidec DE, Monterrey El Paso
+    """
+
+    def __init__(self, file_bytes: bytes, name: str = ""):
+        self.file_bytes = file_bytes
+        self.name = name
+        self._fitz = None
+        self._plumber = None
+        self._fitz_text: Dict[int, str] = {}
+        self._plumber_text: Dict[int, str] = {}
+        self._plumber_tables: Dict[Tuple[int, str, str], Any] = {}
+        self._pypdf_text: Optional[str] = None
+        self.extractions = 0
+        self.avoided = 0
+
+    # ---------- engines ----------
+    @property
+    def fitz_doc(self):
+        if self._fitz is None:
+            self._fitz = fitz.open(stream=self.file_bytes, filetype="pdf")
+        return self._fitz
+
+    @property
+    def plumber(self):
+        if self._plumber is None:
+            self._plumber = pdfplumber.open(io.BytesIO(self.file_bytes))
+        return self._plumber
+
+    def _hit(self):
+        self.avoided += 1
+
+    # ---------- fitz ----------
+    def fitz_page_count(self) -> int:
+        return self.fitz_doc.page_count
+
+    def fitz_page_text(self, i: int) -> str:
+        if i in self._fitz_text:
+            self._hit()
+        else:
+            self._fitz_text[i] = self.fitz_doc[i].get_text()
+            self.extractions += 1
+        return self._fitz_text[i]
+
+    def fitz_pages_text(self) -> List[str]:
+        return [self.fitz_page_text(i) for i in range(self.fitz_page_count())]
+
+    # ---------- pdfplumber ----------
+    def page_count(self) -> int:
+        return len(self.plumber.pages)
+
+    def page_text(self, i: int) -> str:
+        if i in self._plumber_text:
+            self._hit()
+        else:
+            self._plumber_text[i] = self.plumber.pages[i].extract_text() or ""
+            self.extractions += 1
+        return self._plumber_text[i]
+
+    def all_text(self) -> str:
+        return "\n".join(self.page_text(i) for i in range(self.page_count()))
+
+    def _tables(self, i: int, kind: str, settings: dict):
+        key = (i, kind, repr(sorted(settings.items())))
+        if key in self._plumber_tables:
+            self._hit()
+        else:
+            page = self.plumber.pages[i]
+            if kind == "table":
+                self._plumber_tables[key] = page.extract_table(settings)
+            else:
+                self._plumber_tables[key] = page.extract_tables(settings)
+            self.extractions += 1
+        return self._plumber_tables[key]
+
+    def page_table(self, i: int, settings: dict):
+        return self._tables(i, "table", settings)
+
+    def page_tables(self, i: int, settings: dict):
+        return self._tables(i, "tables", settings)
+
+    @property
+    def metadata(self) -> dict:
+        return self.plumber.metadata
+
+    # ---------- PyPDF2 ----------
+    def pypdf_text(self) -> str:
+        if self._pypdf_text is None:
+            self._pypdf_text = parse_pdf(io.BytesIO(self.file_bytes))
+            self.extractions += 1
+        else:
+            self._hit()
+        return self._pypdf_text
+
+    # ---------- lifecycle ----------
+    def summary(self) -> str:
+        return f"extractions={self.extractions} avoided={self.avoided}"
+
+    def close(self):
+        if self._fitz is not None:
+            self._fitz.close()
+            self._fitz = None
+        if self._plumber is not None:
+            self._plumber.close()
+            self._plumber = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextmanager
+def pdf_document(pdf, name: str = ""):
+    """
+    Accept raw bytes or an existing PdfDocument. A shared document is lent as-is
+    (its owner closes it); for raw bytes a private one is opened and closed here.
+    """
+    if isinstance(pdf, PdfDocument):
+        yield pdf
+    else:
+        with PdfDocument(pdf, name) as doc:
+            yield doc
+
+
+def open_request_pdf(file_bytes: bytes, name: str = "") -> PdfDocument:
+    """
+    PdfDocument bound to the current request: closed (and its extraction
+    stats logged) in teardown_request. Outside a request it is just returned.
+    """
+    doc = PdfDocument(file_bytes, name)
+    if has_request_context():
+        request_g.setdefault("_pdf_documents", []).append(doc)
+    return doc
+
+
+@app.teardown_request
+def _close_request_pdfs(exc=None):
+    for doc in request_g.pop("_pdf_documents", []):
+        logging.info(f"[PDF] {doc.name or 'document'}: {doc.summary()}")
+        try:
+            doc.close()
+        except Exception:
+            pass
+
+
+# ========================= RESULT CACHES =========================
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL, bounded by entry count and
+    optionally by total size (callers pass the size of what they store).
+    """
+
+    def __init__(self, name: str, ttl_seconds: float, max_entries: int, max_bytes: Optional[int] = None):
+        self.name = name
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[Any, Tuple[float, int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _CACHES[name] = self
+
+    def _drop(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def put(self, key, value, size: int = 0):
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while self._data and (
+                len(self._data) > self.max_entries
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+                "evictions": self.evictions,
+            }
+
+
+_CACHES: Dict[str, TTLCache] = {}
+
+# Parsed upload records keyed by (scope, sha256 of the file bytes, mapping
+# registry version), so the /detect-client-info call and the following
+# /process-TunisiaSite call with the same file run the vendor parser only once,
+# and a re-upload after a mapping change is parsed again.
+PARSE_CACHE = TTLCache(
+    "parsed_uploads",
+    ttl_seconds=float(os.environ.get("PARSE_CACHE_TTL", "900")),
+    max_entries=int(os.environ.get("PARSE_CACHE_MAX_ENTRIES", "32")),
+)
+
+
+def parse_cache_key(scope: str, file_bytes: bytes) -> Tuple[str, str, Tuple[int, ...]]:
+    return scope, hashlib.sha256(file_bytes).hexdigest(), data_versions("MappingRegistry")
+
+
+# Per-table data versions, bumped by this process's writers after they commit.
+# Cached results embed the versions they were computed from, so a write makes
+# them unreachable at once; the TTL bounds staleness from writes made outside
+# this process (other workers, manual SQL).
+_data_versions: Dict[str, int] = defaultdict(int)
+_data_versions_lock = threading.Lock()
+
+
+def bump_data_version(*tables: str):
+    with _data_versions_lock:
+        for table in tables:
+            _data_versions[table] += 1
+
+
+def data_versions(*tables: str) -> Tuple[int, ...]:
+    with _data_versions_lock:
+        return tuple(_data_versions[t] for t in tables)
+
+
+# Serialized /edi-analysis responses keyed by the normalized request + data versions
+EDI_ANALYSIS_CACHE = TTLCache(
+    "edi_analysis",
+    ttl_seconds=float(os.environ.get("EDI_ANALYSIS_CACHE_TTL", "300")),
+    max_entries=int(os.environ.get("EDI_ANALYSIS_CACHE_MAX_ENTRIES", "64")),
+    max_bytes=int(os.environ.get("EDI_ANALYSIS_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+)
+
+
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    return jsonify({"status": "ok", "caches": {name: c.stats() for name, c in _CACHES.items()}}), 200
+
+
+# ========================= PARSE PROCESS POOL =========================
+# pdfplumber table extraction and the vendor text scans are pure Python and
+# hold the GIL for seconds on large documents, so concurrent uploads to one
+# worker used to serialize behind each other. Parsing runs in a small process
+# pool instead; tasks take bytes and return plain records (picklable), and the
+# children are recycled after PARSE_POOL_MAX_TASKS_PER_CHILD tasks to contain
+# pdfplumber's memory growth. PARSE_POOL_WORKERS=0 parses inline.
+#
+# The timeout counts run time only: each child arms SIGALRM when it picks a
+# task up, so a slow parse fails on its own and the pool carries on. A task
+# stuck where the alarm cannot reach it (inside C code) is killed by the parent
+# PARSE_POOL_KILL_GRACE later; that breaks the executor, and the other tasks
+# it was running are resubmitted to a fresh pool rather than failed.
+
+PARSE_POOL_WORKERS = int(os.environ.get("PARSE_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+PARSE_POOL_MAX_TASKS_PER_CHILD = int(os.environ.get("PARSE_POOL_MAX_TASKS_PER_CHILD", "50"))
+PARSE_POOL_TIMEOUT = float(os.environ.get("PARSE_POOL_TIMEOUT", "120"))  # seconds of run time per task
+PARSE_POOL_KILL_GRACE = float(os.environ.get("PARSE_POOL_KILL_GRACE", "30"))
+
+_parse_pool = None
+_parse_pool_pid = None
+_parse_pool_lock = threading.Lock()
+_parse_pool_started = None                    # SimpleQueue of (task_id, pid, started) from the children
+_parse_task_starts: Dict[str, Optional[Tuple[int, float]]] = {}   # tasks someone waits on
+_in_parse_worker = False
+_parse_worker_started = None                  # the same queue, child side
+_parse_worker_mappings = None                 # parent's MappingRegistry version this child loaded for
+
+
+class ParseTimeoutError(Exception):
+    pass
+
+
+class _ParseDeadline(BaseException):
+    # BaseException so a parser's own "except Exception" cannot swallow the alarm
+    pass
+
+
+def _init_parse_worker(started=None):
+    # tasks running in a pool child parse inline instead of opening a nested pool
+    global _in_parse_worker, _parse_worker_started
+    _in_parse_worker = True
+    _parse_worker_started = started
+
+
+def _parse_deadline(signum, frame):
+    raise _ParseDeadline()
+
+
+def _run_parse_task(task_id, timeout, mappings, fn, *args):
+    """Pool child side of _submit_parse_task: report the start, then run fn under the alarm."""
+    global _parse_worker_mappings
+    if mappings != _parse_worker_mappings:
+        # the parent's registry changed since this child loaded its copy
+        if _parse_worker_mappings is not None:
+            MAPPING_REGISTRY.invalidate()
+        _parse_worker_mappings = mappings
+    if _parse_worker_started is not None:
+        _parse_worker_started.put((task_id, os.getpid(), time.time()))
+    alarm = bool(timeout) and hasattr(signal, "setitimer")
+    if alarm:
+        previous = signal.signal(signal.SIGALRM, _parse_deadline)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return fn(*args)
+    except _ParseDeadline:
+        raise ParseTimeoutError(f"parsing timed out after {timeout:g}s") from None
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+def _get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    Lazily created process pool (per worker pid). Uses the spawn start method:
+    forking a threaded web worker (DB pool, scheduler, job threads) is unsafe,
+    and max_tasks_per_child requires it anyway.
+    Returns None when PARSE_POOL_WORKERS is 0, in which case parsing runs inline.
+    """
+    global _parse_pool, _parse_pool_pid, _parse_pool_started
+    if PARSE_POOL_WORKERS <= 0 or _in_parse_worker:
+        return None
+    pid = os.getpid()
+    if _parse_pool is None or _parse_pool_pid != pid:
+        with _parse_pool_lock:
+            if _parse_pool is None or _parse_pool_pid != pid:
+                ctx = multiprocessing.get_context("spawn")
+                _parse_pool_started = ctx.SimpleQueue()
+                _parse_pool = ProcessPoolExecutor(
+                    max_workers=PARSE_POOL_WORKERS,
+                    mp_context=ctx,
+                    max_tasks_per_child=PARSE_POOL_MAX_TASKS_PER_CHILD or None,
+                    initializer=_init_parse_worker,
+                    initargs=(_parse_pool_started,),
+                )
+                _parse_pool_pid = pid
+    return _parse_pool
+
+
+def _reset_parse_pool(pool=None, terminate: bool = False):
+    """
+    Drop the current pool, or only if it is still `pool` (every waiter on a
+    broken pool calls this). terminate=True also kills its children (exit).
+    """
+    global _parse_pool, _parse_pool_started
+    with _parse_pool_lock:
+        if pool is not None and pool is not _parse_pool:
+            return
+        pool, _parse_pool = _parse_pool, None
+        _parse_pool_started = None
+    if pool is None or _parse_pool_pid != os.getpid():
+        return
+    processes = list((getattr(pool, "_processes", None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=terminate)
+    if terminate:
+        for proc in processes:
+            try:
+                proc.terminate()
+            except Exception:
+                pass
+
+
+atexit.register(_reset_parse_pool, terminate=True)
+
+
+def _submit_parse_task(pool, fn, args, timeout) -> Tuple[Any, str]:
+    task_id = uuid.uuid4().hex
+    with _parse_pool_lock:
+        _parse_task_starts[task_id] = None
+    try:
+        mappings = data_versions("MappingRegistry")
+        return pool.submit(_run_parse_task, task_id, timeout, mappings, fn, *args), task_id
+    except Exception:
+        with _parse_pool_lock:
+            _parse_task_starts.pop(task_id, None)
+        raise
+
+
+def _wait_parse_task(pool, future, task_id, timeout):
+    """
+    Result of a _submit_parse_task task. The child enforces the timeout; the
+    parent only kills the child that has run this task for longer than
+    timeout + PARSE_POOL_KILL_GRACE (stuck where the alarm cannot fire).
+    """
+    try:
+        while True:
+            try:
+                return future.result(timeout=1.0)
+            except FuturesTimeoutError:
+                pass
+            with _parse_pool_lock:
+                started = _parse_pool_started
+                while started is not None and not started.empty():
+                    tid, pid, at = started.get()
+                    if tid in _parse_task_starts:
+                        _parse_task_starts[tid] = (pid, at)
+            start = _parse_task_starts.get(task_id)
+            if timeout and start and time.time() - start[1] > timeout + PARSE_POOL_KILL_GRACE:
+                logging.warning(f"[PARSE POOL] task ignored its {timeout:g}s alarm, killing child {start[0]}")
+                try:
+                    os.kill(start[0], getattr(signal, "SIGKILL", signal.SIGTERM))
+                except OSError:
+                    pass
+                _reset_parse_pool(pool)
+                raise ParseTimeoutError(f"parsing timed out after {timeout:g}s")
+    finally:
+        with _parse_pool_lock:
+            _parse_task_starts.pop(task_id, None)
+
+
+def run_in_parse_pool(fn, *args, timeout: Optional[float] = None):
+    """
+    Run fn(*args) in the parse pool and wait for it (inline when the pool is off).
+    PdfDocument arguments are sent as their bytes. A task running longer than
+    the timeout raises ParseTimeoutError; one lost to a pool that broke
+    under it (another child killed or crashed) is run again on a fresh pool.
+    """
+    pool = _get_parse_pool()
+    if pool is None:
+        return fn(*args)
+
+    args = tuple(a.file_bytes if isinstance(a, PdfDocument) else a for a in args)
+    timeout = PARSE_POOL_TIMEOUT if timeout is None else timeout
+    for attempt in (1, 2):
+        try:
+            return _wait_parse_task(pool, *_submit_parse_task(pool, fn, args, timeout), timeout)
+        except (BrokenProcessPool, CancelledError):
+            _reset_parse_pool(pool)
+            if attempt == 2:
+                raise
+            logging.warning(f"[PARSE POOL] {fn.__name__} lost to a broken pool, retrying on a fresh one")
+            pool = _get_parse_pool()
+
+
+def _parse_tunisia_pdf_task(pdf, file_name):
+    """Pool task: FACTURE/format detection + vendor parse. Errors come back as strings."""
+    with pdf_document(pdf, file_name) as pdf_doc:
+        if _contains_facture(pdf_doc):
+            kind = "facture"
+            parser = lambda: process_delivery_invoice_pdf(pdf_doc, default_site="Tunisia")
+        else:
+            kind = detect_pdf_format(pdf_doc)
+            parser = {
+                "valeo_campinas": lambda: process_valeo_campinas_pdf(pdf_doc, file_name),
+                "valeo_nevers": lambda: process_valeo_nevers_pdf(pdf_doc, file_name),
+                "pierburg": lambda: process_pierburg_pdf(pdf_doc, file_name),
+                "nidec": lambda: process_nidec_pdf(pdf_doc, file_name),
+            }.get(kind)
+
+        if parser is None:
+            return kind, [], None
+        try:
+            return kind, parser(), None
+        except Exception as e:
+            return kind, [], str(e)
+
+
+TUNISIA_PDF_COMPANIES = {
+    "facture": "Delivery Invoice (FACTURE)",
+    "valeo_campinas": "Valeo VWS Campinas",
+    "valeo_nevers": "Valeo CIE Nevers",
+    "pierburg": "Pierburg",
+    "nidec": "Nidec",
+}
+
+
+def _parse_tunisia_pdf(pdf_doc, file_name):
+    """
+    FACTURE check, format detection and vendor parse for a (non-scanned) Tunisia PDF.
+    Returns (kind, records, parse_error): kind is "facture", a detect_pdf_format()
+    value, or None when unrecognized. Parser exceptions are returned rather than
+    raised because the detect and process routes report them differently.
+    The parse runs in the parse pool; successful results are cached by content hash.
+    """
+    key = parse_cache_key("tunisia-pdf", pdf_doc.file_bytes)
+    cached = PARSE_CACHE.get(key)
+    if cached is not None:
+        kind, records = cached
+        return kind, [dict(r) for r in records], None
+
+    kind, records, parse_error = run_in_parse_pool(_parse_tunisia_pdf_task, pdf_doc, file_name)
+    if parse_error is not None:
+        return kind, [], Exception(parse_error)
+
+    PARSE_CACHE.put(key, (kind, tuple(dict(r) for r in records)))
+    return kind, records, None
+
+
+TUNISIA_CSV_PARSERS = {
+    "Valeo": process_valeo_rows,
+    "Inteva": process_inteva_rows,
+    "Nidec": process_nidec_rows,
+}
+
+
+def _read_semicolon_csv_rows(file_bytes):
+    """Decode/clean a CSV upload and split it into trimmed rows (trailing empty cells dropped)."""
+    csv_text = clean_csv_bytes(file_bytes)
+    rows = list(csv.reader(io.StringIO(csv_text), delimiter=';'))
+    if not rows:
+        return rows
+
+    header = [col.strip() for col in rows[0]]
+    rows_cleaned = []
+    for row in rows:
+        cleaned_row = [cell.strip() for cell in row]
+        while cleaned_row and cleaned_row[-1] == '':
+            cleaned_row.pop()
+        rows_cleaned.append(cleaned_row)
+    rows_cleaned[0] = header
+    return rows_cleaned
+
+
 def detect_pdf_format(file_bytes):
-    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
+    with pdf_document(file_bytes) as pdf:
         # Combine all text for easy searching
-        all_text = '\n'.join(page.extract_text() or '' for page in pdf.pages)
+        all_text = pdf.all_text()
         lines = all_text.splitlines()
         
         # 1. Nidec: First 10 lines, look for "NIDEC"
@@ -1098,8 +2893,8 @@ def extract_value_after_label(lines, label, default=None):
 
 
 def process_pierburg_pdf(file_bytes, file_name):
-    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-        all_text = "\n".join(page.extract_text() or '' for page in pdf.pages)
+    with pdf_document(file_bytes, file_name) as pdf:
+        all_text = pdf.all_text()
         lines = all_text.splitlines()
 
         # Material (Customer): 501312040 Material description (Customer):
@@ -1205,8 +3000,8 @@ def pars_euro_number(val):
 
 def process_nidec_pdf(file_bytes, file_name):
     results = []
-    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-        all_text = "\n".join(page.extract_text() or '' for page in pdf.pages)
+    with pdf_document(file_bytes, file_name) as pdf:
+        all_text = pdf.all_text()
         lines = all_text.splitlines()
         logging.warning(f"[NIDEC] Number of extracted lines: {len(lines)}")
         for i, line in enumerate(lines):
@@ -1353,8 +3148,8 @@ def parse_any_date(raw_date):
 
 def process_valeo_campinas_pdf(pdf_bytes, file_name):
     data = []
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    all_pages_text = [page.get_text() for page in doc]
+    with pdf_document(pdf_bytes, file_name) as pdf:
+        all_pages_text = pdf.fitz_pages_text()
     full_text = "\n".join(all_pages_text)
     logging.info(f"[VALEO] Extracted {len(full_text)} characters of text.")
 
@@ -1501,16 +3296,154 @@ def to_week(date_str: str) -> str:
             logging.warning(f"[to_a_week] Failed to parse DD.MM.YYYY: {date_str} – {e}")
             return date_str
 
-    # Unknown format, return as-is
-    logging.warning(f"[to_a_week] Unknown format: {date_str}")
-    return date_str
+    # Unknown format, return as-is
+    logging.warning(f"[to_a_week] Unknown format: {date_str}")
+    return date_str
+
+
+def _parse_valeo_nevers_section(agreement_no, section_pages, forecast_date):
+    """Rows of one SCHEDULING AGREEMENT section (its pages' fitz text); independent of the other sections."""
+    data = []
+    current_material = ""
+    avo_material = f"V{current_material}"
+    current_product = None
+
+    last_delivery_date = ""
+    last_delivery_qty = None
+    last_delivery_doc = ""
+
+    # Try to extract product name and material from the block (first page in section)
+    m_prod = re.search(
+        r"Material\s+([A-Z0-9]+)\s+([^\n]+?)\s+Unit\s+of\s+Measure", section_pages[0])
+    if m_prod:
+        current_material = m_prod.group(1)
+        current_product = m_prod.group(2).strip()
+        avo_material = f"V{current_material}"
+        logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Material: {current_material}, Product: {current_product}")
+
+    # LAST DELIVERY block (all pages in section)
+    last_delivery_search = re.search(
+        r"LAST DELIVERY(.*?)SCHEDULING AGREEMENT", section_pages[0], re.DOTALL)
+    if last_delivery_search:
+        block_text = last_delivery_search.group(1)
+        logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] LAST DELIVERY block raw text:\n{block_text}")
+        lines = block_text.splitlines()
+        logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Last delivery block found with {len(lines)} lines.")
+        for i in range(len(lines)-2):
+            date_line = lines[i].strip()
+            qty_line = lines[i+1].strip()
+            doc_line = lines[i+2].strip()
+
+            # Look for a date line
+            m_date = re.match(r"(\d{2}\.\d{2}\.\d{4})$", date_line)
+            m_qty = re.match(r"^([\d\.,]+)$", qty_line)
+            m_doc = re.match(r"^(\d+)$", doc_line)
+            logging.debug(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Check triple: {date_line!r}, {qty_line!r}, {doc_line!r}")
+
+            if m_date and m_qty and m_doc:
+                last_delivery_date = m_date.group(1)
+                try:
+                    last_delivery_qty = int(float(m_qty.group(1).replace('.', '').replace(',', '.')))
+                except Exception as e:
+                    logging.warning(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Error parsing last delivery qty: {e}")
+                    last_delivery_qty = None
+                last_delivery_doc = m_doc.group(1)
+                logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] LAST DELIVERY triple matched: {last_delivery_date}, {last_delivery_qty}, {last_delivery_doc}")
+                break
+    else:
+        logging.warning(f"[VALEO NEVERS][AGREEMENT {agreement_no}] LAST DELIVERY block not found in section page.")
+    if not last_delivery_search:
+        logging.error(f"[VALEO NEVERS][AGREEMENT {agreement_no}] No LAST DELIVERY block found! Here is section page 0 text:\n{section_pages[0]}")
+
+    # Block for planning (between UoM and CUMM.RECEIVED)
+    planning_block = re.search(r"Unit of Measure[^\n]*\n(?P<planning>.+?)CUMM\. RECEIVED", "\n".join(section_pages), re.DOTALL)
+    if not planning_block:
+        logging.warning(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Planning block not found.")
+        return data
+
+    planning_lines = [l.strip() for l in planning_block.group('planning').splitlines() if l.strip()]
+    logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Found {len(planning_lines)} planning lines.")
+
+    edi_map = {
+        "PAST DUE": "Past Due",
+        "FIRM AUTHORIZED SHIPPMENTS": "Firm",
+        "PLANNED SHIPPMENTS": "Firm",
+        "FORECAST": "Forecast",
+    }
+
+    last_status = None
+    for idx_row, line in enumerate(planning_lines):
+        logging.debug(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Line: {line}")
+
+        # Status lines
+        status_match = re.match(r"^(?:\*?)(PAST DUE|FIRM AUTHORIZED SHIPPMENTS|PLANNED SHIPPMENTS|FORECAST)$", line)
+        # Data lines: date/qty/cumulated or just qty/cumulated (for PAST DUE, maybe no date)
+        data_match = re.match(
+            r"^([0-9]{2}\.[0-9]{2}\.[0-9]{4}D|[0-9]{2}\.[0-9]{4}W|[0-9]{2}\.[0-9]{2}\.[0-9]{4})?\s*([\d\.,]+)\s+([\d\.,]+)$", 
+            line
+        )
+
+        if status_match:
+            last_status = status_match.group(1)
+            logging.debug(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Found status: {last_status}")
+            continue
+        elif data_match and last_status:
+            # Assign last status as EDI status
+            date_from = data_match.group(1) or ""
+            qty = data_match.group(2)
+            cum = data_match.group(3)
+            edi_status = last_status
+            last_status = None  # Reset until next status line
+
+            edi_map = {
+                "PAST DUE": "Past Due",
+                "FIRM AUTHORIZED SHIPPMENTS": "Firm",
+                "PLANNED SHIPPMENTS": "Firm",
+                "FORECAST": "Forecast",
+            }
+            edi_status = edi_map.get(edi_status, edi_status)
+            date_from = date_from.replace("D", "").replace("W", "") if date_from else ""
+
+            try:
+                quantity = int(float(qty.replace(".", "").replace(",", ".")))
+            except Exception as e:
+                logging.warning(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Error parsing quantity: {qty} - {e}")
+                quantity = 0
+            try:
+                cumulated = int(float(cum.replace(".", "").replace(",", ".")))
+            except Exception as e:
+                logging.warning(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Error parsing cumulated: {cum} - {e}")
+                cumulated = 0
+
+            row = {
+                "Site": "Tunisia",
+                "ClientCode": "C00409",
+                "SchedulingAgreement": agreement_no,
+                "ForecastDate": forecast_date,
+                "ClientMaterialNo": current_material,
+                "AVOMaterialNo": avo_material,
+                "ProductName": current_product,
+                "EDIStatus": edi_status,
+                "DateFrom": to_week(date_from),
+                "DateUntil": date_from,
+                "Quantity": quantity,
+                "CumulatedQuantity": cumulated,
+                "LastDeliveryDate": to_week(last_delivery_date),
+                "LastDeliveredQuantity": last_delivery_qty,
+                "LastDeliveryNo": last_delivery_doc,
+            }
+            data.append(row)
+            logging.info(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Row: {row}")
+        else:
+            logging.warning(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Line did not match any expected pattern: {line}")
+    return data
 
 
 def process_valeo_nevers_pdf(pdf_bytes, file_name):
 
     data = []
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    all_pages_text = [page.get_text() for page in doc]
+    with pdf_document(pdf_bytes, file_name) as pdf:
+        all_pages_text = pdf.fitz_pages_text()
     full_text = "\n".join(all_pages_text)
     logging.info(f"[VALEO NEVERS] Extracted {len(full_text)} characters of text.")
 
@@ -1519,160 +3452,38 @@ def process_valeo_nevers_pdf(pdf_bytes, file_name):
     raw_forecast_date = m_date.group(1) if m_date else ""
     forecast_date = to_adjusted_iso_week(raw_forecast_date) if raw_forecast_date else ""
     logging.info(f"[VALEO NEVERS] ForecastDate raw: {raw_forecast_date}, week format: {forecast_date}")
-    # Extract agreements
-    sched_split = list(re.finditer(r"SCHEDULING AGREEMENT \d+", full_text))
-    agreement_numbers = [re.search(r"(\d+)", m.group()).group(1) for m in sched_split]
+    # Agreement boundaries in one pass over the pages: a section starts on the first
+    # page mentioning "SCHEDULING AGREEMENT <no>" (substring match, so every digit
+    # prefix of a number found on a page counts as mentioned there).
+    agreement_numbers = []
+    first_page = {}
+    for page_no, page_text in enumerate(all_pages_text):
+        for m in re.finditer(r"SCHEDULING AGREEMENT (\d+)", page_text):
+            number = m.group(1)
+            agreement_numbers.append(number)
+            for j in range(1, len(number) + 1):
+                first_page.setdefault(number[:j], page_no)
+
+    # Continuation pages repeat the header: one section per agreement
+    agreement_numbers = list(dict.fromkeys(agreement_numbers))
     logging.info(f"[VALEO NEVERS] Found {len(agreement_numbers)} scheduling agreement sections: {agreement_numbers}")
 
-    # Start pages for each agreement
-    agreement_start_pages = []
-    for agreement_no in agreement_numbers:
-        for i, page_text in enumerate(all_pages_text):
-            if f"SCHEDULING AGREEMENT {agreement_no}" in page_text:
-                agreement_start_pages.append(i)
-                break
-    agreement_start_pages.append(len(all_pages_text))
+    agreement_start_pages = [first_page[no] for no in agreement_numbers] + [len(all_pages_text)]
     logging.info(f"[VALEO NEVERS] Agreement start pages: {agreement_start_pages}")
 
     for idx, agreement_no in enumerate(agreement_numbers):
         section_start_page = agreement_start_pages[idx]
         section_end_page = agreement_start_pages[idx + 1]
-        section_pages = all_pages_text[section_start_page:section_end_page]
-        logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Processing section from page {section_start_page} to {section_end_page}")
-
-        current_material = ""
-        avo_material = f"V{current_material}"
-        current_product = None
-
-        last_delivery_date = ""
-        last_delivery_qty = None
-        last_delivery_doc = ""
-
-        # Try to extract product name and material from the block (first page in section)
-        m_prod = re.search(
-            r"Material\s+([A-Z0-9]+)\s+([^\n]+?)\s+Unit\s+of\s+Measure", section_pages[0])
-        if m_prod:
-            current_material = m_prod.group(1)
-            current_product = m_prod.group(2).strip()
-            avo_material = f"V{current_material}"
-            logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Material: {current_material}, Product: {current_product}")
-
-        # LAST DELIVERY block (all pages in section)
-        last_delivery_search = re.search(
-            r"LAST DELIVERY(.*?)SCHEDULING AGREEMENT", section_pages[0], re.DOTALL)
-        if last_delivery_search:
-            block_text = last_delivery_search.group(1)
-            logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] LAST DELIVERY block raw text:\n{block_text}")
-            lines = block_text.splitlines()
-            logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Last delivery block found with {len(lines)} lines.")
-            for i in range(len(lines)-2):
-                date_line = lines[i].strip()
-                qty_line = lines[i+1].strip()
-                doc_line = lines[i+2].strip()
-
-                # Look for a date line
-                m_date = re.match(r"(\d{2}\.\d{2}\.\d{4})$", date_line)
-                m_qty = re.match(r"^([\d\.,]+)$", qty_line)
-                m_doc = re.match(r"^(\d+)$", doc_line)
-                logging.debug(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Check triple: {date_line!r}, {qty_line!r}, {doc_line!r}")
-
-                if m_date and m_qty and m_doc:
-                    last_delivery_date = m_date.group(1)
-                    try:
-                        last_delivery_qty = int(float(m_qty.group(1).replace('.', '').replace(',', '.')))
-                    except Exception as e:
-                        logging.warning(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Error parsing last delivery qty: {e}")
-                        last_delivery_qty = None
-                    last_delivery_doc = m_doc.group(1)
-                    logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] LAST DELIVERY triple matched: {last_delivery_date}, {last_delivery_qty}, {last_delivery_doc}")
-                    break
-        else:
-            logging.warning(f"[VALEO NEVERS][AGREEMENT {agreement_no}] LAST DELIVERY block not found in section page.")
-        if not last_delivery_search:
-            logging.error(f"[VALEO NEVERS][AGREEMENT {agreement_no}] No LAST DELIVERY block found! Here is section page 0 text:\n{section_pages[0]}")
-
-        # Block for planning (between UoM and CUMM.RECEIVED)
-        planning_block = re.search(r"Unit of Measure[^\n]*\n(?P<planning>.+?)CUMM\. RECEIVED", "\n".join(section_pages), re.DOTALL)
-        if not planning_block:
-            logging.warning(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Planning block not found.")
-            continue
-
-        planning_lines = [l.strip() for l in planning_block.group('planning').splitlines() if l.strip()]
-        logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Found {len(planning_lines)} planning lines.")
-
-        edi_map = {
-            "PAST DUE": "Past Due",
-            "FIRM AUTHORIZED SHIPPMENTS": "Firm",
-            "PLANNED SHIPPMENTS": "Firm",
-            "FORECAST": "Forecast",
-        }
-
-        last_status = None
-        for idx_row, line in enumerate(planning_lines):
-            logging.debug(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Line: {line}")
-
-            # Status lines
-            status_match = re.match(r"^(?:\*?)(PAST DUE|FIRM AUTHORIZED SHIPPMENTS|PLANNED SHIPPMENTS|FORECAST)$", line)
-            # Data lines: date/qty/cumulated or just qty/cumulated (for PAST DUE, maybe no date)
-            data_match = re.match(
-                r"^([0-9]{2}\.[0-9]{2}\.[0-9]{4}D|[0-9]{2}\.[0-9]{4}W|[0-9]{2}\.[0-9]{2}\.[0-9]{4})?\s*([\d\.,]+)\s+([\d\.,]+)$", 
-                line
+        if section_end_page <= section_start_page:
+            logging.warning(
+                f"[VALEO NEVERS][AGREEMENT {agreement_no}] Shares its start page {section_start_page} "
+                f"with the next agreement, section skipped."
             )
-
-            if status_match:
-                last_status = status_match.group(1)
-                logging.debug(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Found status: {last_status}")
-                continue
-            elif data_match and last_status:
-                # Assign last status as EDI status
-                date_from = data_match.group(1) or ""
-                qty = data_match.group(2)
-                cum = data_match.group(3)
-                edi_status = last_status
-                last_status = None  # Reset until next status line
-
-                edi_map = {
-                    "PAST DUE": "Past Due",
-                    "FIRM AUTHORIZED SHIPPMENTS": "Firm",
-                    "PLANNED SHIPPMENTS": "Firm",
-                    "FORECAST": "Forecast",
-                }
-                edi_status = edi_map.get(edi_status, edi_status)
-                date_from = date_from.replace("D", "").replace("W", "") if date_from else ""
-
-                try:
-                    quantity = int(float(qty.replace(".", "").replace(",", ".")))
-                except Exception as e:
-                    logging.warning(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Error parsing quantity: {qty} - {e}")
-                    quantity = 0
-                try:
-                    cumulated = int(float(cum.replace(".", "").replace(",", ".")))
-                except Exception as e:
-                    logging.warning(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Error parsing cumulated: {cum} - {e}")
-                    cumulated = 0
-
-                row = {
-                    "Site": "Tunisia",
-                    "ClientCode": "C00409",
-                    "SchedulingAgreement": agreement_no,
-                    "ForecastDate": forecast_date,
-                    "ClientMaterialNo": current_material,
-                    "AVOMaterialNo": avo_material,
-                    "ProductName": current_product,
-                    "EDIStatus": edi_status,
-                    "DateFrom": to_week(date_from),
-                    "DateUntil": date_from,
-                    "Quantity": quantity,
-                    "CumulatedQuantity": cumulated,
-                    "LastDeliveryDate": to_week(last_delivery_date),
-                    "LastDeliveredQuantity": last_delivery_qty,
-                    "LastDeliveryNo": last_delivery_doc,
-                }
-                data.append(row)
-                logging.info(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Row: {row}")
-            else:
-                logging.warning(f"[VALEO NEVERS][{agreement_no}][ROW {idx_row}] Line did not match any expected pattern: {line}")
-
+            continue
+        logging.info(f"[VALEO NEVERS][AGREEMENT {agreement_no}] Processing section from page {section_start_page} to {section_end_page}")
+        data.extend(_parse_valeo_nevers_section(
+            agreement_no, all_pages_text[section_start_page:section_end_page], forecast_date
+        ))
 
     # Deduplicate rows by primary key if you need, similar to Campinas
     unique_rows = {}
@@ -1717,19 +3528,19 @@ def _normalize_avo_ref(s: object, following_hint: object = None) -> str:
 def _looks_like_pdf(b: bytes) -> bool:
     return b.lstrip()[:5] == b"%PDF-"
 
-def _contains_facture(pdf_bytes: bytes, pages_to_check: int = 2) -> bool:
+def _contains_facture(pdf_bytes, pages_to_check: int = 2) -> bool:
     try:
-        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-            for i in range(min(pages_to_check, len(pdf.pages))):
-                txt = pdf.pages[i].extract_text() or ""
+        with pdf_document(pdf_bytes) as pdf:
+            for i in range(min(pages_to_check, pdf.page_count())):
+                txt = pdf.page_text(i)
                 if re.search(r"\bfacture\b", txt, re.IGNORECASE):
                     return True
     except Exception:
         pass
     return False
 
-def parse_delivery_pdf_bytes(pdf_bytes: bytes, *, default_site: str = "Tunisia") -> pd.DataFrame:
-    import io, re, pdfplumber, pandas as pd
+def parse_delivery_pdf_bytes(pdf_bytes, *, default_site: str = "Tunisia") -> pd.DataFrame:
+    import re, pandas as pd
     from dateutil.parser import parse as dtparse
 
     delivery_no = None
@@ -1763,10 +3574,10 @@ def parse_delivery_pdf_bytes(pdf_bytes: bytes, *, default_site: str = "Tunisia")
 )
 
 
-    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+    with pdf_document(pdf_bytes) as pdf:
         # -------- header (page 1, with fallbacks) --------
-        if pdf.pages:
-            p0_text = pdf.pages[0].extract_text() or ""
+        if pdf.page_count():
+            p0_text = pdf.page_text(0)
             m_no = header_no_pat.search(p0_text)
             if m_no:
                 delivery_no = m_no.group(1).strip()
@@ -1803,15 +3614,15 @@ def parse_delivery_pdf_bytes(pdf_bytes: bytes, *, default_site: str = "Tunisia")
         material_pat = re.compile(r"^[A-Za-z0-9][A-Za-z0-9.\-_/]*[A-Za-z0-9]$")
 
         found = 0
-        for page in pdf.pages:
+        for page_no in range(pdf.page_count()):
             tables = []
             try:
-                t = page.extract_table(tbl_settings)
+                t = pdf.page_table(page_no, tbl_settings)
                 if t: tables.append(t)
             except Exception:
                 pass
             try:
-                ts = page.extract_tables(tbl_settings) or []
+                ts = pdf.page_tables(page_no, tbl_settings) or []
                 tables.extend(ts)
             except Exception:
                 pass
@@ -1864,8 +3675,8 @@ def parse_delivery_pdf_bytes(pdf_bytes: bytes, *, default_site: str = "Tunisia")
 
         # -------- attempt 2: text-line regex fallback --------
         if found == 0:
-            for page in pdf.pages:
-                text = page.extract_text() or ""
+            for page_no in range(pdf.page_count()):
+                text = pdf.page_text(page_no)
                 for line in text.splitlines():
                     if total_row_pat.search(line):
                         continue
@@ -1923,7 +3734,7 @@ def _norm_status(s):
         return "Delivered"
     return s  # fallback unchanged
 
-def process_delivery_invoice_pdf(pdf_bytes: bytes, *, default_site: str = "Tunisia") -> list[dict]:
+def process_delivery_invoice_pdf(pdf_bytes, *, default_site: str = "Tunisia") -> list[dict]:
     """
     Parse a delivery invoice PDF (recognized via 'FACTURE') and return
     records ready for DB: Site, AVOMaterialNo, DeliveryNo, Quantity, Date, Status.
@@ -1956,94 +3767,189 @@ def process_delivery_invoice_pdf(pdf_bytes: bytes, *, default_site: str = "Tunis
 
 
 
+def _fold_clamped(acc, delta):
+    """
+    The per-row merge always stores max(0, current + delta) (non-positive totals
+    are deleted). A sequence of such steps composes to max(floor, start + delta_sum),
+    so a whole group collapses to [floor, delta_sum] without knowing the start value.
+    """
+    if acc[0] is None:
+        acc[0] = 0
+    else:
+        acc[0] = max(0, acc[0] + delta)
+    acc[1] += delta
+
+
+def refresh_in_transit_balance(cur, keys: Optional[List[Tuple[str, str]]] = None):
+    """
+    Recompute InTransitBalance rows from DeliveryDetails: the whole table, or
+    only the given (Site, AVOMaterialNo) keys. The balance is the SUM of the
+    rows fetch_deliverydetails_raw treats as in transit, keyed by trimmed Site /
+    AVOMaterialNo exactly like build_in_transit_map; reads clamp it at 0.
+    """
+    select_sql = f'''
+        SELECT TRIM("Site"), TRIM("AVOMaterialNo"), COALESCE(SUM("Quantity"), 0), now()
+        FROM public."DeliveryDetails"
+        WHERE {_SQL_DD_IN_TRANSIT}
+          AND TRIM(COALESCE("Site", '')) <> '' AND TRIM(COALESCE("AVOMaterialNo", '')) <> ''
+          {{extra}}
+        GROUP BY 1, 2
+    '''
+    insert_sql = 'INSERT INTO public."InTransitBalance" ("Site", "AVOMaterialNo", "Quantity", "UpdatedAt") '
+
+    if keys is None:
+        cur.execute('DELETE FROM public."InTransitBalance"')
+        cur.execute(insert_sql + select_sql.format(extra=""))
+        return
+
+    keys = sorted({(s.strip(), p.strip()) for s, p in keys})
+    if not keys:
+        return
+    sites = [s for s, _ in keys]
+    prods = [p for _, p in keys]
+    cur.execute('''
+        DELETE FROM public."InTransitBalance" b
+        USING unnest(%s::text[], %s::text[]) AS k(site, prod)
+        WHERE b."Site" = k.site AND b."AVOMaterialNo" = k.prod
+    ''', (sites, prods))
+    # Filter on the indexed expressions (a superset of the keys); every group
+    # it yields is recomputed in full, so upserting the extras is harmless.
+    extra = f"AND {_SQL_DD_PRODUCT} = ANY(%s) AND {_SQL_DD_SITE} = ANY(%s)"
+    cur.execute(
+        insert_sql + select_sql.format(extra=extra) + '''
+        ON CONFLICT ("Site", "AVOMaterialNo")
+        DO UPDATE SET "Quantity" = EXCLUDED."Quantity", "UpdatedAt" = EXCLUDED."UpdatedAt"
+        ''',
+        (sorted({p.upper() for p in prods}), sorted({s.upper() for s in sites})),
+    )
+
+
+def _table_exists(cur, table: str) -> bool:
+    """For tables created by SCHEMA_MIGRATIONS, which may not have run yet."""
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f'public."{table}"',))
+    return cur.fetchone()[0]
+
+
 def insert_deliverydetails(df):
     """
     psycopg2 version — uses get_pg_connection() and merges/sums duplicates.
     Expected df columns: Site, AVOMaterialNo, DeliveryNo, Date, Status, Quantity
+
+    Set-based: the batch is folded in memory (InTransit balance per Site/AVOMaterialNo,
+    running totals per full key for the other statuses) and applied with one
+    delete+insert per group type, which leaves DeliveryDetails in the same state
+    as applying the rows one by one.
     """
-    import psycopg2
+    set_job_stage("saving")
+    intransit: Dict[Tuple[str, str], list] = {}
+    keyed: Dict[Tuple[str, str, str, str, str], list] = {}
+
+    for row in df.to_dict("records"):
+        site        = _safestr(row.get("Site"))[:20]
+        avo_mat     = _safestr(row.get("AVOMaterialNo"))[:30]
+        delivery_no = _safestr(row.get("DeliveryNo"))[:30]
+        date        = _safestr(row.get("Date"))[:20]
+        qty         = _clean_qty(row.get("Quantity"))
+        status      = _norm_status(row.get("Status"))
+
+        if not (site and avo_mat and delivery_no and date and status):
+            continue
+
+        if status in ("Dispatched", "Delivered", "InTransit"):
+            acc = intransit.setdefault((site, avo_mat), [None, 0, None, None])
+            _fold_clamped(acc, -qty if status == "Delivered" else qty)
+            # the surviving InTransit row carries the last movement's delivery/date
+            acc[2], acc[3] = delivery_no, date
+
+        if status != "InTransit":
+            acc = keyed.setdefault((site, avo_mat, delivery_no, date, status), [None, 0])
+            _fold_clamped(acc, qty)
+
+    if not intransit and not keyed:
+        return
 
     conn = get_pg_connection()
     try:
         with conn:
             with conn.cursor() as cur:
-
-                def _sum_key(site, avo_mat, delivery_no, date, status):
-                    cur.execute("""
-                        SELECT COALESCE(SUM("Quantity"), 0)
-                        FROM public."DeliveryDetails"
-                        WHERE "Site"=%s AND "AVOMaterialNo"=%s AND "DeliveryNo"=%s AND "Date"=%s AND "Status"=%s
-                    """, (site, avo_mat, delivery_no, date, status))
-                    return int(cur.fetchone()[0] or 0)
-
-                def _delete_key(site, avo_mat, delivery_no, date, status):
+                if intransit:
                     cur.execute("""
-                        DELETE FROM public."DeliveryDetails"
-                        WHERE "Site"=%s AND "AVOMaterialNo"=%s AND "DeliveryNo"=%s AND "Date"=%s AND "Status"=%s
-                    """, (site, avo_mat, delivery_no, date, status))
-
-                def _insert_row(site, avo_mat, delivery_no, date, status, qty):
+                        CREATE TEMP TABLE _dd_intransit ON COMMIT DROP AS
+                        SELECT "Site","AVOMaterialNo","DeliveryNo","Date",
+                               0::bigint AS floor_qty, 0::bigint AS delta_qty
+                        FROM public."DeliveryDetails" WITH NO DATA
+                    """)
+                    execute_values(
+                        cur,
+                        'INSERT INTO _dd_intransit ("Site","AVOMaterialNo","DeliveryNo","Date",floor_qty,delta_qty) VALUES %s',
+                        [(s, a, dn, dt, f, d) for (s, a), (f, d, dn, dt) in intransit.items()],
+                        page_size=len(intransit),
+                    )
                     cur.execute("""
+                        WITH cur AS (
+                            SELECT d."Site", d."AVOMaterialNo", TRUNC(SUM(d."Quantity")::numeric)::bigint AS qty
+                            FROM public."DeliveryDetails" d
+                            JOIN _dd_intransit t ON d."Site" = t."Site" AND d."AVOMaterialNo" = t."AVOMaterialNo"
+                            WHERE d."Status" = 'InTransit'
+                            GROUP BY d."Site", d."AVOMaterialNo"
+                        ), del AS (
+                            DELETE FROM public."DeliveryDetails" d
+                            USING _dd_intransit t
+                            WHERE d."Site" = t."Site" AND d."AVOMaterialNo" = t."AVOMaterialNo"
+                              AND d."Status" = 'InTransit'
+                        ), new AS (
+                            SELECT t."Site", t."AVOMaterialNo", t."DeliveryNo", t."Date",
+                                   GREATEST(t.floor_qty, COALESCE(c.qty, 0) + t.delta_qty) AS qty
+                            FROM _dd_intransit t
+                            LEFT JOIN cur c ON c."Site" = t."Site" AND c."AVOMaterialNo" = t."AVOMaterialNo"
+                        )
                         INSERT INTO public."DeliveryDetails"
                             ("Site","AVOMaterialNo","DeliveryNo","Quantity","Date","Status")
-                        VALUES (%s,%s,%s,%s,%s,%s)
-                    """, (site, avo_mat, delivery_no, int(qty), date, status))
+                        SELECT "Site","AVOMaterialNo","DeliveryNo",qty,"Date",'InTransit'
+                        FROM new WHERE qty > 0
+                    """)
+                    if _table_exists(cur, "InTransitBalance"):
+                        refresh_in_transit_balance(cur, list(intransit))
 
-                def _merge_sum_key(site, avo_mat, delivery_no, date, status, delta_qty):
-                    existing = _sum_key(site, avo_mat, delivery_no, date, status)
-                    total = existing + int(delta_qty)
-                    _delete_key(site, avo_mat, delivery_no, date, status)
-                    if total > 0:
-                        _insert_row(site, avo_mat, delivery_no, date, status, total)
-
-                def _sum_intransit(site, avo_mat):
+                if keyed:
                     cur.execute("""
-                        SELECT COALESCE(SUM("Quantity"), 0)
-                        FROM public."DeliveryDetails"
-                        WHERE "Site"=%s AND "AVOMaterialNo"=%s AND "Status"='InTransit'
-                    """, (site, avo_mat))
-                    return int(cur.fetchone()[0] or 0)
-
-                def _delete_all_intransit(site, avo_mat):
+                        CREATE TEMP TABLE _dd_keyed ON COMMIT DROP AS
+                        SELECT "Site","AVOMaterialNo","DeliveryNo","Date","Status",
+                               0::bigint AS floor_qty, 0::bigint AS delta_qty
+                        FROM public."DeliveryDetails" WITH NO DATA
+                    """)
+                    execute_values(
+                        cur,
+                        'INSERT INTO _dd_keyed ("Site","AVOMaterialNo","DeliveryNo","Date","Status",floor_qty,delta_qty) VALUES %s',
+                        [(*k, f, d) for k, (f, d) in keyed.items()],
+                        page_size=len(keyed),
+                    )
                     cur.execute("""
-                        DELETE FROM public."DeliveryDetails"
-                        WHERE "Site"=%s AND "AVOMaterialNo"=%s AND "Status"='InTransit'
-                    """, (site, avo_mat))
-
-                def _rewrite_intransit(site, avo_mat, delivery_no, date, qty):
-                    _delete_all_intransit(site, avo_mat)
-                    if int(qty) > 0:
-                        _insert_row(site, avo_mat, delivery_no, date, "InTransit", int(qty))
-
-                # iterate normalized df
-                for _, row in df.iterrows():
-                    site        = _safestr(row.get("Site"))[:20]
-                    avo_mat     = _safestr(row.get("AVOMaterialNo"))[:30]
-                    delivery_no = _safestr(row.get("DeliveryNo"))[:30]
-                    date        = _safestr(row.get("Date"))[:20]
-                    qty         = _clean_qty(row.get("Quantity"))
-                    status      = _norm_status(row.get("Status"))
-
-                    if not (site and avo_mat and delivery_no and date and status):
-                        continue
-
-                    if status == "Dispatched":
-                        curr_it = _sum_intransit(site, avo_mat)
-                        _rewrite_intransit(site, avo_mat, delivery_no, date, curr_it + qty)
-                        _merge_sum_key(site, avo_mat, delivery_no, date, "Dispatched", qty)
-
-                    elif status == "Delivered":
-                        curr_it = _sum_intransit(site, avo_mat)
-                        new_it = max(0, curr_it - qty)
-                        _rewrite_intransit(site, avo_mat, delivery_no, date, new_it)
-                        _merge_sum_key(site, avo_mat, delivery_no, date, "Delivered", qty)
-
-                    elif status == "InTransit":
-                        curr_it = _sum_intransit(site, avo_mat)
-                        _rewrite_intransit(site, avo_mat, delivery_no, date, curr_it + qty)
-
-                    else:
-                        _merge_sum_key(site, avo_mat, delivery_no, date, status, qty)
+                        WITH cur AS (
+                            SELECT d."Site", d."AVOMaterialNo", d."DeliveryNo", d."Date", d."Status",
+                                   TRUNC(SUM(d."Quantity")::numeric)::bigint AS qty
+                            FROM public."DeliveryDetails" d
+                            JOIN _dd_keyed t ON d."Site" = t."Site" AND d."AVOMaterialNo" = t."AVOMaterialNo"
+                                AND d."DeliveryNo" = t."DeliveryNo" AND d."Date" = t."Date" AND d."Status" = t."Status"
+                            GROUP BY d."Site", d."AVOMaterialNo", d."DeliveryNo", d."Date", d."Status"
+                        ), del AS (
+                            DELETE FROM public."DeliveryDetails" d
+                            USING _dd_keyed t
+                            WHERE d."Site" = t."Site" AND d."AVOMaterialNo" = t."AVOMaterialNo"
+                              AND d."DeliveryNo" = t."DeliveryNo" AND d."Date" = t."Date" AND d."Status" = t."Status"
+                        ), new AS (
+                            SELECT t."Site", t."AVOMaterialNo", t."DeliveryNo", t."Date", t."Status",
+                                   GREATEST(t.floor_qty, COALESCE(c.qty, 0) + t.delta_qty) AS qty
+                            FROM _dd_keyed t
+                            LEFT JOIN cur c ON c."Site" = t."Site" AND c."AVOMaterialNo" = t."AVOMaterialNo"
+                                AND c."DeliveryNo" = t."DeliveryNo" AND c."Date" = t."Date" AND c."Status" = t."Status"
+                        )
+                        INSERT INTO public."DeliveryDetails"
+                            ("Site","AVOMaterialNo","DeliveryNo","Quantity","Date","Status")
+                        SELECT "Site","AVOMaterialNo","DeliveryNo",qty,"Date","Status"
+                        FROM new WHERE qty > 0
+                    """)
+        bump_data_version("DeliveryDetails")
 
     finally:
         try:
@@ -2054,6 +3960,7 @@ def insert_deliverydetails(df):
 
 
 
+
 OCR_SERVICE_URL = "https://ocr-files-cdh9dbaqf2cufdgs.francecentral-01.azurewebsites.net/process-base64"
 
 #----------------------------- les fonctions pour truncate delivery detaills--------------------------- 
@@ -2069,8 +3976,11 @@ def purge_deliverydetails_job():
             conn = get_pg_connection()
             with conn.cursor() as cur:
                 cur.execute('TRUNCATE TABLE public."DeliveryDetails" RESTART IDENTITY CASCADE;')
+                if _table_exists(cur, "InTransitBalance"):
+                    cur.execute('TRUNCATE TABLE public."InTransitBalance";')
 
             conn.commit()
+            bump_data_version("DeliveryDetails")
             app.logger.info("✅ DeliveryDetails table cleared successfully")
 
     except Exception as e:
@@ -2174,6 +4084,7 @@ def perform_ocr_on_base64(file_base64, filename):
     """
     Sends the Base64 string to the local OCR service and returns the raw text.
     """
+    set_job_stage("ocr")
     payload = {
         "file_name": filename,
         "file_content_base64": file_base64,
@@ -2376,33 +4287,156 @@ def process_file_endpoint():
     file_content_base64 = data['file_content_base64']
     file_type = data.get('file_type', None)
 
-    file_ext = os.path.splitext(file_name)[1].lower()
-
-    is_pdf = (file_type == "pdf") or file_ext == ".pdf"
-    is_csv = (file_type == "csv") or file_ext == ".csv"
-    is_excel = file_ext in [".xlsx", ".xls"]
-
     try:
         file_bytes = base64.b64decode(file_content_base64)
     except Exception as e:
         logging.error(f"Failed to decode Base64 string for file {file_name}: {e}")
         return jsonify({"error": f"Invalid Base64 content. Detail: {e}"}), 400
 
-    extracted_records = []
-    company = None
-    header = None
+    return _process_tunisia_file(file_name, file_bytes, file_type, file_content_base64)
+
+
+def _parse_tunisia_upload(file_name, file_bytes, file_type=None, pdf_doc=None):
+    """
+    Parse step of /process-TunisiaSite (PDF after the scanned check, Excel stock, CSV).
+    Returns (company, records, error) where error is (json_body, http_status) or None.
+    """
+    file_ext = os.path.splitext(file_name)[1].lower()
+
+    is_pdf = (file_type == "pdf") or file_ext == ".pdf"
+    is_csv = (file_type == "csv") or file_ext == ".csv"
+    is_excel = file_ext in [".xlsx", ".xls"]
 
     # ---------- PDF path ----------
     if is_pdf and _looks_like_pdf(file_bytes):
+        if pdf_doc is None:
+            pdf_doc = open_request_pdf(file_bytes, file_name)
+
+        # FACTURE first, otherwise vendor-specific PDF
+        try:
+            pdf_format, extracted_records, parse_error = _parse_tunisia_pdf(pdf_doc, file_name)
+            if parse_error is not None:
+                raise parse_error
+            if not pdf_format:
+                return None, [], ({"error": "Unknown or unsupported PDF format."}, 400)
+
+            company = TUNISIA_PDF_COMPANIES.get(pdf_format)
+            if company is None:
+                return None, [], ({"error": "Unrecognized PDF format."}, 400)
+            return company, extracted_records, None
+
+        except Exception as e:
+            logging.exception("PDF processing error")
+            return None, [], ({"error": f"PDF processing error: {e}"}, 400)
+
+    # ---------- Excel Stock path ----------
+    elif is_excel:
+        try:
+            extracted_records, company = process_stock_excel(file_bytes, file_name)
+
+            if not extracted_records:
+                return None, [], ({"error": "No stock rows found in Excel file."}, 422)
+            return company, extracted_records, None
+
+        except Exception as e:
+            logging.exception("Excel stock processing error")
+            return None, [], ({"error": f"Excel stock processing error: {e}"}, 400)
+
+    # ---------- CSV path ----------
+    elif is_csv:
+        cache_key = parse_cache_key("tunisia-csv", file_bytes)
+        cached = PARSE_CACHE.get(cache_key)
+        if cached is not None:
+            company, records = cached
+            return company, [dict(r) for r in records], None
+
+        try:
+            rows = _read_semicolon_csv_rows(file_bytes)
+            header = rows[0]
+        except Exception as e:
+            logging.error(f"Failed to decode and clean Base64 string for file {file_name}: {e}")
+            return None, [], ({"error": f"Invalid Base64 content. Detail: {e}"}, 400)
+
+        company, header = detect_company_and_prepare(rows)
+        if not company:
+            return None, [], ({"error": "Unknown or unsupported CSV format."}, 400)
+
+        parser = TUNISIA_CSV_PARSERS.get(company)
+        if parser is None:
+            return None, [], ({"error": "Unrecognized company type."}, 400)
+        extracted_records = parser(rows, header)
+        PARSE_CACHE.put(cache_key, (company, tuple(dict(r) for r in extracted_records)))
+        return company, extracted_records, None
+
+    return None, [], ({"error": f"Unsupported file type for file: {file_name}"}, 400)
+
+
+def _prepare_delivery_frame(extracted_records, company):
+    """
+    FACTURE / STOCK records -> normalized, de-duplicated DeliveryDetails frame.
+    Returns (df, source_lines); df is None when nothing was parsed.
+    """
+    company_str = str(company or "").upper()
+    df = pd.DataFrame(extracted_records)
+    if df.empty:
+        return None, 0
+
+    # ensure required columns exist
+    for col in ["Site", "AVOMaterialNo", "DeliveryNo", "Date", "Status", "Quantity"]:
+        if col not in df.columns:
+            df[col] = ""
+
+    # normalize
+    df["Site"] = df["Site"].map(lambda s: _safestr(s)[:20])
+    df["AVOMaterialNo"] = df["AVOMaterialNo"].map(lambda s: _safestr(s)[:30])
+    df["DeliveryNo"] = df["DeliveryNo"].map(lambda s: _safestr(s)[:30])
+    df["Date"] = df["Date"].map(_safestr)
+    df["Status"] = df["Status"].map(_norm_status)
+    df["Quantity"] = df["Quantity"].apply(_clean_qty).astype(int)
+
+    # apply AVO normalization only for FACTURE
+    if "FACTURE" in company_str:
+        df["AVOMaterialNo"] = df.apply(
+            lambda r: _normalize_avo_ref(r.get("AVOMaterialNo"), None), axis=1
+        )
+        df["AVOMaterialNo"] = df["AVOMaterialNo"].map(lambda s: _safestr(s)[:30])
+
+    # aggregate duplicates
+    key_cols = ["Site", "AVOMaterialNo", "DeliveryNo", "Date", "Status"]
+    source_lines = len(df)
+    df = df.groupby(key_cols, as_index=False)["Quantity"].sum()
+    df = df[df["Quantity"] != 0].reset_index(drop=True)
+    return df, source_lines
+
+
+def _is_delivery_company(company) -> bool:
+    """FACTURE and STOCK uploads go to DeliveryDetails, everything else to EDIGlobal."""
+    company_str = str(company or "").upper()
+    return ("FACTURE" in company_str) or ("STOCK" in company_str)
+
+
+def _process_tunisia_file(file_name, file_bytes, file_type=None, file_content_base64=None):
+    file_ext = os.path.splitext(file_name)[1].lower()
+    is_pdf = (file_type == "pdf") or file_ext == ".pdf"
+    pdf_doc = None
+
+    # ---------- Scanned PDF path ----------
+    if is_pdf and _looks_like_pdf(file_bytes):
+        pdf_doc = open_request_pdf(file_bytes, file_name)
 
-        # Check if it is scanned
-        scan_resp, scan_status = is_scanned_pdf(file_bytes, file_name)
+        # Check if it is scanned (skipped when this exact file was already parsed)
+        if parse_cache_key("tunisia-pdf", file_bytes) in PARSE_CACHE:
+            scan_resp, scan_status = None, None
+        else:
+            scan_resp, scan_status = is_scanned_pdf(pdf_doc, file_name)
 
         # If scanned, try OCR
         if scan_resp is not None:
             logging.info(f"File {file_name} detected as scanned. Attempting OCR...")
 
-            ocr_text = perform_ocr_on_base64(file_content_base64, file_name)
+            ocr_text = perform_ocr_on_base64(
+                file_content_base64 or base64.b64encode(file_bytes).decode("ascii"), file_name
+            )
 
             if ocr_text:
                 try:
@@ -2431,126 +4465,18 @@ def process_file_endpoint():
                 logging.warning("OCR service returned no text or failed.")
                 return scan_resp, scan_status
 
-        # Not scanned: FACTURE first, otherwise vendor-specific PDF
-        try:
-            if _contains_facture(file_bytes):
-                extracted_records = process_delivery_invoice_pdf(file_bytes, default_site="Tunisia")
-                company = "Delivery Invoice (FACTURE)"
-            else:
-                pdf_format = detect_pdf_format(file_bytes)
-                if not pdf_format:
-                    return jsonify({"error": "Unknown or unsupported PDF format."}), 400
-
-                if pdf_format == "valeo_campinas":
-                    extracted_records = process_valeo_campinas_pdf(file_bytes, file_name)
-                    company = "Valeo VWS Campinas"
-
-                elif pdf_format == "valeo_nevers":
-                    extracted_records = process_valeo_nevers_pdf(file_bytes, file_name)
-                    company = "Valeo CIE Nevers"
-
-                elif pdf_format == "pierburg":
-                    extracted_records = process_pierburg_pdf(file_bytes, file_name)
-                    company = "Pierburg"
-
-                elif pdf_format == "nidec":
-                    extracted_records = process_nidec_pdf(file_bytes, file_name)
-                    company = "Nidec"
-
-                else:
-                    return jsonify({"error": "Unrecognized PDF format."}), 400
-
-        except Exception as e:
-            logging.exception("PDF processing error")
-            return jsonify({"error": f"PDF processing error: {e}"}), 400
-
-    # ---------- Excel Stock path ----------
-    elif is_excel:
-        try:
-            extracted_records, company = process_stock_excel(file_bytes, file_name)
-
-            if not extracted_records:
-                return jsonify({"error": "No stock rows found in Excel file."}), 422
-
-        except Exception as e:
-            logging.exception("Excel stock processing error")
-            return jsonify({"error": f"Excel stock processing error: {e}"}), 400
-
-    # ---------- CSV path ----------
-    elif is_csv:
-        try:
-            logging.warning(f"DEBUG: first 100 b64 chars: {file_content_base64[:100]}")
-            csv_text = decode_and_clean_csv(file_content_base64)
-            csv_io = io.StringIO(csv_text)
-            rows = list(csv.reader(csv_io, delimiter=';'))
-
-            header = [col.strip() for col in rows[0]]
-            rows_cleaned = []
-            for row in rows:
-                cleaned_row = [cell.strip() for cell in row]
-                while cleaned_row and cleaned_row[-1] == '':
-                    cleaned_row.pop()
-                rows_cleaned.append(cleaned_row)
-
-            rows = rows_cleaned
-            rows[0] = header
-
-        except Exception as e:
-            logging.error(f"Failed to decode and clean Base64 string for file {file_name}: {e}")
-            return jsonify({"error": f"Invalid Base64 content. Detail: {e}"}), 400
-
-        company, header = detect_company_and_prepare(rows)
-        if not company:
-            return jsonify({"error": "Unknown or unsupported CSV format."}), 400
-
-        if company == "Valeo":
-            extracted_records = process_valeo_rows(rows, header)
-        elif company == "Inteva":
-            extracted_records = process_inteva_rows(rows, header)
-        elif company == "Nidec":
-            extracted_records = process_nidec_rows(rows, header)
-        else:
-            return jsonify({"error": "Unrecognized company type."}), 400
-
-    else:
-        return jsonify({"error": f"Unsupported file type for file: {file_name}"}), 400
+    company, extracted_records, error = _parse_tunisia_upload(file_name, file_bytes, file_type, pdf_doc)
+    if error:
+        return jsonify(error[0]), error[1]
 
     # ---------- Save to DB ----------
     try:
-        company_str = str(company or "").upper()
-
         # FACTURE + STOCK => DeliveryDetails
-        if ("FACTURE" in company_str) or ("STOCK" in company_str):
-            df = pd.DataFrame(extracted_records)
-            if df.empty:
+        if _is_delivery_company(company):
+            df, source_lines = _prepare_delivery_frame(extracted_records, company)
+            if df is None:
                 return jsonify({"error": "No delivery/stock lines parsed"}), 422
 
-            # ensure required columns exist
-            for col in ["Site", "AVOMaterialNo", "DeliveryNo", "Date", "Status", "Quantity"]:
-                if col not in df.columns:
-                    df[col] = ""
-
-            # normalize
-            df["Site"] = df["Site"].map(lambda s: _safestr(s)[:20])
-            df["AVOMaterialNo"] = df["AVOMaterialNo"].map(lambda s: _safestr(s)[:30])
-            df["DeliveryNo"] = df["DeliveryNo"].map(lambda s: _safestr(s)[:30])
-            df["Date"] = df["Date"].map(_safestr)
-            df["Status"] = df["Status"].map(_norm_status)
-            df["Quantity"] = df["Quantity"].apply(_clean_qty).astype(int)
-
-            # apply AVO normalization only for FACTURE
-            if "FACTURE" in company_str:
-                df["AVOMaterialNo"] = df.apply(
-                    lambda r: _normalize_avo_ref(r.get("AVOMaterialNo"), None), axis=1
-                )
-                df["AVOMaterialNo"] = df["AVOMaterialNo"].map(lambda s: _safestr(s)[:30])
-
-            # aggregate duplicates
-            key_cols = ["Site", "AVOMaterialNo", "DeliveryNo", "Date", "Status"]
-            source_lines = len(df)
-            df = df.groupby(key_cols, as_index=False)["Quantity"].sum()
-            df = df[df["Quantity"] != 0].reset_index(drop=True)
-
             # insert into DeliveryDetails
             insert_deliverydetails(df)
 
@@ -2587,15 +4513,15 @@ def process_file_endpoint():
 
 
 
-def is_scanned_pdf(file_bytes: bytes, file_name: str) -> tuple:
+def is_scanned_pdf(file_bytes, file_name: str) -> tuple:
     """
     Analyse un PDF pour détecter s'il est scanné (aucun texte extractible).
     Retourne un tuple (json_response, http_status) pour envoi direct.
     """
     try:
-        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
-            for page in doc:
-                if page.get_text("text").strip():
+        with pdf_document(file_bytes, file_name) as pdf:
+            for page_no in range(pdf.fitz_page_count()):
+                if pdf.fitz_page_text(page_no).strip():
                     # PDF non scanné
                     return None, None  # On renvoie None pour signaler que ce n'est pas un scan
 
@@ -2676,8 +4602,6 @@ def detect_client_info():
 
     file_name = data['file_name']
     file_content_base64 = data['file_content_base64']
-    file_ext = os.path.splitext(file_name)[1] or ".dat"
-    is_pdf = file_name.lower().endswith('.pdf')
 
     try:
         file_bytes = base64.b64decode(file_content_base64)
@@ -2685,6 +4609,13 @@ def detect_client_info():
         logging.error(f"Failed to decode Base64 string for file {file_name}: {e}")
         return jsonify({"error": f"Invalid Base64 content. Detail: {e}"}), 400
 
+    return _detect_tunisia_file(file_name, file_bytes)
+
+
+def _detect_tunisia_file(file_name, file_bytes):
+    file_ext = os.path.splitext(file_name)[1] or ".dat"
+    is_pdf = file_name.lower().endswith('.pdf')
+
     extracted_records = []
     client_code = None
     company_name = None
@@ -2692,22 +4623,28 @@ def detect_client_info():
 
     # ---------- PDF HANDLING ----------
     if is_pdf:
-        scan_resp, scan_status = is_scanned_pdf(file_bytes, file_name)
-        if scan_resp is not None:
-            return scan_resp, scan_status
+        pdf_doc = open_request_pdf(file_bytes, file_name)
+        if parse_cache_key("tunisia-pdf", file_bytes) not in PARSE_CACHE:
+            scan_resp, scan_status = is_scanned_pdf(pdf_doc, file_name)
+            if scan_resp is not None:
+                return scan_resp, scan_status
 
         scanned_flag = False
 
+        # Same parse (and cache entry) as /process-TunisiaSite
+        try:
+            pdf_format, extracted_records, parse_error = _parse_tunisia_pdf(pdf_doc, file_name)
+        except Exception as e:
+            logging.warning(f"PDF format detection failed for {file_name}: {e}")
+            pdf_format, extracted_records, parse_error = None, [], e
+
         # ✅ NEW: detect delivery invoice by the word "FACTURE"
         try:
-            if _contains_facture(file_bytes):
-                company_name = "Delivery Invoice (FACTURE)"
+            if pdf_format == "facture":
+                company_name = TUNISIA_PDF_COMPANIES["facture"]
 
-                # Optional: parse to get DeliveryNo/Date for a nicer suggested filename
-                try:
-                    recs = process_delivery_invoice_pdf(file_bytes, default_site="Tunisia")
-                except Exception:
-                    recs = []
+                # Optional: parsed DeliveryNo/Date give a nicer suggested filename
+                recs = extracted_records if parse_error is None else []
 
                 dno = str((recs[0].get("DeliveryNo") if recs else None) or "unknown")
                 ddate = str((recs[0].get("Date") if recs else None) or "unknown")
@@ -2728,43 +4665,24 @@ def detect_client_info():
                 }
                 return jsonify(payload), 200
         except Exception as e:
-            # If something goes wrong in the detection, fall through to the legacy flow
+            # If something goes wrong building the invoice payload, fall through to the legacy flow
             app.logger.warning(f"FACTURE detection failed for {file_name}: {e}")
 
-        # (legacy vendor PDF flow kept as-is)
-        pdf_format = detect_pdf_format(file_bytes)
-        if not pdf_format:
+        # (legacy vendor PDF flow)
+        if parse_error is not None:
+            logging.warning(f"PDF parsing error for {file_name}: {parse_error}")
             return build_unknown_response(
                 file_name=file_name,
                 file_ext=file_ext,
-                reason="unrecognized_pdf_format",
+                reason="pdf_parse_error",
                 file_type="pdf",
                 is_scanned=scanned_flag,
             )
-
-        try:
-            if pdf_format == "valeo_campinas":
-                extracted_records = process_valeo_campinas_pdf(file_bytes, file_name)
-            elif pdf_format == "valeo_nevers":
-                extracted_records = process_valeo_nevers_pdf(file_bytes, file_name)
-            elif pdf_format == "pierburg":
-                extracted_records = process_pierburg_pdf(file_bytes, file_name)
-            elif pdf_format == "nidec":
-                extracted_records = process_nidec_pdf(file_bytes, file_name)
-            else:
-                return build_unknown_response(
-                    file_name=file_name,
-                    file_ext=file_ext,
-                    reason="unrecognized_pdf_format",
-                    file_type="pdf",
-                    is_scanned=scanned_flag,
-                )
-        except Exception as e:
-            logging.warning(f"PDF parsing error for {file_name}: {e}")
+        if pdf_format not in TUNISIA_PDF_COMPANIES or pdf_format == "facture":
             return build_unknown_response(
                 file_name=file_name,
                 file_ext=file_ext,
-                reason="pdf_parse_error",
+                reason="unrecognized_pdf_format",
                 file_type="pdf",
                 is_scanned=scanned_flag,
             )
@@ -2772,82 +4690,63 @@ def detect_client_info():
 
     # ---------- CSV HANDLING ----------
     else:
-        try:
-            csv_text = decode_and_clean_csv(file_content_base64)
-            csv_io = io.StringIO(csv_text)
-            rows = list(csv.reader(csv_io, delimiter=';'))
+        cache_key = parse_cache_key("tunisia-csv", file_bytes)
+        cached = PARSE_CACHE.get(cache_key)
+        if cached is not None:
+            extracted_records = [dict(r) for r in cached[1]]
+        else:
+            try:
+                rows = _read_semicolon_csv_rows(file_bytes)
+            except Exception as e:
+                return build_unknown_response(
+                    file_name=file_name,
+                    file_ext=file_ext,
+                    reason="csv_decoding_failed",
+                    file_type="csv",
+                )
 
             if not rows or not rows[0]:
                 return build_unknown_response(
                     file_name=file_name,
                     file_ext=file_ext,
-                    reason="empty_or_invalid_csv",
+                    reason="empty_or_invalid_csv",
+                    file_type="csv",
+                )
+
+            company, header = detect_company_and_prepare(rows)
+            if not company:
+                return build_unknown_response(
+                    file_name=file_name,
+                    file_ext=file_ext,
+                    reason="unrecognized_csv_format",
+                    file_type="csv",
+                )
+
+            parser = TUNISIA_CSV_PARSERS.get(company)
+            if parser is None:
+                return build_unknown_response(
+                    file_name=file_name,
+                    file_ext=file_ext,
+                    reason="unrecognized_company_type",
                     file_type="csv",
                 )
-
-            header = [col.strip() for col in rows[0]]
-            rows_cleaned = [[cell.strip() for cell in row] for row in rows]
-            rows_cleaned[0] = header
-            rows = rows_cleaned
-        except Exception as e:
-            return build_unknown_response(
-                file_name=file_name,
-                file_ext=file_ext,
-                reason="csv_decoding_failed",
-                file_type="csv",
-            )
-
-        company, header = detect_company_and_prepare(rows)
-        if not company:
-            return build_unknown_response(
-                file_name=file_name,
-                file_ext=file_ext,
-                reason="unrecognized_csv_format",
-                file_type="csv",
-            )
-
-        try:
-            if company == "Valeo":
-                extracted_records = process_valeo_rows(rows, header)
-            elif company == "Inteva":
-                extracted_records = process_inteva_rows(rows, header)
-            elif company == "Nidec":
-                extracted_records = process_nidec_rows(rows, header)
-            else:
+            try:
+                extracted_records = parser(rows, header)
+            except Exception as e:
+                logging.warning(f"CSV parsing error for {file_name}: {e}")
                 return build_unknown_response(
                     file_name=file_name,
                     file_ext=file_ext,
-                    reason="unrecognized_company_type",
+                    reason="csv_parse_error",
                     file_type="csv",
                 )
-        except Exception as e:
-            logging.warning(f"CSV parsing error for {file_name}: {e}")
-            return build_unknown_response(
-                file_name=file_name,
-                file_ext=file_ext,
-                reason="csv_parse_error",
-                file_type="csv",
-            )
+            PARSE_CACHE.put(cache_key, (company, tuple(dict(r) for r in extracted_records)))
 
     # ---------- Produce recognized response ----------
     if extracted_records:
         client_code = extracted_records[0].get("ClientCode", None)
 
-    code_to_company = {
-        "C00409": "Valeo Nevers",
-        "C00072": "Valeo Brasil",
-        "C00285": "Pierburg",
-        "C00260": "Nidec Inde",
-        "C00113": "Nidec DCK",
-        "C00126": "Nidec Pologne",
-        "C00050": "Nidec ESP",
-        "C00241": "Inteva GAD",
-        "C00410": "Inteva Esson",
-        "C00250": "Valeo Poland",
-        "C00303": "Valeo Mexique",
-        "C00125": "Valeo Madrid",
-        "C00132": "Valeo Betigheim"
-    }
+    code_to_company = MAPPING_REGISTRY.forward("client.company")
     company_name = code_to_company.get(client_code, "Unknown") if client_code else "Unknown"
     forecast_date = extracted_records[0].get("ForecastDate") if extracted_records else None
     suggested_name = f"{company_name.replace(' ', '_')}_edi_{(forecast_date or 'unknown_week')}{file_ext}".lower()
@@ -2875,26 +4774,8 @@ def detect_client_info():
 def process_valeo_de_csv_rows(rows, header):
     processed = []
 
-    plant_to_client = {
-        "CZ22": "100442", 
-        "FUEN": "100541", 
-        "KJ01": "100506", 
-        "CA02": "100573",
-        "ET01": "100523"
-    }
-
-    valeo_de_product_map = {
-        "190313": "1023093",
-        "191663": "1023645",
-        "187144": "1026188",
-        "194470": "1026258",
-        "202066": "1026540",
-        "214188": "1026629",
-        "471550":  "1026325",
-        "478537":  "1026365",
-        "470737":  "1026384"
-
-    }
+    plant_to_client = MAPPING_REGISTRY.forward("valeo_de.plant_to_client")
+    valeo_de_product_map = MAPPING_REGISTRY.forward("valeo_de.material_to_avo")
 
     idx = {col: header.index(col) for col in header}
 
@@ -2958,14 +4839,8 @@ def process_valeo_de_csv_rows(rows, header):
 
 
 def process_nidec_de_csv_rows(rows, header):
-    plant_to_client = {
-        "ZI01": "100420",  # Nidec Poland - Germany site
-    }
-
-    material_map = {
-        "471-695-99-99": "1022201",
-        "503-660-99-99": "1027700"
-    }
+    plant_to_client = MAPPING_REGISTRY.forward("nidec_de.plant_to_client")  # Nidec Poland - Germany site
+    material_map = MAPPING_REGISTRY.forward("nidec_de.material_to_avo")
 
     processed = []
     idx = {col: header.index(col) for col in header}
@@ -3041,7 +4916,8 @@ def process_nidec_de_csv_rows(rows, header):
 
 
 def process_bosch_pdf(file_bytes, file_name):
-    text = parse_pdf(io.BytesIO(file_bytes))
+    with pdf_document(file_bytes, file_name) as pdf:
+        text = pdf.pypdf_text()
     lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
 
     # Standortcode --> ClientCode
@@ -3049,13 +4925,7 @@ def process_bosch_pdf(file_bytes, file_name):
     m = re.search(r"Standortcode\s*\(Kunde\):\s*(\w+)", text)
     if m:
         code = m.group(1)
-        site_code_to_client = {
-            "2570": "100409",
-            "5060": "100410",
-            "908A": "100327",
-            "526W": "100296"
-        }
-        client_code = site_code_to_client.get(code, "UNKNOWN")
+        client_code = MAPPING_REGISTRY.forward("bosch.site_to_client").get(code, "UNKNOWN")
 
     # Material (Client)
     material = re.search(r"Material:\s*([0-9A-Za-z\-]+)", text)
@@ -3084,16 +4954,8 @@ def process_bosch_pdf(file_bytes, file_name):
         forecast_date = m.group(1)
 
     # Material Mappings
-    bosch_material_map = {
-        "1027599": "1582875601",
-        "1022031": "1582884102",
-        "1026644": "1394320515",
-        "1021731": "1394320230",
-        "1394320230":  "1021731",
-        "1394320228":  "1026021"
-
-    }
-    reverse_map = {v: k for k, v in bosch_material_map.items()}
+    bosch_material_map = MAPPING_REGISTRY.forward("bosch.avo_to_client_material")
+    reverse_map = MAPPING_REGISTRY.reverse("bosch.avo_to_client_material")
 
     client_material_no = "UNKNOWN"
     avo_material_no = "UNKNOWN"
@@ -3175,10 +5037,11 @@ def parse_pdf(file_bytes_io):
 
 
 def process_nidec_de_pdf(file_bytes):
-    import re, io
+    import re
     from datetime import datetime
 
-    text = parse_pdf(io.BytesIO(file_bytes))
+    with pdf_document(file_bytes) as pdf:
+        text = pdf.pypdf_text()
 
     # --- helpers ---
     def int_from(s):
@@ -3292,7 +5155,6 @@ def process_file_endpoint_germany():
     file_name = data['file_name']
     file_content_base64 = data['file_content_base64']
     file_type = data.get('file_type', None)
-    is_pdf = file_type == "pdf" or file_name.lower().endswith('.pdf')
 
     try:
         file_bytes = base64.b64decode(file_content_base64)
@@ -3300,33 +5162,31 @@ def process_file_endpoint_germany():
         logging.error(f"Failed to decode Base64 string for file {file_name}: {e}")
         return jsonify({"error": f"Invalid Base64 content. Detail: {e}"}), 400
 
+    return _process_germany_file(file_name, file_bytes, file_type)
+
+
+def _parse_germany_upload(file_name, file_bytes, file_type=None):
+    """
+    Parse step of /process-GermanySite.
+    Returns (company, records, error) where error is (json_body, http_status) or None.
+    """
+    is_pdf = file_type == "pdf" or file_name.lower().endswith('.pdf')
+
     extracted_records = []
     company = None
     header = None
 
     if not is_pdf:
         try:
-            logging.warning(f"DEBUG: first 100 b64 chars: {file_content_base64[:100]}")
-            csv_text = decode_and_clean_csv(file_content_base64)
-            csv_io = io.StringIO(csv_text)
-            rows = list(csv.reader(csv_io, delimiter=';'))
-
-            header = [col.strip() for col in rows[0]]
-            rows_cleaned = []
-            for row in rows:
-                cleaned_row = [cell.strip() for cell in row]
-                while cleaned_row and cleaned_row[-1] == '':
-                    cleaned_row.pop()
-                rows_cleaned.append(cleaned_row)
-            rows = rows_cleaned
-            rows[0] = header
+            rows = _read_semicolon_csv_rows(file_bytes)
+            header = rows[0]
         except Exception as e:
             logging.error(f"Failed to decode and clean Base64 string for file {file_name}: {e}")
-            return jsonify({"error": f"Invalid Base64 content. Detail: {e}"}), 400
+            return None, [], ({"error": f"Invalid Base64 content. Detail: {e}"}, 400)
 
         company, header = detect_company_and_prepare(rows)
         if not company:
-            return jsonify({"error": "Unknown or unsupported CSV format."}), 400
+            return None, [], ({"error": "Unknown or unsupported CSV format."}, 400)
 
         if company == "Valeo":
             extracted_records = process_valeo_de_csv_rows(rows, header)
@@ -3335,48 +5195,57 @@ def process_file_endpoint_germany():
         elif company == "Nidec":
             extracted_records = process_nidec_de_csv_rows(rows, header)   # Optional: Replace if you want DE-specific Nidec logic
         else:
-            return jsonify({"error": "Unrecognized company type."}), 400
+            return None, [], ({"error": "Unrecognized company type."}, 400)
 
     elif is_pdf:
         try:
-            logging.warning(f"DEBUG: first 100 b64 chars: {file_content_base64[:100]}")
-            file_bytes = base64.b64decode(file_content_base64)
-            file = io.BytesIO(file_bytes)
-            text = parse_pdf(file)
+            pdf_doc = open_request_pdf(file_bytes, file_name)
+            text = pdf_doc.pypdf_text()
 
             if "Standortcode (Kunde):" in text:
                 match = re.search(r"Standortcode\s*\(Kunde\):\s*(\w+)", text)
                 if match:
                     bosch_code = match.group(1)
                     company="BOSCH"
-                    bosch_code_to_client = {
-                        "2570": "100409",
-                        "5060": "100410",
-                        "908A": "100327",
-                        "526W": "100296"
-                    }
-                    client_code = bosch_code_to_client.get(bosch_code)
+                    client_code = MAPPING_REGISTRY.forward("bosch.site_to_client").get(bosch_code)
                     if not client_code:
-                        return jsonify({"error": f"Unrecognized BOSCH Standortcode: {bosch_code}"}), 400
+                        return None, [], ({"error": f"Unrecognized BOSCH Standortcode: {bosch_code}"}, 400)
 
-                    extracted_records = process_bosch_pdf(file_bytes, file_name)
+                    extracted_records = process_bosch_pdf(pdf_doc, file_name)
                 else:
-                    return jsonify({"error": "Could not extract Standortcode (Kunde) from Bosch PDF."}), 400
+                    return None, [], ({"error": "Could not extract Standortcode (Kunde) from Bosch PDF."}, 400)
             elif "NIDEC PART NUMBER" in text and "AVO CARBON GERMANY GMBH" in text:
                 company = "Nidec USA"
-                extracted_records = process_nidec_de_pdf(file_bytes)
+                extracted_records = process_nidec_de_pdf(pdf_doc)
             elif "DENSO MANUFACTURING ITALIA" in text and "MATERIAL RELEASE" in text:
                 if "AVO CARBON GERMANY GMBH" in text:
                     company = "Denso"
                     # extracted_records = process_denso_de_pdf(file_bytes)
                 else:
-                    return jsonify({"error": "Unrecognized Denso recipient in PDF."}), 400
+                    return None, [], ({"error": "Unrecognized Denso recipient in PDF."}, 400)
             else:
-                return jsonify({"error": "Unrecognized PDF format – Bosch header not found."}), 400
+                return None, [], ({"error": "Unrecognized PDF format – Bosch header not found."}, 400)
+
+        except Exception as e:
+            logging.exception("Error processing PDF file:")
+            return None, [], ({"error": f"Failed to process PDF. Detail: {str(e)}"}, 400)
 
+    return company, extracted_records, None
+
+
+def _process_germany_file(file_name, file_bytes, file_type=None):
+    if file_type == "pdf" or file_name.lower().endswith('.pdf'):
+        try:
+            parsed = run_in_parse_pool(_parse_upload_task, "process-GermanySite", file_name, file_bytes, file_type)
         except Exception as e:
             logging.exception("Error processing PDF file:")
             return jsonify({"error": f"Failed to process PDF. Detail: {str(e)}"}), 400
+        company, extracted_records, error = parsed["company"], parsed["records"], parsed["error"]
+    else:
+        company, extracted_records, error = _parse_germany_upload(file_name, file_bytes, file_type)
+    if error:
+        return jsonify(error[0]), error[1]
+
     success_count, error_details = save_to_postgres_with_conflict_reporting(extracted_records)
     return jsonify({
         "message": "Germany processing completed.",
@@ -3502,7 +5371,7 @@ def debug_probe_deliverytable(product_codes: Optional[List[str]], sites: Optiona
     try:
         conn = get_pg_connection()
         with conn.cursor() as cur:
-            cur.execute('SELECT UPPER(TRIM("Status")) AS s, COUNT(*) FROM "DeliveryDetails" GROUP BY 1 ORDER BY 2 DESC')
+            cur.execute(f'SELECT {_SQL_DD_STATUS} AS s, COUNT(*) FROM "DeliveryDetails" GROUP BY 1 ORDER BY 2 DESC')
             rows = cur.fetchall()
             _log("[DELIV:PROBE] status counts: %s", rows)
 
@@ -3512,19 +5381,19 @@ def debug_probe_deliverytable(product_codes: Optional[List[str]], sites: Optiona
 
             # Removed client-only probe; the column no longer exists.
             if product_codes:
-                cur.execute('''
+                cur.execute(f'''
                     SELECT COUNT(*)
                     FROM "DeliveryDetails"
-                    WHERE UPPER(COALESCE("AVOMaterialNo", '')) = ANY(%s)
+                    WHERE {_SQL_DD_PRODUCT} = ANY(%s)
                 ''', ([p.upper() for p in product_codes],))
                 cnt = cur.fetchone()[0]
                 _log("[DELIV:PROBE] rows matching product_codes by AVOMaterialNo: %s", cnt)
 
             if sites:
-                cur.execute('''
+                cur.execute(f'''
                     SELECT COUNT(*)
                     FROM "DeliveryDetails"
-                    WHERE UPPER(TRIM("Site")) = ANY(%s)
+                    WHERE {_SQL_DD_SITE} = ANY(%s)
                 ''', ([s.upper().strip() for s in sites],))
                 cnt = cur.fetchone()[0]
                 _log("[DELIV:PROBE] rows matching sites: %s", cnt)
@@ -3567,15 +5436,97 @@ def fetch_ediglobal(
     finally:
         conn.close()
 
-def fetch_deliverydetails_raw(
+# Week strings -> ordinal (year * 52 + week) in SQL, mirroring norm_week_str /
+# parse_year_week / week_diff: 'YYYY-W<digits>', week zero-padded to 2 and read
+# from its last two digits. Anything else is NULL (-> "BackLog"). {col} is an
+# expression: DateFrom goes through _SQL_WEEK_TRIM (ASCII whitespace only),
+# ForecastDate needs no trim since it is matched exactly by = ANY(weeks).
+# Values only str.strip() / int() would rescue (Unicode spaces, a sign,
+# underscores, non-ASCII digits) bucket as BackLog here.
+_SQL_WEEK_TRIM = r"btrim({col}, E' \t\n\r\f\x0b')"
+
+_SQL_WEEK_ORDINAL = r"""(CASE WHEN {col} ~ '^[0-9]{{4}}-[Ww][0-9]+$'
+    THEN substr({col}, 1, 4)::int * 52
+       + right('0' || substr({col}, 7), 2)::int
+    END)"""
+
+_SQL_WEEK_NORM = r"""(CASE WHEN {col} ~ '^[0-9]{{4}}-[Ww][0-9]+$'
+    THEN substr({col}, 1, 4) || '-W'
+       || CASE WHEN length({col}) = 7 THEN '0' ELSE '' END
+       || substr({col}, 7)
+    END)"""
+
+
+def fetch_ediglobal_aggregated(
+    weeks: List[str],
+    client_codes: Optional[List[str]],
     product_codes: Optional[List[str]],
     sites: Optional[List[str]],
 ) -> List[dict]:
     """
-    Fetch delivery rows broadly and normalize:
-    - Accept common status variants (IN TRANSIT, INTRANSIT)
-    - Match products by AVOMaterialNo (case-insensitive)
-    - Match Site case-insensitively, trimmed
+    Push-down variant of fetch_ediglobal for run_edi_analysis: interval
+    bucketing and SUM(Quantity) run in PostgreSQL, so only one row per
+    (Site, ClientCode, AVOMaterialNo, Interval, ForecastDate) comes back.
+
+    Totals are exact numeric sums while the raw-row path adds floats one
+    by one, so the two agree to float rounding, not bit for bit: compare
+    them with a small tolerance (a Coverage_OK or Violation sitting exactly
+    on its threshold can come out either way). Week parsing differences
+    are listed at _SQL_WEEK_ORDINAL.
+    """
+    ref_ord = _SQL_WEEK_ORDINAL.format(col='"ForecastDate"')
+    row_ord = _SQL_WEEK_ORDINAL.format(col=_SQL_WEEK_TRIM.format(col='"DateFrom"'))
+    where = ['"ForecastDate" = ANY(%s)']
+    params: List[Any] = [weeks]
+
+    if client_codes:
+        where.append('"ClientCode" = ANY(%s)')
+        params.append(client_codes)
+    if product_codes:
+        where.append('"AVOMaterialNo" = ANY(%s)')
+        params.append(product_codes)
+    if sites:
+        where.append('"Site" = ANY(%s)')
+        params.append(sites)
+
+    sql = f"""
+        SELECT "Site", "ClientCode", "AVOMaterialNo", "ForecastDate", "Interval",
+               SUM("Quantity") AS "Quantity"
+        FROM (
+            SELECT "Site", "ClientCode", "AVOMaterialNo",
+                   {_SQL_WEEK_NORM.format(col='"ForecastDate"')} AS "ForecastDate",
+                   CASE
+                       WHEN {ref_ord} IS NULL OR {row_ord} IS NULL THEN 'BackLog'
+                       WHEN {row_ord} - {ref_ord} <= 1  THEN 'W-1 to W'
+                       WHEN {row_ord} - {ref_ord} <= 5  THEN 'W+2 to W+5'
+                       WHEN {row_ord} - {ref_ord} <= 14 THEN 'W+6 to W+14'
+                       WHEN {row_ord} - {ref_ord} <= 24 THEN 'W+15 to W+24'
+                       ELSE 'W+25 and more'
+                   END AS "Interval",
+                   COALESCE("Quantity", 0) AS "Quantity"
+            FROM "EDIGlobal"
+            WHERE {" AND ".join(where)}
+        ) e
+        GROUP BY "Site", "ClientCode", "AVOMaterialNo", "ForecastDate", "Interval"
+        ORDER BY "Site", "ClientCode", "AVOMaterialNo", "Interval", "ForecastDate"
+    """
+
+    conn = get_pg_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            cols = [c.name for c in cur.description]
+            return [dict(zip(cols, r)) for r in cur.fetchall()]
+    finally:
+        conn.close()
+
+def deliverydetails_intransit_query(
+    product_codes: Optional[List[str]],
+    sites: Optional[List[str]],
+) -> Tuple[str, List[Any]]:
+    """
+    SQL + params for fetch_deliverydetails_raw. Built from the _SQL_DD_*
+    expressions so it stays servable by the in-transit partial indexes.
     """
     prods_upper = [p.upper().strip() for p in product_codes] if product_codes else None
     sites_upper = [s.upper().strip() for s in sites] if sites else None
@@ -3585,80 +5536,482 @@ def fetch_deliverydetails_raw(
     sql = f'''
         SELECT {fields}
         FROM "DeliveryDetails"
-        WHERE UPPER(TRIM("Status")) IN ('IN TRANSIT','INTRANSIT')
+        WHERE {_SQL_DD_IN_TRANSIT}
     '''
     params: List[Any] = []
 
     if prods_upper:
-        sql += '''
-          AND UPPER(COALESCE("AVOMaterialNo", '')) = ANY(%s)
-        '''
+        sql += f' AND {_SQL_DD_PRODUCT} = ANY(%s)'
         params.append(prods_upper)
 
-    if sites_upper:
-        sql += ' AND UPPER(TRIM("Site")) = ANY(%s)'
-        params.append(sites_upper)
+    if sites_upper:
+        sql += f' AND {_SQL_DD_SITE} = ANY(%s)'
+        params.append(sites_upper)
+
+    return sql, params
+
+
+def fetch_deliverydetails_raw(
+    product_codes: Optional[List[str]],
+    sites: Optional[List[str]],
+) -> List[dict]:
+    """
+    Fetch delivery rows broadly and normalize:
+    - Accept common status variants (IN TRANSIT, INTRANSIT)
+    - Match products by AVOMaterialNo (case-insensitive)
+    - Match Site case-insensitively, trimmed
+    """
+    sql, params = deliverydetails_intransit_query(product_codes, sites)
+
+    conn = get_pg_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            cols = [c.name for c in cur.description]
+            rows = [dict(zip(cols, r)) for r in cur.fetchall()]
+            debug_dump_deliveries("RAW", rows)
+            return rows
+    finally:
+        conn.close()
+
+def fetch_deliverydetails(
+    weeks: List[str],                 # kept for signature compatibility
+    product_codes: Optional[List[str]],
+    sites: Optional[List[str]],
+) -> List[dict]:
+    # Return ALL relevant delivery rows (no week filter)
+    return fetch_deliverydetails_raw(product_codes, sites)
+
+
+# "balance": read InTransitBalance (kept current by insert_deliverydetails);
+# "rows": rebuild the map from DeliveryDetails on every call.
+IN_TRANSIT_SOURCE = os.environ.get("IN_TRANSIT_SOURCE", "balance").strip().lower()
+
+
+def fetch_in_transit_balance(
+    product_codes: Optional[List[str]],
+    sites: Optional[List[str]],
+) -> Optional[Dict[str, Dict[str, float]]]:
+    """
+    Same shape and filters as build_in_transit_map(fetch_deliverydetails_raw(...)),
+    read from InTransitBalance. None if the table is not there yet (migration 6).
+    """
+    sql = 'SELECT "Site", "AVOMaterialNo", GREATEST("Quantity", 0) FROM public."InTransitBalance" WHERE TRUE'
+    params: List[Any] = []
+    if product_codes:
+        sql += ' AND UPPER("AVOMaterialNo") = ANY(%s)'
+        params.append([p.upper().strip() for p in product_codes])
+    if sites:
+        sql += ' AND UPPER("Site") = ANY(%s)'
+        params.append([s.upper().strip() for s in sites])
+
+    conn = get_pg_connection()
+    try:
+        with conn.cursor() as cur:
+            try:
+                cur.execute(sql, params)
+            except psycopg2.errors.UndefinedTable:
+                return None
+            in_transit_map: Dict[str, Dict[str, float]] = defaultdict(dict)
+            for site, prod, qty in cur.fetchall():
+                in_transit_map[site][prod] = float(qty or 0)
+            return in_transit_map
+    finally:
+        conn.close()
+
+
+def load_in_transit_map(
+    weeks: List[str],
+    product_codes: Optional[List[str]],
+    sites: Optional[List[str]],
+) -> Dict[str, Dict[str, float]]:
+    """Effective in-transit map for the analysis, from the balance table when available."""
+    if IN_TRANSIT_SOURCE == "balance":
+        in_transit_map = fetch_in_transit_balance(product_codes, sites)
+        if in_transit_map is not None:
+            debug_dump_intransit_map_site_only(in_transit_map)
+            return in_transit_map
+        logging.warning("[IN TRANSIT] InTransitBalance missing (run db-migrate); rebuilding from DeliveryDetails")
+    return build_in_transit_map(fetch_deliverydetails(weeks, product_codes, sites))
+
+# ========================= PRODUCT DETAILS CACHE =========================
+# ProductDetails is small and changes rarely, so each worker keeps the whole
+# table in memory under one normalized key (UPPER(TRIM(AVOMaterialNo))).
+# fetch_productdetails_map, /product-capacity-stock and /get-product-details
+# read from it instead of querying. A snapshot is reloaded when it is older
+# than PRODUCT_DETAILS_CACHE_TTL, or at once when Postgres notifies
+# PRODUCT_DETAILS_CHANNEL (statement trigger of schema migration 8, see
+# CHANGE NOTIFICATIONS). Reloads that change the content bump the
+# "ProductDetails" data version, which drops dependent /edi-analysis cache
+# entries.
+
+PRODUCT_DETAILS_CACHE_TTL = float(os.environ.get("PRODUCT_DETAILS_CACHE_TTL", "600"))
+PRODUCT_DETAILS_CHANNEL = "productdetails_changed"
+
+
+def product_key(avo: Any) -> str:
+    return str(avo or "").strip().upper()
+
+
+class ProductDetailsCache:
+    """Whole-table ProductDetails snapshot: rows, columns and per-product info."""
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl = ttl_seconds
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._expires = 0.0
+        self._generation = 0   # bumped by invalidate(); see _mark_fresh
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.invalidations = 0
+        self.loaded_at: Optional[str] = None
+
+    def _load(self) -> Dict[str, Any]:
+        conn = get_pg_connection()
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute('SELECT * FROM public."ProductDetails"')
+                rows = cur.fetchall()
+                columns = [d[0] for d in cur.description]
+        finally:
+            conn.close()
+
+        # key -> row positions; info keeps MAX(Line), MAX(WeeklyCapacity) per key
+        index: Dict[str, List[int]] = defaultdict(list)
+        for i, r in enumerate(rows):
+            key = product_key(r.get("AVOMaterialNo"))
+            if key:
+                index[key].append(i)
+        info = {}
+        for key, positions in index.items():
+            lines = [rows[i].get("Line") for i in positions if rows[i].get("Line") is not None]
+            caps = [rows[i].get("WeeklyCapacity") for i in positions if rows[i].get("WeeklyCapacity") is not None]
+            info[key] = {
+                "Line": max(lines) if lines else None,
+                "WeeklyCapacity": float(max(caps)) if caps else None,
+            }
+        signature = hashlib.sha256(json.dumps(rows, default=str, sort_keys=True).encode("utf-8")).hexdigest()
+        return {"columns": columns, "rows": rows, "index": dict(index), "info": info, "signature": signature}
+
+    def snapshot(self) -> Dict[str, Any]:
+        snap = self._snapshot
+        if snap is not None and time.monotonic() < self._expires:
+            return snap
+        with self._lock:
+            old = self._snapshot
+            if old is not None and time.monotonic() < self._expires:
+                return old
+            generation = self._generation
+            try:
+                snap = self._load()
+            except Exception as e:
+                if old is None:
+                    raise
+                # Keep serving the previous snapshot; retry shortly
+                logging.warning(f"[PRODUCT CACHE] reload failed, serving stale snapshot: {e}")
+                self._mark_fresh(generation, min(self.ttl, 30.0))
+                return old
+            if old is not None and old["signature"] != snap["signature"]:
+                bump_data_version("ProductDetails")
+            self._snapshot = snap
+            self._mark_fresh(generation, self.ttl)
+            self.loads += 1
+            self.loaded_at = datetime.now().isoformat(timespec="seconds")
+            return snap
+
+    def _mark_fresh(self, generation: int, ttl: float):
+        # As in MappingRegistry._mark_fresh: an invalidate() during the load
+        # leaves the snapshot stale instead of being overwritten.
+        self._expires = time.monotonic() + ttl
+        if self._generation != generation:
+            self._expires = 0.0
+
+    def invalidate(self):
+        """Reload on next access (the old snapshot stays for change detection)."""
+        self._generation += 1
+        self._expires = 0.0
+        self.invalidations += 1
+
+    def info(self, product_codes: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        info = self.snapshot()["info"]
+        if not product_codes:
+            return dict(info)
+        keys = {product_key(p) for p in product_codes}
+        return {k: info[k] for k in keys if k in info}
+
+    def rows(self, product_codes: Optional[List[str]] = None) -> Tuple[List[str], List[dict]]:
+        snap = self.snapshot()
+        if not product_codes:
+            return snap["columns"], list(snap["rows"])
+        positions = sorted({i for p in product_codes for i in snap["index"].get(product_key(p), ())})
+        return snap["columns"], [snap["rows"][i] for i in positions]
+
+    def stats(self) -> Dict[str, Any]:
+        snap = self._snapshot
+        return {
+            "products": len(snap["info"]) if snap else 0,
+            "rows": len(snap["rows"]) if snap else 0,
+            "ttl_seconds": self.ttl,
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+            "loaded_at": self.loaded_at,
+            "listening": change_listener_alive(),
+        }
+
+
+PRODUCT_DETAILS_CACHE = ProductDetailsCache(PRODUCT_DETAILS_CACHE_TTL)
+_CACHES["product_details"] = PRODUCT_DETAILS_CACHE
+
+
+def _on_product_details_changed():
+    bump_data_version("ProductDetails")
+    PRODUCT_DETAILS_CACHE.invalidate()
+
+
+CHANGE_CHANNELS[PRODUCT_DETAILS_CHANNEL] = _on_product_details_changed
+
+
+# ========================= DB FETCHERS =========================
+def fetch_productdetails_map(
+    product_codes: Optional[List[str]],
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Return a mapping: product_key(AVOMaterialNo) -> {"Line": <str or None>, "WeeklyCapacity": <float or None>}
+    served from PRODUCT_DETAILS_CACHE (keys are UPPER(TRIM()) only).
+    """
+    return PRODUCT_DETAILS_CACHE.info(product_codes)
+
+
+# ========================= CORE ANALYSIS =========================
+# Two engines produce the same summary_per_group / green_sheet / red_sheet:
+#   - "columnar" (default): one groupby over (Site, ClientCode, AVOMaterialNo,
+#     Interval) x ForecastDate, comparisons done on NumPy arrays;
+#   - "rows": the original dict-per-row implementation, kept as a fallback.
+# Row order inside a week comparison is first-appearance order in the columnar
+# engine; the rows engine iterates a set, so its order was never stable.
+
+EDI_ANALYSIS_ENGINE = os.environ.get("EDI_ANALYSIS_ENGINE", "columnar").strip().lower()
+# "python": fetch raw EDIGlobal rows; "sql": bucket + SUM in PostgreSQL (multi-week /edi-analysis)
+EDI_ANALYSIS_AGGREGATION = os.environ.get("EDI_ANALYSIS_AGGREGATION", "python").strip().lower()
+
+_INTERVAL_LABELS = np.array(["W-1 to W", "W+2 to W+5", "W+6 to W+14", "W+15 to W+24", "W+25 and more"], dtype=object)
+
+
+def build_in_transit_map(delivery_rows: List[dict]) -> Dict[str, Dict[str, float]]:
+    """Effective In-Transit per (Site) -> { Product -> qty }: InTransit + Dispatched - Delivered, clamped at 0."""
+    in_transit_map: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    for d in delivery_rows:
+        site = (d.get("Site") or "").strip()
+        prod = (d.get("AVOMaterialNo") or "").strip()  # ClientMaterialNo removed
+        if not site or not prod:
+            continue
+        try:
+            qty = float(d.get("Quantity", 0) or 0)
+        except (ValueError, TypeError):
+            qty = 0.0
+        status_norm = str(d.get("Status","")).strip().upper().replace(" ", "")
+        if status_norm in {"INTRANSIT", "DISPATCHED"}:
+            in_transit_map[site][prod] += qty
+        elif status_norm == "DELIVERED":
+            in_transit_map[site][prod] -= qty
+    # clamp negatives
+    for site, m in in_transit_map.items():
+        for p in list(m.keys()):
+            if m[p] < 0:
+                m[p] = 0.0
+    debug_dump_intransit_map_site_only(in_transit_map)
+    return in_transit_map
+
+
+def run_edi_analysis(
+    edi_rows: List[dict],
+    delivery_rows: Optional[List[dict]],
+    product_info: Dict[str, Dict[str, Any]],
+    pre_aggregated: bool = False,
+    in_transit_map: Optional[Dict[str, Dict[str, float]]] = None,
+) -> Dict[str, Any]:
+    """
+    pre_aggregated: edi_rows come from fetch_ediglobal_aggregated (Interval already set, columnar only).
+    in_transit_map: from load_in_transit_map; when given, delivery_rows is not used.
+    """
+    if EDI_ANALYSIS_ENGINE == "rows" and not pre_aggregated:
+        return run_edi_analysis_rows(edi_rows, delivery_rows, product_info, in_transit_map)
+    return run_edi_analysis_columnar(edi_rows, delivery_rows, product_info, pre_aggregated, in_transit_map)
+
+
+def _week_columns(values: List[Any]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Normalized week string, year, week and validity for a column of raw week
+    values. The scalar helpers run once per distinct value, not per row.
+    """
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    norm = [norm_week_str(u) for u in uniques] + [norm_week_str(None)]   # code -1 (NA) -> last slot
+    parsed = [parse_year_week(n) if n else None for n in norm]
+    norm_arr = np.array(norm, dtype=object)[codes]
+    year = np.array([p[0] if p else 0 for p in parsed], dtype=np.int64)[codes]
+    week = np.array([p[1] if p else 0 for p in parsed], dtype=np.int64)[codes]
+    valid = np.array([p is not None for p in parsed], dtype=bool)[codes]
+    return norm_arr, year, week, valid
+
+
+def _edi_quantity(v) -> float:
+    # same coercion as group_and_sum: unparsable quantities contribute nothing
+    try:
+        return float(v or 0)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def run_edi_analysis_columnar(
+    edi_rows: List[dict],
+    delivery_rows: Optional[List[dict]],
+    product_info: Dict[str, Dict[str, Any]],
+    pre_aggregated: bool = False,
+    in_transit_map: Optional[Dict[str, Dict[str, float]]] = None,
+) -> Dict[str, Any]:
+    key_cols = ["Site", "ClientCode", "AVOMaterialNo"]
+    cols = {c: [r.get(c) for r in edi_rows] for c in key_cols}
+
+    ref_norm, ref_year, ref_week, ref_valid = _week_columns([r.get("ForecastDate") for r in edi_rows])
+
+    all_ref_weeks = sorted({w for w in ref_norm if w}, key=week_order_key)
+    if len(all_ref_weeks) < 2:
+        raise ValueError(f"Cumulative analysis requires at least 2 forecast weeks, found {len(all_ref_weeks)}.")
+
+    if pre_aggregated:
+        interval = np.array([r.get("Interval") for r in edi_rows], dtype=object)
+    else:
+        # Interval per row (get_interval on DateFrom - ForecastDate, vectorized)
+        _, row_year, row_week, row_valid = _week_columns([r.get("DateFrom") for r in edi_rows])
+        diff = (row_year - ref_year) * 52 + (row_week - ref_week)
+        has_diff = ref_valid & row_valid
+        interval = np.where(
+            has_diff,
+            _INTERVAL_LABELS[np.select(
+                [diff <= 1, diff <= 5, diff <= 14, diff <= 24], [0, 1, 2, 3], default=4
+            )],
+            "BackLog",
+        ).astype(object)
+
+    # Only rows of a reference week take part (ForecastDate None is never compared)
+    in_scope = np.flatnonzero(np.array([w is not None for w in ref_norm], dtype=bool))
+    frame = pd.DataFrame({
+        "Site": pd.Series(cols["Site"], dtype=object).iloc[in_scope].to_numpy(),
+        "ClientCode": pd.Series(cols["ClientCode"], dtype=object).iloc[in_scope].to_numpy(),
+        "AVOMaterialNo": pd.Series(cols["AVOMaterialNo"], dtype=object).iloc[in_scope].to_numpy(),
+        "Interval": interval[in_scope],
+    })
+    key_code = frame.groupby(key_cols + ["Interval"], sort=False, dropna=False).ngroup().to_numpy()
+    week_index = {w: i for i, w in enumerate(all_ref_weeks)}
+    week_code = np.array([week_index[w] for w in ref_norm[in_scope]], dtype=np.int64)
+    qty = np.array([_edi_quantity(edi_rows[i].get("Quantity", 0)) for i in in_scope], dtype=float)
+
+    n_keys = int(key_code.max()) + 1
+    n_weeks = len(all_ref_weeks)
+    totals = np.zeros((n_keys, n_weeks))
+    np.add.at(totals, (key_code, week_code), qty)     # sequential, same float result as the row loop
+    present = np.zeros((n_keys, n_weeks), dtype=bool)
+    present[key_code, week_code] = True
+
+    # Key values (original objects) from the first row of each group
+    _, first_row = np.unique(key_code, return_index=True)
+    keys = [
+        (cols["Site"][i], cols["ClientCode"][i], cols["AVOMaterialNo"][i], interval[i])
+        for i in in_scope[first_row]
+    ]
+
+    if in_transit_map is None:
+        in_transit_map = build_in_transit_map(delivery_rows)
+
+    # Per-key constants
+    key_meta = []
+    for site, client, product, intv in keys:
+        prod_key = str(product or "").strip()
+        info = product_info.get(prod_key.upper())
+        key_meta.append((
+            interval_week_diff(intv),
+            get_allowed_change(intv),
+            in_transit_map.get(site, {}).get(str(product), 0.0),
+            info.get("Line") if info else None,
+            info.get("WeeklyCapacity") if info else None,
+        ))
+
+    detailed_report: List[dict] = []
+    total_diff = np.zeros(n_keys)
+    coverage_rows = coverage_issues = 0
+
+    for i in range(n_weeks - 1):
+        w1_ref, w2_ref = all_ref_weeks[i], all_ref_weeks[i + 1]
+        comparison = f"{w1_ref}_vs_{w2_ref}"
+        in_pair = present[:, i] | present[:, i + 1]
+        differences = totals[:, i + 1] - totals[:, i]
+        total_diff += np.where(in_pair, differences, 0.0)
+
+        idx = np.flatnonzero(in_pair)
+        for k, q1, q2, difference in zip(
+            idx.tolist(), totals[idx, i].tolist(), totals[idx, i + 1].tolist(), differences[idx].tolist()
+        ):
+            site, client, product, intv = keys[k]
+            week_diff_val, allowed_change, in_transit, line, cap = key_meta[k]
+
+            variation_pct = round(100 * (difference / q1), 2) if q1 > 0 else 0.0
+            violation = abs(variation_pct) > allowed_change
+            coverage_ok = in_transit >= q2
+            if intv == "W-1 to W":
+                coverage_rows += 1
+                coverage_issues += not coverage_ok
 
-    conn = get_pg_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, params)
-            cols = [c.name for c in cur.description]
-            rows = [dict(zip(cols, r)) for r in cur.fetchall()]
-            debug_dump_deliveries("RAW", rows)
-            return rows
-    finally:
-        conn.close()
+            detailed_report.append({
+                "Week_Comparison": comparison,
+                "Site": site,
+                "ClientCode": client,
+                "AVOMaterialNo": product,
+                "Interval": intv,
+                "Interval_Week_Diff": week_diff_val,
+                "Quantity_W1": q1,
+                "Quantity_W2": q2,
+                "Difference": difference,
+                "Variation_Pct": f"{variation_pct}%",
+                "Allowed_Change_%": allowed_change,
+                "Violation": violation,
+                "InTransit": in_transit,
+                "Required_W": q2,
+                "Coverage_OK": coverage_ok,
+                "Delivery_Issue": not coverage_ok,
+                "Line": line,
+                "WeeklyCapacity": cap,
+            })
 
-def fetch_deliverydetails(
-    weeks: List[str],                 # kept for signature compatibility
-    product_codes: Optional[List[str]],
-    sites: Optional[List[str]],
-) -> List[dict]:
-    # Return ALL relevant delivery rows (no week filter)
-    return fetch_deliverydetails_raw(product_codes, sites)
+    _log("[COV:MULTI] W-1 to W rows=%d delivery_issues=%d", coverage_rows, coverage_issues)
 
-# ========================= DB FETCHERS =========================
-def fetch_productdetails_map(
-    product_codes: Optional[List[str]],
-) -> Dict[str, Dict[str, Any]]:
-    """
-    Return a mapping: AVOMaterialNo -> {"Line": <str or None>, "WeeklyCapacity": <float or None>}
-    Keys are added in both raw and UPPER() forms to ease lookups.
-    """
-    sql = 'SELECT "AVOMaterialNo","Line","WeeklyCapacity" FROM "ProductDetails"'
-    params: List[Any] = []
-    if product_codes:
-        sql += ' WHERE "AVOMaterialNo" = ANY(%s)'
-        params.append(product_codes)
+    # Summary: one row per key, straight from the arrays
+    summary_per_group = []
+    for k, (start_q, end_q, diff_total) in enumerate(zip(
+        totals[:, 0].tolist(), totals[:, -1].tolist(), total_diff.tolist()
+    )):
+        site, client, product, intv = keys[k]
+        total_pct_var = round(100 * (end_q - start_q) / start_q, 2) if start_q > 0 else 0.0
+        summary_per_group.append({
+            "Site": site,
+            "ClientCode": client,
+            "AVOMaterialNo": product,
+            "Interval": intv,
+            "Total_Cumulated_Quantity_Difference": diff_total,
+            "Total_Cumulated_Percentage_Variation": f"{total_pct_var}%"
+        })
 
-    conn = get_pg_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, params)
-            rows = cur.fetchall()
-            out: Dict[str, Dict[str, Any]] = {}
-            for avo, line, cap in rows:
-                key_raw = str(avo or "").strip()
-                key_up  = key_raw.upper()
-                rec = {
-                    "Line": line,
-                    "WeeklyCapacity": float(cap) if cap is not None else None,
-                }
-                if key_raw:
-                    out[key_raw] = rec
-                    out[key_up]  = rec
-            return out
-    finally:
-        conn.close()
+    # Every violation is red (W-1 to W has 0% tolerance); the rest is green
+    green_sheet = [r for r in detailed_report if r["Violation"] is False]
+    red_sheet = [r for r in detailed_report if r["Violation"] is True]
 
+    return {"summary_per_group": summary_per_group, "green_sheet": green_sheet, "red_sheet": red_sheet}
 
-# ========================= CORE ANALYSIS =========================
 
-def run_edi_analysis(
+def run_edi_analysis_rows(
     edi_rows: List[dict],
-    delivery_rows: List[dict],
+    delivery_rows: Optional[List[dict]],
     product_info: Dict[str, Dict[str, Any]],
+    in_transit_map: Optional[Dict[str, Dict[str, float]]] = None,
 ) -> Dict[str, Any]:
     # Normalize weeks + intervals on EDI
     for r in edi_rows:
@@ -3678,30 +6031,12 @@ def run_edi_analysis(
         rows_by_refweek[ref_w].append(r)
 
     # ---- Effective In-Transit: (Site) -> { Product -> qty } ----
-    in_transit_map: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
-    for d in delivery_rows:
-        site = (d.get("Site") or "").strip()
-        prod = (d.get("AVOMaterialNo") or "").strip()  # ClientMaterialNo removed
-        if not site or not prod:
-            continue
-        try:
-            qty = float(d.get("Quantity", 0) or 0)
-        except (ValueError, TypeError):
-            qty = 0.0
-        status_norm = str(d.get("Status","")).strip().upper().replace(" ", "")
-        if status_norm in {"INTRANSIT", "DISPATCHED"}:
-            in_transit_map[site][prod] += qty
-        elif status_norm == "DELIVERED":
-            in_transit_map[site][prod] -= qty
-    # clamp negatives
-    for site, m in in_transit_map.items():
-        for p in list(m.keys()):
-            if m[p] < 0:
-                m[p] = 0.0
-    debug_dump_intransit_map_site_only(in_transit_map)
+    if in_transit_map is None:
+        in_transit_map = build_in_transit_map(delivery_rows)
 
     detailed_report: List[dict] = []
     all_quantities_by_key: Dict[Tuple[str, str, str, str], Dict[str, float]] = defaultdict(dict)
+    rows_by_key: Dict[Tuple[str, str, str, str], List[dict]] = defaultdict(list)
 
     for i in range(len(all_ref_weeks) - 1):
         w1_ref, w2_ref = all_ref_weeks[i], all_ref_weeks[i + 1]
@@ -3736,7 +6071,7 @@ def run_edi_analysis(
 
             # ---- attach product meta (Line, WeeklyCapacity)
             prod_key = str(product or "").strip()
-            info = product_info.get(prod_key) or product_info.get(prod_key.upper())
+            info = product_info.get(prod_key.upper())
             line = info.get("Line") if info else None
             cap  = info.get("WeeklyCapacity") if info else None
 
@@ -3774,16 +6109,14 @@ def run_edi_analysis(
                 debug_log_coverage_row("MULTI", site, str(product), interval, w2_ref, required_w, in_transit, coverage_ok)
 
             detailed_report.append(row)
+            rows_by_key[key].append(row)
 
-    # Summary (unchanged)
+    # Summary: rows were indexed by key as they were produced (one pass, not keys x rows)
     summary_per_group = []
     start_ref, end_ref = all_ref_weeks[0], all_ref_weeks[-1]
     for key, weekly_quantities in all_quantities_by_key.items():
         site, client, product, interval = key
-        group_rows = [
-            r for r in detailed_report
-            if r["Site"] == site and r["ClientCode"] == client and r["AVOMaterialNo"] == product and r["Interval"] == interval
-        ]
+        group_rows = rows_by_key[key]
         total_diff = sum(r["Difference"] for r in group_rows)
         start_q = float(weekly_quantities.get(start_ref, 0.0))
         end_q   = float(weekly_quantities.get(end_ref, 0.0))
@@ -3818,8 +6151,9 @@ def run_edi_analysis(
 
 def analyze_single_week(
     edi_rows: List[dict],
-    delivery_rows: List[dict],
+    delivery_rows: Optional[List[dict]],
     product_info: Dict[str, Dict[str, Any]],
+    in_transit_map: Optional[Dict[str, Dict[str, float]]] = None,
 ) -> Dict[str, Any]:
     for r in edi_rows:
         r["ForecastDate"] = norm_week_str(r.get("ForecastDate"))
@@ -3833,26 +6167,8 @@ def analyze_single_week(
         r["Interval"] = get_interval(week_diff(r["DateFrom"], r["ForecastDate"]))
 
     # ---- Effective In-Transit: (Site) -> { Product -> qty } ----
-    in_transit_map: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
-    for d in delivery_rows:
-        site = (d.get("Site") or "").strip()
-        prod = (d.get("AVOMaterialNo") or "").strip()  # ClientMaterialNo removed
-        if not site or not prod:
-            continue
-        try:
-            qty = float(d.get("Quantity", 0) or 0)
-        except (ValueError, TypeError):
-            qty = 0.0
-        status_norm = str(d.get("Status","")).strip().upper().replace(" ", "")
-        if status_norm in {"INTRANSIT", "DISPATCHED"}:
-            in_transit_map[site][prod] += qty
-        elif status_norm == "DELIVERED":
-            in_transit_map[site][prod] -= qty
-    for site, m in in_transit_map.items():
-        for p in list(m.keys()):
-            if m[p] < 0:
-                m[p] = 0.0
-    debug_dump_intransit_map_site_only(in_transit_map)
+    if in_transit_map is None:
+        in_transit_map = build_in_transit_map(delivery_rows)
 
     group_keys = ["Site","ClientCode","AVOMaterialNo","Interval"]
     grouped = group_and_sum([r for r in edi_rows if r["ForecastDate"] == w_ref], group_keys, "Quantity")
@@ -3864,7 +6180,7 @@ def analyze_single_week(
 
         # ---- attach product meta (Line, WeeklyCapacity)
         prod_key = str(product or "").strip()
-        info = product_info.get(prod_key) or product_info.get(prod_key.upper())
+        info = product_info.get(prod_key.upper())
         line = info.get("Line") if info else None
         cap  = info.get("WeeklyCapacity") if info else None
 
@@ -3933,14 +6249,19 @@ def process_file_endpoint_monterrey_nidec_elpaso():
     except Exception as e:
         return jsonify({"error": f"Invalid base64. Detail: {e}"}), 400
 
+    return _process_monterrey_elpaso_pdf(file_name, pdf_bytes)
+
+
+def _process_monterrey_elpaso_pdf(file_name, pdf_bytes):
     # Detect correct PDF
-    text_preview = parse_pdf(io.BytesIO(pdf_bytes))[:1000]
+    pdf_doc = open_request_pdf(pdf_bytes, file_name)
+    text_preview = pdf_doc.pypdf_text()[:1000]
 
     if "NIDEC PART NUMBER" not in text_preview:
         return jsonify({"error": "Unsupported PDF (not Nidec Automotive format)."}), 400
 
     # Extract records
-    extracted_records = process_nidec_elpaso_monterrey_pdf(pdf_bytes, file_name)
+    extracted_records = process_nidec_elpaso_monterrey_pdf(pdf_doc, file_name)
 
     if not extracted_records:
         return jsonify({"error": "No records extracted for Monterrey Nidec El Paso."}), 422
@@ -3965,6 +6286,16 @@ def process_file_endpoint_monterrey_nidec_elpaso():
         logging.exception("[Monterrey Nidec El Paso] Database error")
         return jsonify({"error": f"Database error: {e}"}), 400
 
+def _monterrey_pdf_not_supported(file_name):
+    return jsonify({
+        "file_processed": file_name,
+        "site": "Monterrey",
+        "file_type": "pdf",
+        "file_recognition": False,
+        "reason": "monterrey_ti_csv_only"
+    }), 200
+
+
 @app.route("/detect-client-info-monterrey", methods=["POST"])
 def detect_client_info_monterrey():
     data = request.get_json()
@@ -3975,28 +6306,31 @@ def detect_client_info_monterrey():
 
     file_name = data['file_name']
     b64 = data['file_content_base64']
-    file_ext = os.path.splitext(file_name)[1] or ".dat"
 
     # Monterrey TI: CSV only
     if file_name.lower().endswith(".pdf") or data.get("file_type") == "pdf":
-        return jsonify({
-            "file_processed": file_name,
-            "site": "Monterrey",
-            "file_type": "pdf",
-            "file_recognition": False,
-            "reason": "monterrey_ti_csv_only"
-        }), 200
+        return _monterrey_pdf_not_supported(file_name)
 
     try:
         csv_text = decode_and_clean_csv(b64)
     except Exception as e:
-        return jsonify({
-            "file_processed": file_name,
-            "site": "Monterrey",
-            "file_type": "csv",
-            "file_recognition": False,
-            "reason": f"csv_decode_failed: {e}"
-        }), 200
+        return _monterrey_csv_decode_failed(file_name, e)
+
+    return _detect_monterrey_csv(file_name, csv_text)
+
+
+def _monterrey_csv_decode_failed(file_name, e):
+    return jsonify({
+        "file_processed": file_name,
+        "site": "Monterrey",
+        "file_type": "csv",
+        "file_recognition": False,
+        "reason": f"csv_decode_failed: {e}"
+    }), 200
+
+
+def _detect_monterrey_csv(file_name, csv_text):
+    file_ext = os.path.splitext(file_name)[1] or ".dat"
 
     if "TI Fluid Systems Supplier Schedule" not in (csv_text or ""):
         return jsonify({
@@ -4038,6 +6372,10 @@ def process_file_endpoint_monterrey():
     except Exception as e:
         return jsonify({"error": f"Invalid Base64/CSV content. Detail: {e}"}), 400
 
+    return _process_monterrey_csv(file_name, csv_text)
+
+
+def _process_monterrey_csv(file_name, csv_text):
     # 2) Detect TI CARO
     if "TI Fluid Systems Supplier Schedule" not in (csv_text or ""):
         return jsonify({"error": "Unsupported Monterrey file (not TI Fluid Systems Supplier Schedule)."}), 400
@@ -4106,41 +6444,583 @@ def process_file_endpoint_monterrey():
 
                 row = new_row
 
-                logging.warning(f"[Monterrey TI] Fixed comma-split Item Description: {merged_item}")
+                logging.warning(f"[Monterrey TI] Fixed comma-split Item Description: {merged_item}")
+
+            fixed_rows.append(row)
+
+        data_rows = fixed_rows
+
+    except Exception as e:
+        return jsonify({"error": f"CSV parsing error: {e}"}), 400
+
+    # 4) Extract
+    extracted_records = process_monterrey_ti_caro_rows(data_rows, header)
+    if not extracted_records:
+        return jsonify({"error": "No records extracted for Monterrey TI CARO."}), 422
+
+    # 5) Save to DB (keep your existing DB logic)
+    try:
+        success_count, error_details = save_to_postgres_with_conflict_reporting(extracted_records)
+        return jsonify({
+            "message": "Monterrey TI CARO processing completed.",
+            "file_processed": file_name,
+            "company_detected": "TI AUTOMOTIVE CARO (Monterrey)",
+            "client_code": "9100",
+            "site": "Monterrey",
+            "records_processed": len(extracted_records),
+            "records_inserted": success_count,
+            "records_failed": len(error_details),
+            "errors": error_details
+        }), (200 if success_count > 0 else 400)
+
+    except Exception as e:
+        logging.exception("[Monterrey TI CARO] Database error")
+        return jsonify({"error": f"Database error: {e}"}), 400
+
+# ========================= STREAMING UPLOAD ROUTES =========================
+# Same contracts as the base64/JSON routes above, but the file arrives as
+# multipart/form-data (field "file") or as a raw application/octet-stream body,
+# so we never hold the JSON text + base64 string + decoded bytes at once.
+# Werkzeug spools multipart files above 500 KB to a temp file; we read it once.
+
+def _read_upload():
+    """
+    Returns (file_name, file_bytes, file_type, error_response).
+    - multipart/form-data : "file" part, optional "file_name"/"file_type" form fields
+    - raw body            : ?file_name=...&file_type=... or X-File-Name / X-File-Type headers
+    """
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("file")
+        if upload is None:
+            return None, None, None, (jsonify({"error": "Missing 'file' part in multipart body."}), 400)
+        file_name = request.form.get("file_name") or upload.filename
+        file_type = request.form.get("file_type")
+        file_bytes = upload.read()
+    else:
+        file_name = request.args.get("file_name") or request.headers.get("X-File-Name")
+        file_type = request.args.get("file_type") or request.headers.get("X-File-Type")
+        file_bytes = request.get_data(cache=False)
+
+    if not file_name:
+        return None, None, None, (jsonify({"error": "Missing file_name (form field, query parameter or X-File-Name header)."}), 400)
+    if not file_bytes:
+        return None, None, None, (jsonify({"error": "Empty upload body."}), 400)
+    return file_name, file_bytes, file_type, None
+
+
+@app.route("/upload/process-TunisiaSite", methods=["POST"])
+def upload_process_tunisia():
+    file_name, file_bytes, file_type, error = _read_upload()
+    if error:
+        return error
+    return _process_tunisia_file(file_name, file_bytes, file_type)
+
+
+@app.route("/upload/detect-client-info", methods=["POST"])
+def upload_detect_client_info():
+    file_name, file_bytes, _, error = _read_upload()
+    if error:
+        return error
+    return _detect_tunisia_file(file_name, file_bytes)
+
+
+@app.route("/upload/process-GermanySite", methods=["POST"])
+def upload_process_germany():
+    file_name, file_bytes, file_type, error = _read_upload()
+    if error:
+        return error
+    return _process_germany_file(file_name, file_bytes, file_type)
+
+
+@app.route("/upload/process-MonterreyNidecElPaso", methods=["POST"])
+def upload_process_monterrey_nidec_elpaso():
+    file_name, file_bytes, _, error = _read_upload()
+    if error:
+        return error
+    if not file_name.lower().endswith(".pdf"):
+        return jsonify({"error": "Nidec El Paso route supports PDF only."}), 400
+    return _process_monterrey_elpaso_pdf(file_name, file_bytes)
+
+
+@app.route("/upload/detect-client-info-monterrey", methods=["POST"])
+def upload_detect_client_info_monterrey():
+    file_name, file_bytes, file_type, error = _read_upload()
+    if error:
+        return error
+    if file_name.lower().endswith(".pdf") or file_type == "pdf":
+        return _monterrey_pdf_not_supported(file_name)
+    try:
+        csv_text = clean_csv_bytes(file_bytes)
+    except Exception as e:
+        return _monterrey_csv_decode_failed(file_name, e)
+    return _detect_monterrey_csv(file_name, csv_text)
+
+
+@app.route("/upload/process-MonterreySite", methods=["POST"])
+def upload_process_monterrey():
+    file_name, file_bytes, file_type, error = _read_upload()
+    if error:
+        return error
+    if file_name.lower().endswith(".pdf") or file_type == "pdf":
+        return jsonify({"error": "Monterrey TI route supports CSV only."}), 400
+    try:
+        csv_text = clean_csv_bytes(file_bytes)
+    except Exception as e:
+        return jsonify({"error": f"Invalid Base64/CSV content. Detail: {e}"}), 400
+    return _process_monterrey_csv(file_name, csv_text)
+
+
+# ========================= INGESTION JOBS =========================
+# Slow uploads (OCR round trip, heavy pdfplumber tables, large DB merges) can be
+# submitted as a job instead: POST /jobs/<route> returns a job id at once and
+# GET /jobs/<job_id> reports the stage and, when done, the same JSON the
+# synchronous route would have returned. Jobs run on a small bounded thread pool
+# inside this worker process, so the registry is per process as well.
+
+INGEST_JOB_WORKERS = int(os.environ.get("INGEST_JOB_WORKERS", "2"))
+INGEST_JOB_QUEUE_MAX = int(os.environ.get("INGEST_JOB_QUEUE_MAX", "20"))       # queued + running
+INGEST_JOB_RETENTION = int(os.environ.get("INGEST_JOB_RETENTION", "3600"))     # seconds a finished job stays pollable
+
+_ingest_executor = None
+_ingest_executor_pid = None
+_ingest_jobs: Dict[str, Dict[str, Any]] = {}
+_ingest_jobs_lock = threading.Lock()
+_job_local = threading.local()
+
+
+def _get_ingest_executor() -> ThreadPoolExecutor:
+    global _ingest_executor, _ingest_executor_pid
+    pid = os.getpid()
+    if _ingest_executor is None or _ingest_executor_pid != pid:
+        with _ingest_jobs_lock:
+            if _ingest_executor is None or _ingest_executor_pid != pid:
+                _ingest_executor = ThreadPoolExecutor(
+                    max_workers=INGEST_JOB_WORKERS, thread_name_prefix="ingest-job"
+                )
+                _ingest_executor_pid = pid
+                _ingest_jobs.clear()
+    return _ingest_executor
+
+
+def _update_job(job: Dict[str, Any], **fields):
+    """Job dicts are read by GET /jobs/<id>; every write goes through the registry lock."""
+    with _ingest_jobs_lock:
+        job.update(fields)
+
+
+def set_job_stage(stage: str):
+    """Record the current stage of the ingestion job running on this thread (no-op otherwise)."""
+    job = getattr(_job_local, "job", None)
+    if job is not None:
+        _update_job(job, stage=stage, updated_at=datetime.utcnow().isoformat() + "Z")
+
+
+def _job_monterrey_elpaso(file_name, file_bytes, file_type=None):
+    if not file_name.lower().endswith(".pdf"):
+        return jsonify({"error": "Nidec El Paso route supports PDF only."}), 400
+    return _process_monterrey_elpaso_pdf(file_name, file_bytes)
+
+
+def _job_monterrey_csv(file_name, file_bytes, file_type=None):
+    if file_name.lower().endswith(".pdf") or file_type == "pdf":
+        return jsonify({"error": "Monterrey TI route supports CSV only."}), 400
+    try:
+        csv_text = clean_csv_bytes(file_bytes)
+    except Exception as e:
+        return jsonify({"error": f"Invalid Base64/CSV content. Detail: {e}"}), 400
+    return _process_monterrey_csv(file_name, csv_text)
+
+
+INGEST_JOB_HANDLERS = {
+    "process-TunisiaSite": _process_tunisia_file,
+    "process-GermanySite": _process_germany_file,
+    "process-MonterreyNidecElPaso": _job_monterrey_elpaso,
+    "process-MonterreySite": _job_monterrey_csv,
+}
+
+
+def _purge_finished_jobs():
+    cutoff = time.monotonic() - INGEST_JOB_RETENTION
+    with _ingest_jobs_lock:
+        for job_id in [j for j, job in _ingest_jobs.items() if job.get("_finished") and job["_finished"] < cutoff]:
+            del _ingest_jobs[job_id]
+
+
+def _public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in job.items() if not k.startswith("_")}
+
+
+def _run_ingest_job(job: Dict[str, Any], handler, file_name, file_bytes, file_type):
+    _job_local.job = job
+    _update_job(job, status="running", started_at=datetime.utcnow().isoformat() + "Z")
+    set_job_stage("parsing")
+    try:
+        # Handlers build their responses with jsonify() and keep per-request PDFs on g
+        with app.test_request_context(f"/jobs/{job['job_id']}", method="POST"):
+            rv = handler(file_name, file_bytes, file_type)
+            resp, http_status = rv if isinstance(rv, tuple) else (rv, rv.status_code)
+            body = resp.get_json(silent=True)
+
+        outcome = {
+            "http_status": http_status,
+            "result": body,
+            "status": "succeeded" if http_status < 400 else "failed",
+        }
+        if isinstance(body, dict):
+            for key in ("records_processed", "records_inserted", "records_failed"):
+                if key in body:
+                    outcome[key] = body[key]
+        _update_job(job, **outcome)
+    except Exception as e:
+        logging.exception(f"Ingestion job {job['job_id']} crashed")
+        _update_job(job, status="failed", http_status=500, result={"error": str(e)})
+    finally:
+        _update_job(
+            job,
+            stage="done",
+            finished_at=datetime.utcnow().isoformat() + "Z",
+            _finished=time.monotonic(),
+        )
+        _job_local.job = None
+
+
+@app.route("/jobs/<route_name>", methods=["POST"])
+def submit_ingest_job(route_name):
+    """
+    Accepts the same bodies as the synchronous routes: JSON with
+    file_name/file_content_base64[/file_type], multipart "file", or a raw
+    application/octet-stream body. Returns 202 with the job id.
+    """
+    handler = INGEST_JOB_HANDLERS.get(route_name)
+    if handler is None:
+        return jsonify({"error": f"Unknown ingestion route: {route_name}",
+                        "supported": sorted(INGEST_JOB_HANDLERS)}), 404
+
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        required_keys = ['file_name', 'file_content_base64']
+        missing_keys = [k for k in required_keys if k not in data]
+        if missing_keys:
+            return jsonify({"error": f"Missing keys in request body: {', '.join(missing_keys)}"}), 400
+        file_name = data['file_name']
+        file_type = data.get('file_type', None)
+        try:
+            file_bytes = base64.b64decode(data['file_content_base64'])
+        except Exception as e:
+            return jsonify({"error": f"Invalid Base64 content. Detail: {e}"}), 400
+    else:
+        file_name, file_bytes, file_type, error = _read_upload()
+        if error:
+            return error
+
+    _purge_finished_jobs()
+    executor = _get_ingest_executor()
+    with _ingest_jobs_lock:
+        active = sum(1 for job in _ingest_jobs.values() if job["status"] in ("queued", "running"))
+        if active >= INGEST_JOB_QUEUE_MAX:
+            resp = jsonify({"error": "Ingestion queue is full, retry later.", "active_jobs": active})
+            resp.headers["Retry-After"] = "30"
+            return resp, 503
+
+        job_id = uuid.uuid4().hex
+        # Every key exists from the start: the worker only overwrites values
+        job = {
+            "job_id": job_id,
+            "route": route_name,
+            "file_name": file_name,
+            "status": "queued",
+            "stage": "queued",
+            "submitted_at": datetime.utcnow().isoformat() + "Z",
+            "started_at": None,
+            "updated_at": None,
+            "finished_at": None,
+            "http_status": None,
+            "result": None,
+            "records_processed": None,
+            "records_inserted": None,
+            "records_failed": None,
+            "_finished": None,
+        }
+        _ingest_jobs[job_id] = job
+
+    executor.submit(_run_ingest_job, job, handler, file_name, file_bytes, file_type)
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_ingest_job(job_id):
+    _purge_finished_jobs()
+    with _ingest_jobs_lock:
+        job = _ingest_jobs.get(job_id)
+        payload = _public_job(job) if job else None
+    if payload is None:
+        return jsonify({"error": "Unknown or expired job id."}), 404
+    return jsonify(payload), 200
+
+
+# ========================= BATCH UPLOADS =========================
+# The Monday mailbox run posts dozens of vendor files one request at a time.
+# POST /batch/<route> takes them all at once (JSON list, several multipart
+# files, or a zip archive), parses them in parallel in a process pool
+# (pdfplumber/regex parsing is CPU-bound and holds the GIL), then writes all
+# EDIGlobal rows in one transaction and all DeliveryDetails rows in another.
+
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", "100"))
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", str(200 * 1024 * 1024)))  # total, after unzip
+
+def _parse_tunisia_batch_file(file_name, file_bytes, file_type=None):
+    # OCR is a slow remote call that inserts on its own; scanned files stay on the single-file routes
+    if ((file_type == "pdf") or file_name.lower().endswith(".pdf")) and _looks_like_pdf(file_bytes):
+        pdf_doc = open_request_pdf(file_bytes, file_name)
+        if parse_cache_key("tunisia-pdf", file_bytes) not in PARSE_CACHE:
+            scan_resp, _ = is_scanned_pdf(pdf_doc, file_name)
+            if scan_resp is not None:
+                return None, [], ({
+                    "error": "Scanned PDF: OCR is not run in batch mode, submit it to "
+                             "/process-TunisiaSite or /jobs/process-TunisiaSite.",
+                    "reason": (scan_resp.get_json() or {}).get("reason"),
+                }, 422)
+        return _parse_tunisia_upload(file_name, file_bytes, file_type, pdf_doc)
+    return _parse_tunisia_upload(file_name, file_bytes, file_type)
+
+
+BATCH_PARSERS = {
+    "process-TunisiaSite": _parse_tunisia_batch_file,
+    "process-GermanySite": _parse_germany_upload,
+}
+
+
+def _parse_upload_task(route_name, file_name, file_bytes, file_type=None) -> Dict[str, Any]:
+    """Pool task: parse one upload for BATCH_PARSERS[route_name]. Returns only plain (picklable) data."""
+    parse = BATCH_PARSERS[route_name]
+    with app.test_request_context("/batch/" + route_name, method="POST"):
+        try:
+            company, records, error = parse(file_name, file_bytes, file_type)
+        except Exception as e:
+            logging.exception(f"Batch parse failed for {file_name}")
+            company, records, error = None, [], ({"error": f"Processing error: {e}"}, 500)
+    return {"file_name": file_name, "company": company, "records": records, "error": error}
+
+
+def _parse_batch(route_name, files) -> List[Dict[str, Any]]:
+    pool = _get_parse_pool()
+    if pool is None or len(files) == 1:
+        return [run_in_parse_pool(_parse_upload_task, route_name, *f) for f in files]
+
+    def failed(file_name, message):
+        return {"file_name": file_name, "company": None, "records": [], "error": ({"error": message}, 500)}
+
+    def parse_again(f):
+        # the pool broke under this file (another child killed or crashed): fresh pool
+        try:
+            return run_in_parse_pool(_parse_upload_task, route_name, *f)
+        except ParseTimeoutError as e:
+            return failed(f[0], f"Processing error: {e}")
+        except Exception as e:
+            return failed(f[0], f"Parse worker failed: {e}")
+
+    try:
+        tasks = [_submit_parse_task(pool, _parse_upload_task, (route_name, *f), PARSE_POOL_TIMEOUT) for f in files]
+    except BrokenProcessPool:
+        _reset_parse_pool(pool)
+        return [parse_again(f) for f in files]
+
+    parsed = []
+    for task, f in zip(tasks, files):
+        try:
+            parsed.append(_wait_parse_task(pool, *task, PARSE_POOL_TIMEOUT))
+        except ParseTimeoutError as e:
+            logging.warning(f"[BATCH] parsing {f[0]} exceeded {PARSE_POOL_TIMEOUT:g}s")
+            parsed.append(failed(f[0], f"Processing error: {e}"))
+        except (BrokenProcessPool, CancelledError):
+            _reset_parse_pool(pool)
+            parsed.append(parse_again(f))
+        except Exception as e:
+            parsed.append(failed(f[0], f"Processing error: {e}"))
+    return parsed
+
+
+def _expand_zip(archive_bytes, archive_name, budget):
+    """Returns ([(file_name, file_bytes, None), ...], bytes_used) for the regular files of a zip."""
+    files, used = [], 0
+    with zipfile.ZipFile(io.BytesIO(archive_bytes)) as zf:
+        for info in zf.infolist():
+            base = os.path.basename(info.filename)
+            if info.is_dir() or not base or base.startswith(".") or info.filename.startswith("__MACOSX/"):
+                continue
+            used += info.file_size
+            if used > budget:
+                raise ValueError(f"{archive_name}: uncompressed content exceeds {BATCH_MAX_BYTES} bytes")
+            files.append((base, zf.read(info), None))
+    return files, used
+
+
+def _collect_batch_files():
+    """
+    Returns ([(file_name, file_bytes, file_type), ...], error_response).
+    - JSON      : {"files": [{"file_name", "file_content_base64", "file_type"?}, ...]} (or the bare list)
+    - multipart : any number of "files"/"file" parts; .zip parts are expanded
+    - raw body  : a zip archive (application/zip or ?file_name=....zip)
+    """
+    entries = []
+    if request.is_json:
+        data = request.get_json(silent=True)
+        items = data.get("files") if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return None, (jsonify({"error": "Expected a non-empty 'files' list."}), 400)
+        for n, item in enumerate(items):
+            if not isinstance(item, dict) or not all(k in item for k in ("file_name", "file_content_base64")):
+                return None, (jsonify({"error": f"files[{n}] needs file_name and file_content_base64."}), 400)
+            try:
+                file_bytes = base64.b64decode(item["file_content_base64"])
+            except Exception as e:
+                return None, (jsonify({"error": f"Invalid Base64 content in files[{n}]. Detail: {e}"}), 400)
+            entries.append((item["file_name"], file_bytes, item.get("file_type")))
+    elif request.mimetype == "multipart/form-data":
+        uploads = request.files.getlist("files") + request.files.getlist("file")
+        if not uploads:
+            return None, (jsonify({"error": "Missing 'files' parts in multipart body."}), 400)
+        entries = [(u.filename, u.read(), None) for u in uploads]
+    else:
+        file_name = request.args.get("file_name") or request.headers.get("X-File-Name") or "upload.zip"
+        if request.mimetype not in ("application/zip", "application/x-zip-compressed") \
+                and not file_name.lower().endswith(".zip"):
+            return None, (jsonify({"error": "Raw batch bodies must be a zip archive."}), 400)
+        entries = [(file_name, request.get_data(cache=False), "zip")]
 
-            fixed_rows.append(row)
+    files, used = [], 0
+    try:
+        for file_name, file_bytes, file_type in entries:
+            if file_type == "zip" or (file_name or "").lower().endswith(".zip"):
+                extracted, size = _expand_zip(file_bytes, file_name, BATCH_MAX_BYTES - used)
+                files.extend(extracted)
+                used += size
+            else:
+                files.append((file_name, file_bytes, file_type))
+                used += len(file_bytes)
+            if used > BATCH_MAX_BYTES:
+                raise ValueError(f"batch content exceeds {BATCH_MAX_BYTES} bytes")
+    except (zipfile.BadZipFile, ValueError) as e:
+        return None, (jsonify({"error": f"Invalid batch upload. Detail: {e}"}), 400)
+
+    if not files:
+        return None, (jsonify({"error": "No files found in batch upload."}), 400)
+    if len(files) > BATCH_MAX_FILES:
+        return None, (jsonify({"error": f"Too many files in batch ({len(files)} > {BATCH_MAX_FILES})."}), 400)
+    return files, None
+
+
+@app.route("/batch/<route_name>", methods=["POST"])
+def process_batch(route_name):
+    if route_name not in BATCH_PARSERS:
+        return jsonify({"error": f"Unknown batch route: {route_name}",
+                        "supported": sorted(BATCH_PARSERS)}), 404
+
+    files, error = _collect_batch_files()
+    if error:
+        return error
+
+    set_job_stage("parsing")
+    parsed = _parse_batch(route_name, files)
+
+    results: List[Dict[str, Any]] = []
+    edi_records: List[dict] = []
+    edi_slices: Dict[int, Tuple[int, int]] = {}        # result index -> [start, end) in edi_records
+    delivery_frames = []
+    delivery_results: List[int] = []
+
+    for item in parsed:
+        result = {"file_processed": item["file_name"], "company_detected": item["company"]}
+        results.append(result)
+        if item["error"]:
+            body, http_status = item["error"]
+            result.update(body)
+            result["http_status"] = http_status
+            continue
 
-        data_rows = fixed_rows
+        records = item["records"]
+        if route_name == "process-TunisiaSite" and _is_delivery_company(item["company"]):
+            df, source_lines = _prepare_delivery_frame(records, item["company"])
+            if df is None:
+                result.update({"error": "No delivery/stock lines parsed", "http_status": 422})
+                continue
+            delivery_frames.append(df)
+            delivery_results.append(len(results) - 1)
+            result.update({
+                "target": "DeliveryDetails",
+                "records_processed": int(source_lines),
+                "records_inserted": int(len(df)),
+                "records_failed": 0,
+                "errors": [],
+                "http_status": 200,
+            })
+        else:
+            edi_slices[len(results) - 1] = (len(edi_records), len(edi_records) + len(records))
+            edi_records.extend(records)
+            result.update({"target": "EDIGlobal", "records_processed": len(records)})
+
+    # ---------- EDIGlobal: one transaction for the whole batch ----------
+    if edi_slices:
+        set_job_stage("saving")
+        conn = None
+        try:
+            conn = get_pg_connection()
+            with conn.cursor() as cur:
+                inserted, row_errors = _bulk_insert_ediglobal(cur, edi_records)
+            conn.commit()
+            if inserted:
+                bump_data_version("EDIGlobal")
+            failed = dict(row_errors)
+            for idx, (start, end) in edi_slices.items():
+                file_errors = [
+                    {"record": edi_records[i], "error": failed[i]} for i in range(start, end) if i in failed
+                ]
+                inserted = (end - start) - len(file_errors)
+                results[idx].update({
+                    "records_inserted": inserted,
+                    "records_failed": len(file_errors),
+                    "errors": file_errors,
+                    "http_status": 200 if inserted > 0 else 400,
+                })
+        except Exception as e:
+            logging.exception("Batch EDIGlobal insert failed")
+            if conn:
+                conn.rollback()
+            for idx in edi_slices:
+                results[idx].update({"records_inserted": 0, "error": f"Database error: {e}", "http_status": 400})
+        finally:
+            if conn:
+                conn.close()
 
-    except Exception as e:
-        return jsonify({"error": f"CSV parsing error: {e}"}), 400
+    # ---------- DeliveryDetails: one merge for the whole batch (file order preserved) ----------
+    if delivery_frames:
+        try:
+            insert_deliverydetails(pd.concat(delivery_frames, ignore_index=True))
+        except Exception as e:
+            logging.exception("Batch DeliveryDetails insert failed")
+            for idx in delivery_results:
+                results[idx].update({"records_inserted": 0, "error": f"Database error: {e}", "http_status": 400})
 
-    # 4) Extract
-    extracted_records = process_monterrey_ti_caro_rows(data_rows, header)
-    if not extracted_records:
-        return jsonify({"error": "No records extracted for Monterrey TI CARO."}), 422
+    for result in results:
+        result["status"] = "succeeded" if result["http_status"] < 400 else "failed"
 
-    # 5) Save to DB (keep your existing DB logic)
-    try:
-        success_count, error_details = save_to_postgres_with_conflict_reporting(extracted_records)
-        return jsonify({
-            "message": "Monterrey TI CARO processing completed.",
-            "file_processed": file_name,
-            "company_detected": "TI AUTOMOTIVE CARO (Monterrey)",
-            "client_code": "9100",
-            "site": "Monterrey",
-            "records_processed": len(extracted_records),
-            "records_inserted": success_count,
-            "records_failed": len(error_details),
-            "errors": error_details
-        }), (200 if success_count > 0 else 400)
+    succeeded = sum(1 for r in results if r["status"] == "succeeded")
+    return jsonify({
+        "message": "Batch processing completed.",
+        "files_received": len(results),
+        "files_succeeded": succeeded,
+        "files_failed": len(results) - succeeded,
+        "records_inserted": sum(r.get("records_inserted", 0) for r in results),
+        "results": results,
+    }), 200
 
-    except Exception as e:
-        logging.exception("[Monterrey TI CARO] Database error")
-        return jsonify({"error": f"Database error: {e}"}), 400
 
 # ========================= ROUTE =========================
 
+# Row lists of an analysis result (columnar / Arrow / Parquet output)
+EDI_ANALYSIS_SHEETS = ("summary_per_group", "green_sheet", "red_sheet")
+
+
 @app.route("/edi-analysis", methods=["POST"])
 def edi_analysis_run():
     try:
@@ -4159,13 +7039,51 @@ def edi_analysis_run():
         if bad:
             return jsonify({"status":"error","message":f"Weeks must be 'YYYY-WXX'. Bad: {bad}"}), 400
 
-        _log("[ROUTE] weeks=%s client_codes=%s product_codes=%s sites=%s",
-             weeks, client_codes, product_codes, sites)
+        # "format": columnar JSON per sheet, or one "sheet" as Arrow/Parquet bytes
+        try:
+            fmt = response_format(body)
+        except ValueError as e:
+            return jsonify({"status":"error","message":str(e)}), 400
+        sheet = str(body.get("sheet") or "").strip() or None
+        if fmt in BINARY_FORMAT_MIMETYPES and sheet not in EDI_ANALYSIS_SHEETS:
+            return jsonify({"status":"error","message":f"format '{fmt}' needs \"sheet\": one of {list(EDI_ANALYSIS_SHEETS)}"}), 400
+
+        # "aggregation": "sql" pushes interval bucketing + SUM(Quantity) into PostgreSQL
+        aggregation = str(body.get("aggregation") or EDI_ANALYSIS_AGGREGATION).strip().lower()
+        pushdown = aggregation == "sql" and len(weeks) > 1
+
+        _log("[ROUTE] weeks=%s client_codes=%s product_codes=%s sites=%s aggregation=%s",
+             weeks, client_codes, product_codes, sites, "sql" if pushdown else "python")
+
+        # Same normalized request + same data versions -> same response ("cache": false to bypass).
+        # Bodies are cached already encoded, so a hit is not compressed again.
+        cache_key = None
+        if str(body.get("cache", True)).strip().lower() not in ("false", "0", "no"):
+            encoding = negotiate_response_encoding()
+            cache_key = (
+                tuple(sorted(weeks)),
+                tuple(sorted(client_codes or ())),
+                tuple(sorted(product_codes or ())),
+                tuple(sorted(sites or ())),
+                pushdown, EDI_ANALYSIS_ENGINE, IN_TRANSIT_SOURCE,
+                data_versions("EDIGlobal", "DeliveryDetails", "ProductDetails"),
+                fmt, sheet, encoding,
+            )
+            cached = EDI_ANALYSIS_CACHE.get(cache_key)
+            if cached is not None:
+                payload, applied, mimetype, headers = cached
+                resp = encoded_response(payload, mimetype, applied)
+                resp.headers.update(headers)
+                resp.headers["X-Cache"] = "HIT"
+                return resp, 200
 
         # Fetch DB rows
-        edi_rows = fetch_ediglobal(weeks, client_codes, product_codes, sites)
+        if pushdown:
+            edi_rows = fetch_ediglobal_aggregated(weeks, client_codes, product_codes, sites)
+        else:
+            edi_rows = fetch_ediglobal(weeks, client_codes, product_codes, sites)
         debug_probe_deliverytable(product_codes, sites)
-        delivery_rows = fetch_deliverydetails(weeks, product_codes, sites)
+        in_transit_map = load_in_transit_map(weeks, product_codes, sites)
 
         # Product meta (Line, WeeklyCapacity) for relevant products
         prods_for_meta = product_codes or sorted({
@@ -4174,16 +7092,32 @@ def edi_analysis_run():
         })
         product_info = fetch_productdetails_map(prods_for_meta)
 
-        _log("[ROUTE] fetched edi_rows=%d delivery_rows=%d product_meta=%d",
-             len(edi_rows), len(delivery_rows), len(product_info))
+        _log("[ROUTE] fetched edi_rows=%d in_transit_sites=%d product_meta=%d",
+             len(edi_rows), len(in_transit_map), len(product_info))
 
         # Single-week coverage mode OR multi-week full analysis
         if len(weeks) == 1:
-            result = analyze_single_week(edi_rows, delivery_rows, product_info)
+            result = analyze_single_week(edi_rows, None, product_info, in_transit_map)
         else:
-            result = run_edi_analysis(edi_rows, delivery_rows, product_info)
-
-        return jsonify({"status":"ok","data":result}), 200
+            result = run_edi_analysis(edi_rows, None, product_info, pre_aggregated=pushdown, in_transit_map=in_transit_map)
+
+        if fmt in BINARY_FORMAT_MIMETYPES:
+            resp = tabular_response(pd.DataFrame(result.get(sheet) or []), fmt)
+        elif fmt == "columnar":
+            resp = jsonify({"status":"ok","data":{
+                k: records_to_columnar(v) if k in EDI_ANALYSIS_SHEETS else v for k, v in result.items()
+            }})
+        else:
+            resp = jsonify({"status":"ok","data":result})
+        if cache_key is not None:
+            payload, applied = compress_payload(resp.get_data(), encoding)
+            headers = {k: v for k, v in resp.headers.items() if k.startswith("X-")}
+            EDI_ANALYSIS_CACHE.put(cache_key, (payload, applied, resp.mimetype, headers), size=len(payload))
+            if applied:
+                resp.set_data(payload)
+                resp.headers["Content-Encoding"] = applied
+            resp.headers["X-Cache"] = "MISS"
+        return resp, 200
 
     except Exception as e:
         return jsonify({"status":"error","message":str(e)}), 500
@@ -4252,6 +7186,39 @@ def _extract_body():
 app.logger.setLevel(logging.INFO)
 
 
+# Planner refreshes repeat the same product sets; stock is read from
+# ProductStockTotals (migration 9) and kept for a short TTL per set.
+PRODUCT_STOCK_CACHE = TTLCache(
+    "product_stock",
+    ttl_seconds=float(os.environ.get("PRODUCT_STOCK_CACHE_TTL", "30")),
+    max_entries=int(os.environ.get("PRODUCT_STOCK_CACHE_MAX_ENTRIES", "256")),
+)
+
+
+def fetch_product_stock_totals(product_codes: List[str]) -> Dict[str, Any]:
+    """ProductCode -> summed ProductStock Quantity (products without stock are absent)."""
+    conn = get_pg_connection()
+    try:
+        with conn.cursor() as cur:
+            try:
+                cur.execute(
+                    'SELECT "ProductCode", "TotalQuantity" FROM public."ProductStockTotals" WHERE "ProductCode" = ANY(%s)',
+                    [product_codes],
+                )
+            except psycopg2.errors.UndefinedTable:
+                # Migration 9 not applied yet: aggregate ProductStock directly
+                conn.rollback()
+                cur.execute('''
+                    SELECT "ProductCode", COALESCE(SUM("Quantity"), 0)
+                    FROM public."ProductStock"
+                    WHERE "ProductCode" = ANY(%s)
+                    GROUP BY "ProductCode"
+                ''', [product_codes])
+            return {code: qty for code, qty in cur.fetchall()}
+    finally:
+        conn.close()
+
+
 @app.route("/product-capacity-stock", methods=["POST"])
 def product_capacity_stock():
     """
@@ -4261,8 +7228,9 @@ def product_capacity_stock():
       // or
       "avo_material_nos": ["VA13116595N","V1001MR035"]
     }
-    Returns WeeklyCapacity + Line from ProductDetails, and summed Quantity from ProductStock.
-    (Fetched independently — no JOIN.)
+    Returns WeeklyCapacity + Line from ProductDetails (PRODUCT_DETAILS_CACHE),
+    and summed Quantity from ProductStock (ProductStockTotals, cached for
+    PRODUCT_STOCK_CACHE_TTL seconds; "cache": false to bypass).
     """
     try:
         body = _extract_body()
@@ -4275,58 +7243,23 @@ def product_capacity_stock():
             app.logger.warning("Missing AVOMaterialNo.")
             return jsonify({"ok": False, "error": "AVOMaterialNo is required."}), 400
 
-        # --- Query ProductDetails (WeeklyCapacity + Line) — NO JOIN ---
-        sql_pd = '''
-            SELECT
-                "AVOMaterialNo",
-                MAX("WeeklyCapacity") AS "WeeklyCapacity",
-                MAX("Line") AS "Line"
-            FROM public."ProductDetails"
-            WHERE "AVOMaterialNo" = ANY(%s)
-            GROUP BY "AVOMaterialNo";
-        '''
-
-        # --- Query ProductStock (TotalQuantity) — NO JOIN ---
-        sql_ps = '''
-            SELECT
-                "ProductCode" AS "AVOMaterialNo",
-                COALESCE(SUM("Quantity"), 0) AS "TotalQuantity"
-            FROM public."ProductStock"
-            WHERE "ProductCode" = ANY(%s)
-            GROUP BY "ProductCode";
-        '''
-
-        app.logger.debug("SQL ProductDetails:\n%s", sql_pd)
-        app.logger.debug("SQL ProductStock:\n%s", sql_ps)
-
-        conn = get_pg_connection()
-        try:
-            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                # ProductDetails
-                cur.execute(sql_pd, [avo_list])
-                pd_rows = cur.fetchall()
-                app.logger.info("ProductDetails rows: %d", len(pd_rows))
-                # map: AVO -> {"WeeklyCapacity": x, "Line": y}
-                pd_map = {
-                    r["AVOMaterialNo"]: {
-                        "WeeklyCapacity": r["WeeklyCapacity"],
-                        "Line": r.get("Line")
-                    }
-                    for r in pd_rows
-                }
+        # --- ProductDetails (WeeklyCapacity + Line), keyed by product_key() ---
+        pd_map = fetch_productdetails_map(avo_list)
+        app.logger.info("ProductDetails products: %d", len(pd_map))
 
-                # ProductStock
-                cur.execute(sql_ps, [avo_list])
-                ps_rows = cur.fetchall()
-                app.logger.info("ProductStock rows: %d", len(ps_rows))
-                ps_map = {r["AVOMaterialNo"]: r["TotalQuantity"] for r in ps_rows}
-        finally:
-            conn.close()
+        # --- ProductStock (TotalQuantity): one round trip, then cached per product set ---
+        use_cache = str(body.get("cache", True)).strip().lower() not in ("false", "0", "no")
+        stock_key = tuple(sorted(set(avo_list)))
+        ps_map = PRODUCT_STOCK_CACHE.get(stock_key) if use_cache else None
+        if ps_map is None:
+            ps_map = fetch_product_stock_totals(list(stock_key))
+            PRODUCT_STOCK_CACHE.put(stock_key, ps_map)
+        app.logger.info("ProductStock products: %d", len(ps_map))
 
         # Merge results in Python (preserve request order)
         items = []
         for avo in avo_list:
-            pd_info = pd_map.get(avo, {})
+            pd_info = pd_map.get(product_key(avo), {})
             weekly = pd_info.get("WeeklyCapacity")
             line   = pd_info.get("Line")
             totalq = ps_map.get(avo, 0)
@@ -5069,25 +8002,228 @@ def get_past_weeks(count):
     return weeks
 
 
+# Per-owner reports (slice, AI wording, Excel) are built concurrently, then
+# sent back to back over one SMTP connection.
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", "4"))
+
+# Outcome and per-stage timings (ms) of the last scheduled_analysis_job run.
+# The job publishes copies of its working state; /scheduler-health reads it
+# under the same lock.
+last_report_run: Dict[str, Any] = {}
+_last_report_run_lock = threading.Lock()
+
+
+def _publish_report_run(run: Dict[str, Any]):
+    published = copy.deepcopy(run)
+    with _last_report_run_lock:
+        last_report_run.clear()
+        last_report_run.update(published)
+
+
+def get_last_report_run() -> Dict[str, Any]:
+    with _last_report_run_lock:
+        return copy.deepcopy(last_report_run)
+
+
+def send_mail_batch(messages: List[Message], timings: Optional[List[Dict[str, float]]] = None) -> List[Optional[str]]:
+    """
+    Send messages over a single SMTP connection. A message whose send fails
+    is retried once on a fresh connection, which the following messages then
+    reuse. Returns one error string per message, None when sent.
+    """
+    def close(conn):
+        try:
+            conn.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    send_errors: List[Optional[str]] = []
+    conn = None
+    try:
+        for i, msg in enumerate(messages):
+            with _report_stage(timings[i] if timings else None, "send"):
+                error = None
+                for attempt in (1, 2):
+                    try:
+                        if conn is None:
+                            conn = mail.connect().__enter__()
+                        conn.send(msg)
+                        error = None
+                        break
+                    except Exception as e:
+                        logging.error(f"[REPORTS] sending to {msg.recipients} failed (attempt {attempt}): {e}")
+                        error = str(e)
+                        if conn is not None:
+                            close(conn)
+                            conn = None
+                send_errors.append(error)
+    finally:
+        if conn is not None:
+            close(conn)
+    return send_errors
+
+
 def scheduled_analysis_job():
     with app.app_context():
         weeks = get_past_weeks(3)
-        for email, client_list in CLIENT_OWNERS.items():
+        run: Dict[str, Any] = {"started_at": datetime.now().isoformat(), "weeks": weeks, "timings_ms": {}, "owners": {}}
+        _publish_report_run(run)
+
+        # One fetch + analysis for every owner; each report is a slice of it.
+        try:
+            with _report_stage(run["timings_ms"], "snapshot"):
+                snapshot = load_analysis_snapshot(weeks)
+        except Exception as e:
+            logging.exception("Scheduled analysis: loading the data snapshot failed")
+            run["error"] = f"loading the data snapshot failed: {e}"
+            run["finished_at"] = datetime.now().isoformat()
+            _publish_report_run(run)
+            return
+        _publish_report_run(run)
+
+        def build(email, client_list):
             report_payload = {
                 "forecastWeeks": weeks,
                 "clientCodes": client_list,
                 "email_recipient": email,
                 "use_ai": True
             }
+            timings: Dict[str, float] = {}
             # This NO LONGER touches the Flask 'request' object
-            trigger_report_logic(report_payload)
+            with app.app_context():
+                msg, response, status = prepare_report(report_payload, snapshot, timings)
+            return msg, response, status, timings
+
+        with _report_stage(run["timings_ms"], "build"):
+            with ThreadPoolExecutor(max_workers=max(1, REPORT_WORKERS), thread_name_prefix="report") as pool:
+                futures = {email: pool.submit(build, email, cl) for email, cl in CLIENT_OWNERS.items()}
+                built = {email: fut.result() for email, fut in futures.items()}
+        _publish_report_run(run)
+
+        ready = [(email, b) for email, b in built.items() if b[0] is not None]
+        with _report_stage(run["timings_ms"], "send"):
+            send_errors = send_mail_batch([b[0] for _, b in ready], [b[3] for _, b in ready])
+        send_error_by_email = {email: err for (email, _), err in zip(ready, send_errors)}
+
+        for email, (msg, response, status, timings) in built.items():
+            err = send_error_by_email.get(email)
+            if err:
+                response, status = {"status": "error", "message": err}, 500
+            run["owners"][email] = {"status": status, "message": response.get("message"), "timings_ms": timings}
+            logging.info(f"[REPORTS] {email}: {status} {timings}")
+
+        run["finished_at"] = datetime.now().isoformat()
+        _publish_report_run(run)
+
+
+def load_analysis_snapshot(
+    weeks: List[str],
+    client_codes: Optional[List[str]] = None,
+    product_codes: Optional[List[str]] = None,
+    sites: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Everything the report analysis reads from the database, fetched once.
+    analyze_snapshot() can then serve any subset of the clients from it.
+    """
+    edi_rows = fetch_ediglobal(weeks, client_codes, product_codes, sites)
+    in_transit_map = load_in_transit_map(weeks, product_codes, sites)
+
+    prods_for_meta = product_codes or sorted({
+        str(r.get("AVOMaterialNo") or "").strip()
+        for r in edi_rows if r.get("AVOMaterialNo")
+    })
+    product_info = fetch_productdetails_map(prods_for_meta)
+
+    # Normalize weeks
+    for r in edi_rows:
+        r["ForecastDate"] = norm_week_str(r.get("ForecastDate"))
+
+    return {
+        "edi_rows": edi_rows,
+        "in_transit_map": in_transit_map,
+        "product_info": product_info,
+        "results": {},   # found weeks -> analysis of every snapshot row in those weeks
+        "lock": threading.Lock(),
+    }
+
+
+def analyze_snapshot(snapshot: Dict[str, Any], client_codes: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Analysis result for the snapshot restricted to client_codes, identical to
+    analysing a fetch filtered on those clients. Results are keyed per
+    (Site, ClientCode, AVOMaterialNo, Interval) and only depend on that key's
+    rows and the set of forecast weeks compared, so one run over all clients
+    is sliced for every client list that has data in the same weeks.
+    Returns a private copy; callers may mutate it.
+    """
+    wanted = set(client_codes) if client_codes else None
+    edi_rows = [r for r in snapshot["edi_rows"] if wanted is None or r.get("ClientCode") in wanted]
+    product_info, in_transit_map = snapshot["product_info"], snapshot["in_transit_map"]
+
+    # Check actual data availability
+    found_data_weeks = tuple(sorted({r["ForecastDate"] for r in edi_rows if r.get("ForecastDate")}))
+
+    if len(found_data_weeks) < 2:
+        logging.warning(f"Found data for {len(found_data_weeks)} week(s). Fallback to single-week analysis.")
+        return analyze_single_week([dict(r) for r in edi_rows], None, product_info, in_transit_map)
+
+    with snapshot["lock"]:   # owners may be analysed from several threads
+        shared = snapshot["results"].get(found_data_weeks)
+        if shared is None:
+            rows = [
+                dict(r) for r in snapshot["edi_rows"]
+                if not r.get("ForecastDate") or r["ForecastDate"] in found_data_weeks
+            ]
+            shared = run_edi_analysis(rows, None, product_info, in_transit_map=in_transit_map)
+            snapshot["results"][found_data_weeks] = shared
+
+    if wanted is None:
+        return copy.deepcopy(shared)
+    return {
+        k: [r for r in v if r.get("ClientCode") in wanted] if isinstance(v, list) else v
+        for k, v in copy.deepcopy(shared).items()
+    }
 
 
+@contextmanager
+def _report_stage(timings: Optional[Dict[str, float]], stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0.0) + (time.perf_counter() - started) * 1000.0, 1)
+
 
 # Helper to avoid code duplication between API and Scheduler
-def trigger_report_logic(data_dict):
+def trigger_report_logic(data_dict, snapshot: Optional[Dict[str, Any]] = None):
     """
     Returns a tuple: (python_dict, status_code)
+
+    snapshot: from load_analysis_snapshot (same weeks, products and sites), so
+    several reports can share one fetch; otherwise the data is fetched here.
+    """
+    msg, response, status = prepare_report(data_dict, snapshot)
+    if msg is None:
+        return response, status
+    try:
+        mail.send(msg)
+    except Exception as e:
+        logging.exception("Error in trigger_report_logic")
+        return {"status": "error", "message": str(e)}, 500
+    return response, status
+
+
+def prepare_report(
+    data_dict,
+    snapshot: Optional[Dict[str, Any]] = None,
+    timings: Optional[Dict[str, float]] = None,
+) -> Tuple[Optional[Message], Dict[str, Any], int]:
+    """
+    Everything trigger_report_logic does except sending: returns
+    (message or None, response dict, status code). Per-stage milliseconds are
+    added to `timings` when given. Needs an app context (Message defaults).
     """
     try:
         # 1) Use the passed dictionary
@@ -5099,51 +8235,37 @@ def trigger_report_logic(data_dict):
         use_ai = data_dict.get("use_ai", True)
 
         if not recipient_email or not weeks:
-            return {"status": "error", "message": "email_recipient and forecastWeeks are required"}, 400
+            return None, {"status": "error", "message": "email_recipient and forecastWeeks are required"}, 400
 
         # 2) Run Core Analysis
-        edi_rows = fetch_ediglobal(weeks, client_codes, product_codes, sites)
-        delivery_rows = fetch_deliverydetails(weeks, product_codes, sites)
-
-        prods_for_meta = product_codes or sorted({
-            str(r.get("AVOMaterialNo") or "").strip()
-            for r in edi_rows if r.get("AVOMaterialNo")
-        })
-        product_info = fetch_productdetails_map(prods_for_meta)
-
-        # Normalize weeks
-        for r in edi_rows:
-            r["ForecastDate"] = norm_week_str(r.get("ForecastDate"))
-
-        # Check actual data availability
-        found_data_weeks = sorted({r["ForecastDate"] for r in edi_rows if r.get("ForecastDate")})
-
-        if len(found_data_weeks) < 2:
-            logging.warning(f"Requested {len(weeks)} weeks but found data for {len(found_data_weeks)}. Fallback to single-week analysis.")
-            result = analyze_single_week(edi_rows, delivery_rows, product_info)
-        else:
-            result = run_edi_analysis(edi_rows, delivery_rows, product_info)
-
-        # 3) Enrich RED rows
-        red_rows = result.get("red_sheet") or []
-        for i, r in enumerate(red_rows):
-            prim = build_ai_row(i, r)
-            for k, v in prim.items():
-                r.setdefault(k, v)
-
-        # 4) Deterministic Decisions
-        result = apply_matrix_decisions_red_only(result)
+        with _report_stage(timings, "analysis"):
+            if snapshot is None:
+                snapshot = load_analysis_snapshot(weeks, client_codes, product_codes, sites)
+            result = analyze_snapshot(snapshot, client_codes)
+
+        with _report_stage(timings, "decisions"):
+            # 3) Enrich RED rows
+            red_rows = result.get("red_sheet") or []
+            for i, r in enumerate(red_rows):
+                prim = build_ai_row(i, r)
+                for k, v in prim.items():
+                    r.setdefault(k, v)
+
+            # 4) Deterministic Decisions
+            result = apply_matrix_decisions_red_only(result)
 
         # 5) AI Rewrite
-        if use_ai and client and result.get("red_sheet"):
-            result["red_sheet"] = rewrite_decisions_with_ai_one_sentence(result["red_sheet"])
+        with _report_stage(timings, "ai"):
+            if use_ai and client and result.get("red_sheet"):
+                result["red_sheet"] = rewrite_decisions_with_ai_one_sentence(result["red_sheet"])
 
-        # 6) Finalize
-        result = finalize_decision_column_for_excel(result)
-        result = compute_reporting_fields(result, weeks)
+        with _report_stage(timings, "excel"):
+            # 6) Finalize
+            result = finalize_decision_column_for_excel(result)
+            result = compute_reporting_fields(result, weeks)
 
-        # 7) Generate Excel
-        excel_bytes = generate_excel_bytes(result)
+            # 7) Generate Excel
+            excel_bytes = generate_excel_bytes(result)
 
         # 8) Send Email
         subject_weeks = f"{weeks[0]}" if len(weeks) == 1 else f"{weeks[0]} vs {weeks[-1]}"
@@ -5193,10 +8315,8 @@ def trigger_report_logic(data_dict):
             excel_bytes
         )
 
-        mail.send(msg)
-
         # Return a Python DICT, not a jsonify object
-        return {
+        return msg, {
             "status": "success",
             "message": f"Report sent to {recipient_email}",
             "filename": filename
@@ -5205,72 +8325,338 @@ def trigger_report_logic(data_dict):
     except Exception as e:
         logging.exception("Error in trigger_report_logic")
         # Return a Python DICT for error too
-        return {"status": "error", "message": str(e)}, 500
+        return None, {"status": "error", "message": str(e)}, 500
     
+# ========================= RESPONSE ENCODING & FORMATS =========================
+# Large JSON/NDJSON/Arrow responses are compressed by Accept-Encoding (br when
+# the brotli package is installed, else gzip) in an after_request hook; NDJSON
+# streams are compressed chunk by chunk so they stay streamed. Bulk data routes
+# also take an opt-in "format":
+#   "json"       (default) list of row objects
+#   "columnar"   {"columns": [...], "data": {column: [values...]}}
+#   "arrow"      Arrow IPC stream bytes (needs pyarrow)
+#   "parquet"    Parquet file bytes (needs pyarrow)
+# For arrow/parquet, paging metadata moves to the X-Row-Count / X-Next-Cursor headers.
+
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.environ.get("RESPONSE_GZIP_LEVEL", "6"))
+RESPONSE_BROTLI_QUALITY = int(os.environ.get("RESPONSE_BROTLI_QUALITY", "5"))
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson", "application/vnd.apache.arrow.stream"}
+BINARY_FORMAT_MIMETYPES = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+RESPONSE_FORMATS = ("json", "columnar") + tuple(BINARY_FORMAT_MIMETYPES)
+
+
+def negotiate_response_encoding() -> Optional[str]:
+    """'br', 'gzip' or None from the request's Accept-Encoding (q=0 excludes)."""
+    accepted = {}
+    for part in (request.headers.get("Accept-Encoding") or "").lower().split(","):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if token:
+            accepted[token] = q
+    for encoding in (("br", "gzip") if brotli is not None else ("gzip",)):
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress_payload(data: bytes, encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """(body, Content-Encoding applied); small bodies are left as they are."""
+    if not encoding or len(data) < RESPONSE_COMPRESSION_MIN_BYTES:
+        return data, None
+    if encoding == "br":
+        return brotli.compress(data, quality=RESPONSE_BROTLI_QUALITY), "br"
+    return gzip.compress(data, compresslevel=RESPONSE_GZIP_LEVEL), "gzip"
+
+
+def _compress_chunks(chunks, encoding: str):
+    """Compress a streamed body, flushing after every chunk so readers keep up."""
+    if encoding == "br":
+        comp = brotli.Compressor(quality=RESPONSE_BROTLI_QUALITY)
+        compress, sync, finish = comp.process, comp.flush, comp.finish
+    else:
+        comp = zlib.compressobj(RESPONSE_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, sync, finish = comp.compress, (lambda: comp.flush(zlib.Z_SYNC_FLUSH)), comp.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            out = compress(chunk) + sync()
+            if out:
+                yield out
+        yield finish()
+    finally:
+        # Closing the wrapper must still run the inner generator's cleanup
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def encoded_response(payload: bytes, mimetype: str, encoding: Optional[str]):
+    """Response for an already encoded body (e.g. served from a cache)."""
+    resp = app.response_class(payload, mimetype=mimetype)
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+
+@app.after_request
+def compress_response(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough:
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code < 200 or response.status_code in (204, 304) or "Content-Encoding" in response.headers:
+        return response
+    encoding = negotiate_response_encoding()
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_chunks(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    payload, applied = compress_payload(response.get_data(), encoding)
+    if applied:
+        response.set_data(payload)
+        response.headers["Content-Encoding"] = applied
+    return response
+
+
+def response_format(body: Dict[str, Any], allowed: Tuple[str, ...] = RESPONSE_FORMATS) -> str:
+    """Requested "format" (default json); ValueError for unknown or unavailable ones."""
+    fmt = str(body.get("format") or "json").strip().lower()
+    if fmt not in allowed:
+        raise ValueError(f"Unsupported format '{fmt}'. Use one of: {', '.join(allowed)}")
+    if fmt in BINARY_FORMAT_MIMETYPES and pa is None:
+        raise ValueError(f"format '{fmt}' needs pyarrow, which is not installed on this server")
+    return fmt
+
+
+def records_to_columnar(rows: List[dict], columns: Optional[List[str]] = None) -> Dict[str, Any]:
+    """List of row dicts -> {"columns": [...], "data": {column: [values...]}}."""
+    if columns is None:
+        columns = list(dict.fromkeys(k for r in rows for k in r))
+    return {"columns": columns, "data": {c: [r.get(c) for r in rows] for c in columns}}
+
+
+def tabular_bytes(df: pd.DataFrame, fmt: str) -> bytes:
+    """Arrow IPC stream or Parquet bytes of a DataFrame."""
+    buf = io.BytesIO()
+    if fmt == "parquet":
+        df.to_parquet(buf, index=False, engine="pyarrow")
+        return buf.getvalue()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.ipc.new_stream(buf, table.schema) as writer:
+        writer.write_table(table)
+    return buf.getvalue()
+
+
+def tabular_response(df: pd.DataFrame, fmt: str, headers: Optional[Dict[str, Any]] = None):
+    resp = app.response_class(tabular_bytes(df, fmt), mimetype=BINARY_FORMAT_MIMETYPES[fmt])
+    resp.headers["X-Row-Count"] = str(len(df))
+    for name, value in (headers or {}).items():
+        if value is not None:
+            resp.headers[name] = str(value)
+    return resp
+
+
 # ========================= DATA RETRIEVAL APIS =========================
+# /get-delivery-details and /get-edi-global share query_table_rows(), which
+# adds to the plain filtered listing:
+#   "fields": [...]            column projection (default: every column)
+#   "pageSize": n, "cursor"    keyset pagination; the response carries
+#                              "next_cursor" (null on the last page)
+#   "format": "ndjson"         stream one JSON object per line from a
+#                              server-side cursor instead of one big array
+#   "format": "columnar" | "arrow" | "parquet"   see RESPONSE ENCODING & FORMATS
+# Pages are ordered by the table's primary key (ctid when it has none).
+
+API_PAGE_SIZE_MAX = int(os.environ.get("API_PAGE_SIZE_MAX", "10000"))
+API_STREAM_FETCH_SIZE = int(os.environ.get("API_STREAM_FETCH_SIZE", "2000"))
+
+_table_meta_cache: Dict[str, Tuple[List[str], List[str]]] = {}
+
+
+def _table_meta(cur, table: str) -> Tuple[List[str], List[str]]:
+    """(columns in table order, primary key columns) of a public table."""
+    meta = _table_meta_cache.get(table)
+    if meta is None:
+        regclass = f'public."{table}"'
+        cur.execute("""
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+            ORDER BY attnum
+        """, (regclass,))
+        columns = [r[0] for r in cur.fetchall()]
+        cur.execute("""
+            SELECT a.attname
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = %s::regclass AND i.indisprimary
+            ORDER BY array_position(i.indkey::int2[], a.attnum)
+        """, (regclass,))
+        meta = (columns, [r[0] for r in cur.fetchall()])
+        _table_meta_cache[table] = meta
+    return meta
+
+
+def _encode_page_cursor(table: str, key_values: List[Any]) -> str:
+    raw = json.dumps({"t": table, "k": key_values}, default=str).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_page_cursor(table: str, token: str, n_keys: int) -> List[Any]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        values = data["k"]
+        ok = data.get("t") == table and isinstance(values, list) and len(values) == n_keys
+    except Exception:
+        ok = False
+    if not ok:
+        raise ValueError("invalid cursor")
+    return values
 
-@app.route("/get-delivery-details", methods=["POST"])
-def get_delivery_details():
-    """Retrieves records from DeliveryDetails with optional filters."""
+
+def query_table_rows(table: str, filters: List[Tuple[str, Optional[List[str]]]], body: Dict[str, Any]):
+    """
+    Filtered rows of `table` ("col" = ANY(values) for every non-empty filter),
+    as a Flask response: JSON, columnar JSON or Arrow/Parquet bytes (optionally
+    one keyset page), or an NDJSON stream.
+    """
+    fields = _coerce_list(body.get("fields"))
     try:
-        body = _extract_body()
-        sites = _coerce_list(body.get("sites"))
-        avo_materials = _coerce_list(body.get("AVOMaterialNo"))
-        statuses = _coerce_list(body.get("statuses"))
-
-        sql = 'SELECT * FROM public."DeliveryDetails" WHERE 1=1'
-        params = []
-
-        if sites:
-            sql += ' AND "Site" = ANY(%s)'
-            params.append(sites)
-        if avo_materials:
-            sql += ' AND "AVOMaterialNo" = ANY(%s)'
-            params.append(avo_materials)
-        if statuses:
-            sql += ' AND "Status" = ANY(%s)'
-            params.append(statuses)
+        fmt = response_format(body, RESPONSE_FORMATS + ("ndjson",))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    stream = fmt == "ndjson"
+    cursor_token = body.get("cursor") or None
+    page_size = body.get("pageSize")
+    paginate = not stream and (page_size is not None or cursor_token is not None)
+    if paginate:
+        try:
+            page_size = int(page_size if page_size is not None else 1000)
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "pageSize must be an integer"}), 400
+        if not 1 <= page_size <= API_PAGE_SIZE_MAX:
+            return jsonify({"status": "error", "message": f"pageSize must be between 1 and {API_PAGE_SIZE_MAX}"}), 400
 
-        conn = get_pg_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    conn = get_pg_connection()
+    streaming = False
+    try:
+        with conn.cursor() as cur:
+            columns, pk = _table_meta(cur, table)
+        if fields:
+            unknown = [f for f in fields if f not in columns]
+            if unknown:
+                return jsonify({"status": "error", "message": f"Unknown fields: {unknown}", "available": columns}), 400
+        select_cols = fields or columns
+        key_sql = [f'"{c}"' for c in pk] or ["ctid"]
+
+        # Key columns ride along after the projected ones for the next cursor
+        cols_sql = ", ".join([f'"{c}"' for c in select_cols] + key_sql)
+        sql = f'SELECT {cols_sql} FROM public."{table}" WHERE 1=1'
+        params: List[Any] = []
+        for col, values in filters:
+            if values:
+                sql += f' AND "{col}" = ANY(%s)'
+                params.append(values)
+        if cursor_token:
+            try:
+                after = _decode_page_cursor(table, cursor_token, len(key_sql))
+            except ValueError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+            placeholders = ", ".join("%s::tid" if k == "ctid" else "%s" for k in key_sql)
+            sql += f" AND ({', '.join(key_sql)}) > ({placeholders})"
+            params.extend(after)
+        if paginate or cursor_token:
+            sql += f" ORDER BY {', '.join(key_sql)}"
+        if paginate:
+            sql += " LIMIT %s"
+            params.append(page_size + 1)
+
+        n = len(select_cols)
+        if stream:
+            def generate():
+                try:
+                    with conn.cursor(name=f"stream_{table}_{uuid.uuid4().hex[:8]}") as cur:
+                        cur.itersize = API_STREAM_FETCH_SIZE
+                        cur.execute(sql, params)
+                        while True:
+                            rows = cur.fetchmany(API_STREAM_FETCH_SIZE)
+                            if not rows:
+                                break
+                            yield "".join(app.json.dumps(dict(zip(select_cols, r[:n]))) + "\n" for r in rows)
+                finally:
+                    conn.close()
+
+            streaming = True
+            resp = app.response_class(generate(), mimetype="application/x-ndjson")
+            # Also covers a generator that never starts (client gone, HEAD, a
+            # failing after_request hook), whose finally would not run
+            resp.call_on_close(conn.close)
+            return resp
+
+        with conn.cursor() as cur:
             cur.execute(sql, params)
             rows = cur.fetchall()
-        conn.close()
 
-        return jsonify({"status": "success", "count": len(rows), "data": rows}), 200
+        response: Dict[str, Any] = {"status": "success"}
+        if paginate:
+            has_more = len(rows) > page_size
+            rows = rows[:page_size]
+            response["next_cursor"] = _encode_page_cursor(table, list(rows[-1][n:])) if has_more else None
+            response["page_size"] = page_size
+        if fmt in BINARY_FORMAT_MIMETYPES:
+            df = pd.DataFrame.from_records([r[:n] for r in rows], columns=select_cols)
+            return tabular_response(df, fmt, {"X-Next-Cursor": response.get("next_cursor")}), 200
+        if fmt == "columnar":
+            data = {c: [r[i] for r in rows] for i, c in enumerate(select_cols)}
+            response.update({"count": len(rows), "columns": select_cols, "data": data})
+        else:
+            data = [dict(zip(select_cols, r[:n])) for r in rows]
+            response.update({"count": len(data), "data": data})
+        return jsonify(response), 200
+    finally:
+        if not streaming:
+            conn.close()
+
+
+@app.route("/get-delivery-details", methods=["POST"])
+def get_delivery_details():
+    """Retrieves records from DeliveryDetails with optional filters (see query_table_rows)."""
+    try:
+        body = _extract_body()
+        return query_table_rows("DeliveryDetails", [
+            ("Site", _coerce_list(body.get("sites"))),
+            ("AVOMaterialNo", _coerce_list(body.get("AVOMaterialNo"))),
+            ("Status", _coerce_list(body.get("statuses"))),
+        ], body)
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
 @app.route("/get-edi-global", methods=["POST"])
 def get_edi_global():
-    """Retrieves records from EDIGlobal, typically filtered by ForecastDate."""
+    """Retrieves records from EDIGlobal, typically filtered by ForecastDate (see query_table_rows)."""
     try:
         body = _extract_body()
-        forecast_weeks = _coerce_list(body.get("forecastWeeks"))
-        client_codes = _coerce_list(body.get("clientCodes"))
-        avo_materials = _coerce_list(body.get("AVOMaterialNo"))
-
-        sql = 'SELECT * FROM public."EDIGlobal" WHERE 1=1'
-        params = []
-
-        if forecast_weeks:
-            sql += ' AND "ForecastDate" = ANY(%s)'
-            params.append(forecast_weeks)
-        if client_codes:
-            sql += ' AND "ClientCode" = ANY(%s)'
-            params.append(client_codes)
-        if avo_materials:
-            sql += ' AND "AVOMaterialNo" = ANY(%s)'
-            params.append(avo_materials)
-
-        conn = get_pg_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(sql, params)
-            rows = cur.fetchall()
-        conn.close()
-
-        return jsonify({"status": "success", "count": len(rows), "data": rows}), 200
+        return query_table_rows("EDIGlobal", [
+            ("ForecastDate", _coerce_list(body.get("forecastWeeks"))),
+            ("ClientCode", _coerce_list(body.get("clientCodes"))),
+            ("AVOMaterialNo", _coerce_list(body.get("AVOMaterialNo"))),
+        ], body)
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -5280,24 +8666,22 @@ def get_product_details_route():
     """
     GET: Returns all products.
     POST: Returns specific products via AVOMaterialNo list.
+    Both take an optional "format" (json | columnar | arrow | parquet).
     """
     try:
-        sql = 'SELECT * FROM public."ProductDetails"'
-        params = []
-
-        if request.method == "POST":
-            body = _extract_body()
-            avo_materials = _coerce_list(body.get("AVOMaterialNo"))
-            if avo_materials:
-                sql += ' WHERE "AVOMaterialNo" = ANY(%s)'
-                params.append(avo_materials)
+        body = _extract_body() if request.method == "POST" else request.args
+        try:
+            fmt = response_format(body)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
 
-        conn = get_pg_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(sql, params)
-            rows = cur.fetchall()
-        conn.close()
+        avo_materials = _coerce_list(body.get("AVOMaterialNo")) if request.method == "POST" else None
+        columns, rows = PRODUCT_DETAILS_CACHE.rows(avo_materials)
 
+        if fmt in BINARY_FORMAT_MIMETYPES:
+            return tabular_response(pd.DataFrame.from_records(rows, columns=columns), fmt), 200
+        if fmt == "columnar":
+            return jsonify({"status": "success", "count": len(rows), **records_to_columnar(rows, columns)}), 200
         return jsonify({"status": "success", "count": len(rows), "data": rows}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -5331,18 +8715,83 @@ CLIENT_CS_MAP = {
 }
 
 
-CLIENT_NAMES = {
-    "C00126": "Nidec Pologne",
-    "C00050": "Nidec ESP",
-    "C00113": "Nidec DCK",
-    "C00285": "Pierburg",
-    "C00125": "Valeo Madrid",
-    "C00303": "Valeo Mexique",
-    "C00410": "Inteva Esson",
-    "C00250": "Valeo Pologne",
-    "C00072": "Valeo Brasil",
-    "C00409": "Valeo Nevers"
-}
+def compliance_weeks(count: int = 10) -> List[str]:
+    """The current ISO week and the (count - 1) before it, newest first."""
+    today = datetime.now()
+    weeks_to_check = []
+    for i in range(count):
+        d = today - timedelta(weeks=i)
+        iso_year, iso_week, _ = d.isocalendar()
+        weeks_to_check.append(f"{iso_year}-W{iso_week:02d}")
+    return weeks_to_check
+
+
+def fetch_edi_week_presence(client_codes: List[str], weeks: List[str]) -> Dict[str, set]:
+    """
+    ClientCode -> set of ForecastDate weeks with EDI data, in one query:
+    from EDIWeekPresence, or grouped from EDIGlobal until migration 7 has run.
+    """
+    found: Dict[str, set] = defaultdict(set)
+    conn = get_pg_connection()
+    try:
+        with conn.cursor() as cur:
+            try:
+                cur.execute("""
+                    SELECT "ClientCode", "ForecastDate"
+                    FROM public."EDIWeekPresence"
+                    WHERE "ClientCode" = ANY(%s) AND "ForecastDate" = ANY(%s)
+                """, (client_codes, weeks))
+            except psycopg2.errors.UndefinedTable:
+                conn.rollback()
+                cur.execute("""
+                    SELECT "ClientCode", "ForecastDate"
+                    FROM public."EDIGlobal"
+                    WHERE "ClientCode" = ANY(%s) AND "ForecastDate" = ANY(%s)
+                    GROUP BY "ClientCode", "ForecastDate"
+                """, (client_codes, weeks))
+            for client_code, week in cur.fetchall():
+                found[client_code].add(week)
+    finally:
+        conn.close()
+    return found
+
+
+def compute_edi_compliance(weeks_to_check: List[str], client_codes: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Per client (default: every client in CLIENT_CS_MAP): weeks found / missing
+    among weeks_to_check (newest first) and the current streak of consecutive
+    missing weeks, which determines the escalation level.
+    """
+    client_codes = client_codes or list(CLIENT_CS_MAP)
+    found_by_client = fetch_edi_week_presence(client_codes, weeks_to_check)
+
+    report = []
+    for client_code in client_codes:
+        found_weeks = found_by_client.get(client_code, set())
+
+        # Identify Missing Weeks & Calculate Streak
+        missing_weeks = []
+        current_streak = 0
+        streak_broken = False
+
+        # Iterate from newest to oldest
+        for w in weeks_to_check:
+            if w not in found_weeks:
+                missing_weeks.append(w)
+                if not streak_broken:
+                    current_streak += 1
+            else:
+                streak_broken = True # Data found, so the consecutive "missing" streak stops here
+
+        report.append({
+            "client_code": client_code,
+            "client_name": MAPPING_REGISTRY.forward("client.name").get(client_code, "Unknown Client"),
+            "cs_email": CLIENT_CS_MAP.get(client_code),
+            "found_weeks": [w for w in weeks_to_check if w in found_weeks],
+            "missing_weeks": missing_weeks,
+            "streak": current_streak # Streak determines escalation level
+        })
+    return report
 
 
 def check_edi_compliance_job():
@@ -5353,57 +8802,25 @@ def check_edi_compliance_job():
     """
     with app.app_context():
         logging.info("--- STARTING DETAILED COMPLIANCE CHECK ---")
-        
-        # 1. Prepare Week List (Current + 3 previous)
-        # We check these 4 specific weeks for presence
-        today = datetime.now()
-        weeks_to_check = []
-        for i in range(10):
-            d = today - timedelta(weeks=i)
-            iso_year, iso_week, _ = d.isocalendar()
-            weeks_to_check.append(f"{iso_year}-W{iso_week:02d}")
-        
+
         # Structure: { 'email@avo.com': [ {'client': 'C001', 'missing_weeks': ['2026-W02', ...], 'streak': 2}, ... ] }
         violations_by_email = defaultdict(list)
 
-        conn = get_pg_connection()
         try:
-            with conn.cursor() as cur:
-                for client_code, cs_email in CLIENT_CS_MAP.items():
-                    
-                    # 2. Check existence for the last 4 weeks
-                    cur.execute("""
-                        SELECT DISTINCT "ForecastDate" 
-                        FROM public."EDIGlobal" 
-                        WHERE "ClientCode" = %s AND "ForecastDate" = ANY(%s)
-                    """, (client_code, weeks_to_check))
-                    
-                    found_weeks = {row[0] for row in cur.fetchall()}
-
-                    # 3. Identify Missing Weeks & Calculate Streak
-                    missing_weeks = []
-                    current_streak = 0
-                    streak_broken = False
-
-                    # Iterate from newest to oldest
-                    for w in weeks_to_check:
-                        if w not in found_weeks:
-                            missing_weeks.append(w)
-                            if not streak_broken:
-                                current_streak += 1
-                        else:
-                            streak_broken = True # Data found, so the consecutive "missing" streak stops here
-                    
-                    # If there are ANY missing weeks, record the violation
-                    if missing_weeks:
-                        violations_by_email[cs_email].append({
-                            "client_code": client_code,
-                            "client_name": CLIENT_NAMES.get(client_code, "Unknown Client"),
-                            "missing_weeks": missing_weeks,
-                            "streak": current_streak # Streak determines escalation level
-                        })
-
-            # 4. Send Consolidated Emails
+            # 1. The last 10 weeks, checked for every client with one query
+            weeks_to_check = compliance_weeks(10)
+
+            for entry in compute_edi_compliance(weeks_to_check):
+                # If there are ANY missing weeks, record the violation
+                if entry["missing_weeks"]:
+                    violations_by_email[entry["cs_email"]].append({
+                        "client_code": entry["client_code"],
+                        "client_name": entry["client_name"],
+                        "missing_weeks": entry["missing_weeks"],
+                        "streak": entry["streak"]
+                    })
+
+            # 2. Send Consolidated Emails
             for email, violation_list in violations_by_email.items():
                 if violation_list:
                     # Sort list so clients with highest streak appear first
@@ -5412,8 +8829,32 @@ def check_edi_compliance_job():
 
         except Exception as e:
             logging.exception("Error in consolidated compliance check")
-        finally:
-            conn.close()
+
+
+@app.route("/edi-compliance", methods=["GET"])
+def edi_compliance():
+    """
+    Missing forecast weeks and streaks per client, for dashboards.
+    Query: ?weeks=10 (1-52) &clientCodes=C00125,C00113 (default: CLIENT_CS_MAP) &onlyMissing=true
+    """
+    try:
+        count = int(request.args.get("weeks", 10))
+        if not 1 <= count <= 52:
+            return jsonify({"status": "error", "message": "weeks must be between 1 and 52"}), 400
+        client_codes = _coerce_list(request.args.get("clientCodes"))
+        only_missing = str(request.args.get("onlyMissing", "")).lower() in ("1", "true", "yes")
+
+        weeks_to_check = compliance_weeks(count)
+        clients = compute_edi_compliance(weeks_to_check, client_codes)
+        if only_missing:
+            clients = [c for c in clients if c["missing_weeks"]]
+        clients.sort(key=lambda c: (-c["streak"], -len(c["missing_weeks"]), c["client_code"]))
+
+        return jsonify({"status": "ok", "current_week": weeks_to_check[0], "weeks": weeks_to_check, "clients": clients}), 200
+    except ValueError:
+        return jsonify({"status": "error", "message": "weeks must be an integer"}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
 
 def send_detailed_escalation_email(cs_email, violation_list, current_week):
@@ -5557,7 +8998,7 @@ def init_scheduler():
         app.logger.info("🔧 Attempting to initialize scheduler...")
         
         # 1. Establish a PERSISTENT connection for the lock
-        scheduler_db_conn = get_pg_connection()
+        scheduler_db_conn = get_direct_pg_connection()
         scheduler_db_conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
         
         with scheduler_db_conn.cursor() as cur:
@@ -5717,6 +9158,8 @@ def ensure_scheduler_started():
         return
     
     app._scheduler_bootstrap_done = True
+    run_startup_migrations()
+    start_change_listener()
     
     try:
         # Double-check it's not already running
@@ -5857,6 +9300,19 @@ def scheduler_health():
             }
         }
         
+        report_run = get_last_report_run()
+        if report_run:
+            status["last_report_run"] = report_run
+
+        try:
+            migrations = get_schema_migration_status()
+            status["schema_migrations"] = {
+                "pending": [m["version"] for m in migrations["pending"]],
+                "failed": migrations["failed"],
+            }
+        except Exception as e:
+            status["schema_migrations"] = {"error": str(e)}
+
         if app_scheduler and app_scheduler.running:
             status["jobs"] = [j.id for j in app_scheduler.get_jobs()]
             status["next_runs"] = {
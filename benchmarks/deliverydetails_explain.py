@@ -0,0 +1,97 @@
+"""
+EXPLAIN plans of the fetch_deliverydetails_raw query with and without the
+DeliveryDetails in-transit lookup indexes (schema migration 1).
+
+    python benchmarks/deliverydetails_explain.py --dsn postgresql://... --products V000001 V000002 --sites Tunisia
+    DATABASE_URL=postgresql://... python benchmarks/deliverydetails_explain.py --synthetic 200000 --analyze
+
+Nothing is changed in the database: each plan is captured in a transaction
+that drops or creates the indexes (and optionally inserts --synthetic rows),
+runs EXPLAIN and then rolls back. DROP INDEX holds a lock on DeliveryDetails
+until that rollback, so the database must be named explicitly (--dsn or
+DATABASE_URL); the app's built-in connection string is never used.
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import App  # noqa: E402
+from psycopg2.extras import execute_values  # noqa: E402
+
+SITES = ["Tunisia", "Germany", "Monterrey", "Kunshan", "Tianjin"]
+STATUSES = ["Delivered", "Delivered", "Delivered", "Delivered", "InTransit", "In Transit", "Dispatched"]
+
+
+def insert_synthetic(cur, n_rows: int, seed: int = 42):
+    rnd = random.Random(seed)
+    rows = [
+        (
+            rnd.choice(SITES),
+            f"V{rnd.randrange(n_rows // 20 + 1):06d}",
+            f"D{n:08d}",
+            f"2025-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}",
+            rnd.choice(STATUSES),
+            rnd.randint(1, 5000),
+        )
+        for n in range(n_rows)
+    ]
+    execute_values(
+        cur,
+        'INSERT INTO public."DeliveryDetails" ("Site","AVOMaterialNo","DeliveryNo","Date","Status","Quantity") VALUES %s',
+        rows,
+        page_size=10000,
+    )
+
+
+def capture_plan(with_indexes: bool, args) -> str:
+    sql, params = App.deliverydetails_intransit_query(args.products, args.sites)
+    options = "ANALYZE, BUFFERS" if args.analyze else "COSTS"
+    conn = App.get_direct_pg_connection()
+    try:
+        with conn.cursor() as cur:
+            if args.synthetic:
+                insert_synthetic(cur, args.synthetic)
+            for name, ddl in App.DELIVERYDETAILS_LOOKUP_INDEXES.items():
+                if with_indexes:
+                    cur.execute(ddl)
+                else:
+                    cur.execute(f'DROP INDEX IF EXISTS public."{name}"')
+            cur.execute('ANALYZE public."DeliveryDetails"')
+            cur.execute(f"EXPLAIN ({options}) {sql}", params)
+            return "\n".join(r[0] for r in cur.fetchall())
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", default=os.environ.get("DATABASE_URL"),
+                        help="database to plan against (default: $DATABASE_URL; required)")
+    parser.add_argument("--products", nargs="*", default=None, help="AVOMaterialNo filter (default: none)")
+    parser.add_argument("--sites", nargs="*", default=None, help="Site filter (default: none)")
+    parser.add_argument("--synthetic", type=int, default=0, help="insert N throwaway rows before planning")
+    parser.add_argument("--analyze", action="store_true", help="EXPLAIN ANALYZE (executes the query)")
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("no database given: pass --dsn or set DATABASE_URL (use a non-production database)")
+
+    logging.disable(logging.CRITICAL)
+    App.DATABASE_URL = args.dsn
+    if args.synthetic and not args.products:
+        args.products = [f"V{n:06d}" for n in range(3)]
+
+    sql, params = App.deliverydetails_intransit_query(args.products, args.sites)
+    print("Query:", " ".join(sql.split()))
+    print("Params:", params)
+    for label, with_indexes in (("BEFORE (no lookup indexes)", False), ("AFTER (migration 1 indexes)", True)):
+        print(f"\n=== {label} ===")
+        print(capture_plan(with_indexes, args))
+
+
+if __name__ == "__main__":
+    main()
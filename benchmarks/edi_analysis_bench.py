@@ -0,0 +1,92 @@
+"""
+Runtime of run_edi_analysis versus the number of (Site, ClientCode,
+AVOMaterialNo, Interval) keys, for both engines.
+
+    python benchmarks/edi_analysis_bench.py
+    python benchmarks/edi_analysis_bench.py --keys 1000 5000 20000 --weeks 8 --engines rows columnar
+
+Data is synthetic (no database needed): every key gets one EDI line per
+forecast week, so the detailed report has keys x (weeks - 1) rows. With the
+summary indexed by key, time per key should stay roughly flat as keys grow.
+"""
+import argparse
+import copy
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import App  # noqa: E402
+
+# DateFrom offsets that land in each analysis interval
+INTERVAL_OFFSETS = [0, 3, 8, 18, 30]
+
+
+def synthetic_rows(n_keys: int, n_weeks: int, seed: int = 42):
+    rnd = random.Random(seed)
+    ref_weeks = [f"2025-W{w:02d}" for w in range(1, n_weeks + 1)]
+    sites = ["Tunisia", "Germany", "Monterrey"]
+    clients = [f"C{c:05d}" for c in range(20)]
+
+    keys = []
+    for n in range(n_keys):
+        rest, offset = divmod(n, len(INTERVAL_OFFSETS))
+        rest, site = divmod(rest, len(sites))
+        product, client = divmod(rest, len(clients))
+        keys.append((sites[site], clients[client], f"V{product:06d}", INTERVAL_OFFSETS[offset]))
+
+    edi_rows = []
+    for ref_no, ref in enumerate(ref_weeks, start=1):
+        for site, client, product, offset in keys:
+            week = ref_no + offset
+            year = 2025 + (week - 1) // 52
+            edi_rows.append({
+                "Site": site,
+                "ClientCode": client,
+                "AVOMaterialNo": product,
+                "ForecastDate": ref,
+                "DateFrom": f"{year}-W{(week - 1) % 52 + 1:02d}",
+                "Quantity": rnd.randint(0, 5000),
+            })
+
+    delivery_rows = [
+        {"Site": site, "AVOMaterialNo": product, "Status": "InTransit", "Quantity": rnd.randint(0, 5000)}
+        for site, _, product, _ in keys[::7]
+    ]
+    return edi_rows, delivery_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, nargs="+", default=[500, 1000, 2000, 5000])
+    parser.add_argument("--weeks", type=int, default=8)
+    parser.add_argument("--engines", nargs="+", default=["rows", "columnar"], choices=["rows", "columnar"])
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    engines = {"rows": App.run_edi_analysis_rows, "columnar": App.run_edi_analysis_columnar}
+
+    print(f"{'keys':>8} {'edi rows':>9} {'detail rows':>11} " + " ".join(f"{e + ' s':>12} {'us/key':>8}" for e in args.engines))
+    for n_keys in args.keys:
+        edi_rows, delivery_rows = synthetic_rows(n_keys, args.weeks)
+        cells = []
+        detail_rows = 0
+        for engine in args.engines:
+            best = None
+            for _ in range(args.repeat):
+                rows = copy.deepcopy(edi_rows)  # the rows engine normalizes in place
+                start = time.perf_counter()
+                result = engines[engine](rows, delivery_rows, {})
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            detail_rows = len(result["green_sheet"]) + len(result["red_sheet"])
+            cells.append(f"{best:>12.3f} {1e6 * best / n_keys:>8.1f}")
+        print(f"{n_keys:>8} {len(edi_rows):>9} {detail_rows:>11} " + " ".join(cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,5 +5,8 @@
 apt-get update
 apt-get install -y libgl1-mesa-glx libglib2.0-0
 
+# Apply pending schema migrations (indexes, constraints); a failure is logged, not fatal
+flask --app App db-migrate || echo "WARNING: schema migrations failed, starting with the current schema"
+
 # Start Gunicorn
 gunicorn --bind=0.0.0.0 --timeout 600 App:app